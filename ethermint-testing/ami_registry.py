@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import re
+import time
+
+import boto3
+
+from settings import AMI_REGISTRY_TTL
+from utils import thread_map
+
+logger = logging.getLogger(__name__)
+
+AMI_ID_PATTERN = re.compile(r'^ami-\w+$')
+
+
+def find_images(ethermint_version, region):
+    """
+    Looks up the Ethermint AMIs of an ethermint version in a region
+    Uses its own session, so that regions can be looked up from many threads
+    :return: a list of AMI IDs
+    """
+    ec2 = boto3.session.Session().resource('ec2', region_name=region)
+    images = ec2.images.filter(Owners=['self'], Filters=[{'Name': 'tag:Ethermint', 'Values': [ethermint_version]}])
+    return [image.id for image in images]
+
+
+class AMIRegistry:
+    """
+    Local registry mapping ethermint version and region to AMI ID
+    Entries older than the TTL are looked up in AWS again, so AMIs deregistered by hand are eventually noticed
+    """
+
+    def __init__(self, path, ttl=AMI_REGISTRY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except ValueError:
+            logger.warning("AMI registry {} is not valid JSON, ignoring it".format(self.path))
+            return {}
+        if not isinstance(entries, dict):
+            logger.warning("AMI registry {} is malformed, ignoring it".format(self.path))
+            return {}
+
+        valid = {}
+        for version, regions in entries.items():
+            if not isinstance(regions, dict):
+                continue
+            for region, entry in regions.items():
+                if self._is_valid(entry):
+                    valid.setdefault(version, {})[region] = entry
+                else:
+                    logger.warning("Ignoring malformed AMI registry entry for {} in {}".format(version, region))
+        return valid
+
+    @staticmethod
+    def _is_valid(entry):
+        return isinstance(entry, dict) and isinstance(entry.get("ami"), basestring) \
+               and AMI_ID_PATTERN.match(entry["ami"]) is not None and isinstance(entry.get("updated"), (int, float))
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # write and rename, so that an interrupted save doesn't leave a truncated registry behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def get(self, ethermint_version, region):
+        """
+        :return: the registered AMI ID, or None if there is none or it is older than the TTL
+        """
+        entry = self.entries.get(ethermint_version, {}).get(region)
+        if entry is None or time.time() - entry["updated"] > self.ttl:
+            return None
+        return entry["ami"]
+
+    def add(self, ethermint_version, region, ami):
+        if not AMI_ID_PATTERN.match(ami):
+            raise ValueError("{} is not an AMI ID".format(ami))
+        self.entries.setdefault(ethermint_version, {})[region] = {"ami": ami, "updated": time.time()}
+
+    def forget(self, ethermint_version):
+        self.entries.pop(ethermint_version, None)
+
+    def refresh(self, ethermint_version, regions):
+        """
+        Looks up the AMIs of the ethermint version in all regions concurrently and updates the registry
+        :return: a dict region -> list of AMI IDs found
+        """
+        regions = list(regions)
+        found = dict(zip(regions, thread_map(lambda region: find_images(ethermint_version, region), regions)))
+        for region, image_ids in found.items():
+            if image_ids:
+                self.add(ethermint_version, region, image_ids[0])
+            else:
+                self.entries.get(ethermint_version, {}).pop(region, None)
+        return found
+
+    def lookup(self, ethermint_version, regions):
+        """
+        Finds the AMIs of the ethermint version, asking AWS only about regions without a fresh registry entry
+        :return: a dict region -> AMI ID, for the regions that have one
+        """
+        stale = [region for region in regions if self.get(ethermint_version, region) is None]
+        if stale:
+            logger.info("Looking up AMIs for {} in regions {}".format(ethermint_version, ", ".join(sorted(stale))))
+            self.refresh(ethermint_version, stale)
+
+        amis = {}
+        for region in regions:
+            ami = self.get(ethermint_version, region)
+            if ami is not None:
+                amis[region] = ami
+        return amis
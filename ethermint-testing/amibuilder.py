@@ -74,11 +74,23 @@ class AMIBuilder:
             logger.error(err.stdout)
             sys.exit(1)
 
-        # retrieve the AMI ID from the command output
-        s = str(filter(lambda line: line.strip(), build_result.stdout.split('\n'))[-1])
-        ami = re.findall('ami-\w{8}', s)[0]
-        logger.info("AMI {} created successfully".format(ami))
-        return ami
+        return build_result.stdout
+
+    def _parse_amis(self, build_output, regions):
+        """
+        Retrieves the AMI IDs from the packer build output.
+        Packer lists the artifacts as "region: ami-id" lines, one per region the AMI was copied to
+        :return: a dict region -> AMI ID
+        """
+        amis = dict(re.findall(r'^\s*([a-z]{2}(?:-gov)?-[a-z]+-\d+): (ami-\w+)\s*$', build_output, re.MULTILINE))
+        if not amis:
+            # older packer versions only print the AMI of the source region
+            last_line = str(filter(lambda line: line.strip(), build_output.split('\n'))[-1])
+            amis = {regions[0]: re.findall(r'ami-\w+', last_line)[0]}
+
+        for region, ami in amis.items():
+            logger.info("AMI {} created successfully in region {}".format(ami, region))
+        return amis
 
     def _get_credentials(self):
         """
@@ -90,6 +102,17 @@ class AMIBuilder:
         secret_key = credentials.secret_key
         return access_key, secret_key
 
+    def create_amis(self, ethermint_version_hash, ami_name, regions):
+        """
+        Builds the AMI once, in the first of the regions, and lets packer copy it to the rest
+        :return: a dict region -> AMI ID (empty if the template didn't validate)
+        """
+        self._generate_packer_file(ethermint_version_hash, ami_name, regions)
+        build_output = self._build_ami_image()
+        if build_output is None:
+            return {}
+        return self._parse_amis(build_output, regions)
+
     def create_ami(self, ethermint_version_hash, ami_name, regions=None):
         """
         Creates an AMI in AWS in given region and returns its ID
@@ -97,5 +120,4 @@ class AMIBuilder:
         if regions is None:
             regions = [DEFAULT_REGION]
 
-        self._generate_packer_file(ethermint_version_hash, ami_name, regions)
-        return self._build_ami_image()
+        return self.create_amis(ethermint_version_hash, ami_name, regions).get(regions[0])
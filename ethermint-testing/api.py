@@ -4,9 +4,16 @@ import logging
 import click
 import yaml
 
+from block_events import NewBlockSubscriber
+from block_index import BlockIndex
 from chain import Chain
 from chainmanager import Chainmanager
 from chainshotter import Chainshotter
+from lineage import load_chainshots, find_chainshot, coverage
+from monitor import ChainMonitor
+from resource_gc import collect_garbage, chainshot_regions
+from settings import DEFAULT_STATUS_CONCURRENCY, DEFAULT_RPC_TIMEOUT, DEFAULT_BLOCK_INDEX_FILE, \
+    DEFAULT_SSH_CONCURRENCY, MONITOR_INTERVAL, BLOCK_EVENTS_BUCKET_MS, GC_GRACE_PERIOD
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -24,59 +31,175 @@ def ethermint_testing():
                                                            'local version in GOPATH (default)')
 @click.option('--name-root', default="test", help='Root of the names of amis to create')
 @click.option('--num-processes', '-n', default=None, type=click.INT,
-              help='specify >1 if you want to run instance creation in parallel using multiprocessing')
+              help='how many instance launches to run at once, all at once by default')
 @click.option('--no-ami-cache', is_flag=True, help='Force rebuilding of Ethermint AMIs')
+@click.option('--pipelined', is_flag=True, help='Prepare and start every node as soon as its instance is ready')
 @click.argument('chain-file', type=click.File('wb'))
-def create(regions, ethermint_version, name_root, num_processes, no_ami_cache, chain_file):
+def create(regions, ethermint_version, name_root, num_processes, no_ami_cache, pipelined, chain_file):
     chainmanager = Chainmanager(num_processes=num_processes)
     chain = chainmanager.create_ethermint_network(regions, ethermint_version, name_root,
-                                                  no_ami_cache=no_ami_cache)
+                                                  no_ami_cache=no_ami_cache, pipelined=pipelined)
 
-    chain_file.write(json.dumps(chain.serialize()))
+    chain_file.write(json.dumps(chain.serialize(metadata=True)))
 
     logger.info("Created a chain ".format(chain))
 
 
+@ethermint_testing.command(help="Updates the IPs, names, availability zones and launch times kept in a chain file, "
+                                "which the status commands use instead of asking AWS")
+@click.argument('chain-file', type=click.Path(exists=True, dir_okay=False))
+def refresh(chain_file):
+    with open(chain_file, 'r') as json_data:
+        chain = Chain.deserialize(json.loads(json_data.read()))
+    chain.hydrate(force=True)
+    with open(chain_file, 'w') as json_data:
+        json_data.write(json.dumps(chain.serialize(metadata=True)))
+
+    logger.info("Refreshed the chain {}".format(chain))
+
+
+@ethermint_testing.command(help="Terminates the instances of a chain and deletes its volumes, and optionally its "
+                                "security groups and key pairs, which the chainshots of the chain are thawed with")
+@click.option('--delete-groups-and-keys', is_flag=True,
+              help='Also delete the security groups and key pairs none of the chainshot files refer to')
+@click.argument('chain-file', type=click.File('rb'))
+@click.argument('chainshot-files', type=click.Path(exists=True, dir_okay=False), nargs=-1)
+def destroy(delete_groups_and_keys, chain_file, chainshot_files):
+    chain = Chain.deserialize(json.loads(chain_file.read()))
+    report = Chainmanager.destroy_ethermint_network(chain, delete_groups_and_keys, load_chainshots(chainshot_files))
+    print(json.dumps(report, indent=2))
+
+
 @ethermint_testing.command(help='Makes a snapshot of a chain')
 @click.option('--name', default="Ethermint-network-chainshot", help='The name of the chainshot')
+@click.option('--concurrency', '-c', default=DEFAULT_SSH_CONCURRENCY, type=click.INT,
+              help='how many nodes to halt/restart at once')
+@click.option('--parent', default=None, type=click.File('rb'),
+              help='the previous chainshot of the chain, to continue its lineage')
+@click.option('--rolling', is_flag=True, help='Snapshot the nodes in batches, without halting the whole network')
+@click.option('--batch-size', default=None, type=click.INT,
+              help='how many nodes a rolling chainshot takes out at once, (n - 1) / 3 by default')
 @click.argument('chain-file', type=click.File('rb'))
 @click.argument('chainshot-file', type=click.File('wb'))
-def chainshot(name, chain_file, chainshot_file):
+def chainshot(name, concurrency, parent, rolling, batch_size, chain_file, chainshot_file):
     chain = Chain.deserialize(json.loads(chain_file.read()))
-    chainshot_data = Chainshotter().chainshot(name, chain)
+    parent_data = json.loads(parent.read()) if parent else None
+    chainshotter = Chainshotter(concurrency=concurrency)
+    if rolling:
+        chainshot_data = chainshotter.rolling_chainshot(name, chain, parent=parent_data, batch_size=batch_size)
+    else:
+        chainshot_data = chainshotter.chainshot(name, chain, parent=parent_data)
 
     chainshot_file.write(json.dumps(chainshot_data))
 
     logger.info("The chainshot: {}".format(chainshot_data))
 
 
-@ethermint_testing.command(help="Unfreezes a network from a chainshot file")
-@click.argument('chainshot-file', type=click.File('rb'))
+@ethermint_testing.command(help="Unfreezes a network from a chainshot file; given many, from the newest one "
+                                "or the one covering --height")
+@click.argument('chainshot-files', type=click.Path(exists=True, dir_okay=False), nargs=-1, required=True)
 @click.argument('chain-file', type=click.File('wb'))
+@click.option('--height', default=None, type=click.INT, help='the block height to restore')
 @click.option('--num-processes', '-n', default=None, type=click.INT,
-              help='specify >1 if you want to run instance creation in parallel using multiprocessing')
-def thaw(chainshot_file, chain_file, num_processes):
-    chainshot = json.loads(chainshot_file.read())
+              help='how many instance launches to run at once, all at once by default')
+@click.option('--concurrency', '-c', default=DEFAULT_SSH_CONCURRENCY, type=click.INT,
+              help='how many nodes to start at once')
+def thaw(chainshot_files, chain_file, height, num_processes, concurrency):
+    chainshot = find_chainshot(load_chainshots(chainshot_files), height)
+    logger.info("Thawing chainshot {}".format(chainshot.get("id", chainshot["chainshot_name"])))
 
-    chain = Chainshotter(num_processes).thaw(chainshot)
+    chain = Chainshotter(num_processes, concurrency).thaw(chainshot)
 
-    chain_file.write(json.dumps(chain.serialize()))
+    chain_file.write(json.dumps(chain.serialize(metadata=True)))
 
     logger.info("Thawed a chain {}".format(chain))
 
 
+@ethermint_testing.command(help="Shows which block heights the chainshots cover")
+@click.argument('chainshot-files', type=click.Path(exists=True, dir_okay=False), nargs=-1, required=True)
+def lineage(chainshot_files):
+    print(json.dumps(coverage(load_chainshots(chainshot_files)), indent=2))
+
+
+@ethermint_testing.command(help="Deletes stale ethermint resources: detached volumes, security groups and key pairs "
+                                "of networks without instances, and snapshots of dropped chainshots")
+@click.option('--regions', '-r', default=None, type=click.STRING, multiple=True,
+              help='the regions to clean up, by default those of the chain and chainshot files')
+@click.option('--chain-file', type=click.Path(exists=True, dir_okay=False), multiple=True,
+              help='a chain file whose regions to clean up')
+@click.option('--keep', default=None, type=click.INT,
+              help='how many chainshots to keep per lineage, all by default')
+@click.option('--orphans', is_flag=True, help='Also delete chainshot snapshots none of the chainshot files refer to')
+@click.option('--grace-period', default=GC_GRACE_PERIOD, type=click.INT,
+              help='skip resources younger than this many seconds, which may belong to a network being created')
+@click.option('--dry-run', is_flag=True, help='Only show what would be deleted')
+@click.argument('chainshot-files', type=click.Path(exists=True, dir_okay=False), nargs=-1)
+def gc(regions, chain_file, keep, orphans, grace_period, dry_run, chainshot_files):
+    chainshots = load_chainshots(chainshot_files)
+    if not regions:
+        regions = chainshot_regions(chainshots)
+        for filename in chain_file:
+            with open(filename, 'r') as json_data:
+                chain = Chain.deserialize(json.loads(json_data.read()))
+            regions.update(region_instance_pair.region_name for region_instance_pair in chain.instances)
+    if not regions:
+        raise click.UsageError("No regions to clean up, give --regions or chain or chainshot files")
+
+    report = collect_garbage(sorted(regions), chainshots, keep, include_orphans=orphans, dry_run=dry_run,
+                             grace_period=grace_period)
+    print(json.dumps(report, indent=2))
+
+
 @ethermint_testing.command(help="Checks if the consensus on the chain is making progress; for more details, use status")
+@click.option('--concurrency', '-c', default=DEFAULT_STATUS_CONCURRENCY, type=click.INT,
+              help='the maximum number of nodes queried at once')
+@click.option('--timeout', default=DEFAULT_RPC_TIMEOUT, type=click.FLOAT,
+              help='how long to wait for a single node (seconds)')
 @click.argument('chain-file', type=click.File('rb'))
-def isalive(chain_file):
-    chain = Chain.deserialize(json.loads(chain_file.read()))
-    print(Chainmanager.isalive(chain))
+def isalive(chain_file, concurrency, timeout):
+    chain = Chain.deserialize(json.loads(chain_file.read())).hydrate()
+    print(Chainmanager.isalive(chain, concurrency, timeout))
 
 
 @ethermint_testing.command(help="Checks the status of all of the nodes that form the chain")
+@click.option('--concurrency', '-c', default=DEFAULT_STATUS_CONCURRENCY, type=click.INT,
+              help='the maximum number of nodes queried at once')
+@click.option('--timeout', default=DEFAULT_RPC_TIMEOUT, type=click.FLOAT,
+              help='how long to wait for a single node (seconds)')
 @click.argument('chain-file', type=click.File('rb'))
-def status(chain_file):
-    chain = Chain.deserialize(json.loads(chain_file.read()))
-    print(json.dumps(Chainmanager.get_status(chain)))
+def status(chain_file, concurrency, timeout):
+    chain = Chain.deserialize(json.loads(chain_file.read())).hydrate()
+    print(json.dumps(Chainmanager.get_status(chain, concurrency, timeout)))
+
+
+@ethermint_testing.command(help="Polls the nodes of a chain at an interval and writes their heights, lags and "
+                                "RPC latencies as CSV")
+@click.option('--interval', '-i', default=MONITOR_INTERVAL, type=click.FLOAT, help='seconds between the polls')
+@click.option('--ticks', default=None, type=click.INT, help='how many polls to make, until interrupted by default')
+@click.option('--concurrency', '-c', default=DEFAULT_STATUS_CONCURRENCY, type=click.INT,
+              help='the maximum number of nodes queried at once')
+@click.option('--timeout', default=DEFAULT_RPC_TIMEOUT, type=click.FLOAT,
+              help='how long to wait for a single node (seconds)')
+@click.argument('chain-file', type=click.File('rb'))
+@click.argument('output-file', type=click.File('wb'), default='-')
+def monitor(interval, ticks, concurrency, timeout, chain_file, output_file):
+    chain = Chain.deserialize(json.loads(chain_file.read())).hydrate()
+    ChainMonitor(chain, concurrency, timeout).run(output_file, interval, ticks)
+
+
+@ethermint_testing.command(help="Follows the NewBlock events of all of the nodes of a chain and shows histograms of "
+                                "the block propagation delays and block times")
+@click.option('--duration', '-d', default=60, type=click.FLOAT, help='how long to follow the nodes (seconds)')
+@click.option('--bucket-ms', default=BLOCK_EVENTS_BUCKET_MS, type=click.INT,
+              help='the width of the histogram buckets (milliseconds)')
+@click.option('--timeout', default=DEFAULT_RPC_TIMEOUT, type=click.FLOAT,
+              help='how long to wait for a single node (seconds)')
+@click.argument('chain-file', type=click.File('rb'))
+def blocks(duration, bucket_ms, timeout, chain_file):
+    chain = Chain.deserialize(json.loads(chain_file.read())).hydrate()
+    subscriber = NewBlockSubscriber(chain, timeout)
+    subscriber.run(duration)
+    print(json.dumps(subscriber.report(bucket_ms), indent=2))
 
 
 @ethermint_testing.command(help="get history of chain performance")
@@ -84,11 +207,19 @@ def status(chain_file):
               help='earliest block to look at')
 @click.option('--to', '-t', default=None, type=click.INT,
               help='last block to look at')
+@click.option('--block-index', default=DEFAULT_BLOCK_INDEX_FILE, type=click.Path(dir_okay=False),
+              help='the local index of already fetched blocks')
+@click.option('--no-block-index', is_flag=True, help='Fetch all blocks from the node, bypassing the block index')
 @click.argument('chain-file', type=click.File('rb'))
-def history(chain_file, fromm, to):
-    chain = Chain.deserialize(json.loads(chain_file.read()))
-    to_print = "\n".join([str(c) for c in Chainmanager.get_history(chain, fromm, to)])
-    print(to_print)
+def history(chain_file, fromm, to, block_index, no_block_index):
+    chain = Chain.deserialize(json.loads(chain_file.read())).hydrate()
+    index = None if no_block_index else BlockIndex(block_index)
+    try:
+        for entry in Chainmanager.iter_history(chain, fromm, to, block_index=index):
+            print(entry)
+    finally:
+        if index is not None:
+            index.close()
 
 
 @ethermint_testing.command(help="get history of chain performance")
@@ -100,7 +231,7 @@ def history(chain_file, fromm, to):
               help='duration of interval between delay increase steps (s)')
 @click.argument('chain-file', type=click.File('rb'))
 def network_fault(chain_file, num_steps, delay_step, interval):
-    chain = Chain.deserialize(json.loads(chain_file.read()))
+    chain = Chain.deserialize(json.loads(chain_file.read())).hydrate()
 
     result = Chainmanager.get_network_fault(chain, num_steps, delay_step, interval)
 
@@ -0,0 +1,152 @@
+import itertools
+import json
+import logging
+import threading
+import time
+
+import dateutil.parser
+import websocket
+
+from settings import DEFAULT_RPC_TIMEOUT, BLOCK_EVENTS_BUCKET_MS
+from tendermint_app_interface import TendermintAppInterface
+
+logger = logging.getLogger(__name__)
+
+
+def _find_header(data):
+    """
+    The block header in a NewBlock event; its nesting differs between tendermint versions
+    :return: the header dict, or None if there is none
+    """
+    if isinstance(data, dict):
+        if "header" in data and "height" in data["header"]:
+            return data["header"]
+        values = data.values()
+    elif isinstance(data, list):
+        values = data
+    else:
+        return None
+    for value in values:
+        header = _find_header(value)
+        if header is not None:
+            return header
+    return None
+
+
+def histogram(values, bucket):
+    """
+    :param values: numbers
+    :param bucket: the width of the buckets
+    :return: a sorted list of [bucket lower bound, count]
+    """
+    counts = {}
+    for value in values:
+        lower = int(value // bucket * bucket)
+        counts[lower] = counts.get(lower, 0) + 1
+    return [[bound, counts[bound]] for bound in sorted(counts)]
+
+
+class NewBlockSubscriber:
+    """
+    Subscribes to the NewBlock events of all of the nodes of a chain at once, over tendermint's websocket,
+    and records when every block arrives at every node
+    The arrival times give block propagation delays and block times without polling the nodes
+    NOTE: the arrival times are taken on this machine, so they include the latency from each node to here
+    """
+    request_ids = itertools.count()
+
+    def __init__(self, chain, timeout=DEFAULT_RPC_TIMEOUT):
+        """
+        :param chain: Chain object; it's hydrated beforehand, so that subscribing doesn't call AWS
+        :param timeout: how long to wait for a node to accept the connection (seconds)
+        """
+        self.chain = chain
+        self.timeout = timeout
+        self.arrivals = {}  # height -> {instance id: arrival time (seconds since the epoch)}
+        self.block_times = {}  # height -> the block's time, from its header
+        self.errors = {}  # instance id -> why the node couldn't be followed
+        self._lock = threading.Lock()
+
+    def _record(self, instance_id, header, arrival):
+        height = header["height"]
+        with self._lock:
+            self.arrivals.setdefault(height, {}).setdefault(instance_id, arrival)
+            if height not in self.block_times:
+                self.block_times[height] = dateutil.parser.parse(header["time"])
+
+    def _listen(self, region_instance_pair, stop):
+        """
+        Follows the NewBlock events of a node until stop is set
+        """
+        url = TendermintAppInterface.websocket(region_instance_pair.public_ip_address)
+        try:
+            connection = websocket.create_connection(url, timeout=self.timeout)
+        except (websocket.WebSocketException, IOError) as e:
+            logger.warning("Unable to subscribe to instance {}: {}".format(region_instance_pair.id, e))
+            self.errors[region_instance_pair.id] = str(e)
+            return
+
+        try:
+            connection.send(json.dumps({"jsonrpc": "2.0", "method": "subscribe", "params": ["NewBlock"],
+                                        "id": next(NewBlockSubscriber.request_ids)}))
+            while not stop.is_set():
+                try:
+                    message = connection.recv()
+                except websocket.WebSocketTimeoutException:
+                    continue
+                arrival = time.time()
+                header = _find_header(json.loads(message).get("result"))
+                if header is not None:
+                    self._record(region_instance_pair.id, header, arrival)
+        except (websocket.WebSocketException, IOError, ValueError) as e:
+            logger.warning("Lost the subscription to instance {}: {}".format(region_instance_pair.id, e))
+            self.errors[region_instance_pair.id] = str(e)
+        finally:
+            connection.close()
+
+    def run(self, duration):
+        """
+        Follows all of the nodes, each in its own thread, for duration seconds
+        :return: -
+        """
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._listen, args=(region_instance_pair, stop))
+                   for region_instance_pair in self.chain.instances]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            stop.wait(duration)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def propagation_delays(self):
+        """
+        How long after the first node every node got each block
+        :return: a dictionary instance id -> list of delays (milliseconds), one per block the node got
+        """
+        delays = dict((region_instance_pair.id, []) for region_instance_pair in self.chain.instances)
+        for height in sorted(self.arrivals):
+            first = min(self.arrivals[height].values())
+            for instance_id, arrival in self.arrivals[height].items():
+                delays[instance_id].append((arrival - first) * 1000)
+        return delays
+
+    def report(self, bucket_ms=BLOCK_EVENTS_BUCKET_MS):
+        """
+        Histograms of the propagation delays per node and of the block times
+        :param bucket_ms: the width of the histograms' buckets (milliseconds)
+        :return: a dictionary
+        """
+        heights = sorted(self.block_times)
+        block_times = [(self.block_times[high] - self.block_times[low]).total_seconds() * 1000
+                       for low, high in zip(heights, heights[1:]) if high == low + 1]
+        return {
+            "blocks": len(heights),
+            "nodes": dict((instance_id, {"blocks": len(delays), "delays_ms": histogram(delays, bucket_ms)})
+                          for instance_id, delays in self.propagation_delays().items()),
+            "block_times_ms": histogram(block_times, bucket_ms),
+            "errors": self.errors,
+        }
@@ -0,0 +1,80 @@
+import logging
+import os
+import sqlite3
+
+from tendermint_app_interface import TendermintBlock
+
+logger = logging.getLogger(__name__)
+
+
+class BlockIndex:
+    """
+    On-disk index of block metadata, keyed by chain and height
+    Blocks are immutable, so a block fetched once from a node never has to be fetched again
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS blocks ("
+                                    "chain TEXT NOT NULL, height INTEGER NOT NULL, hash TEXT, time TEXT, "
+                                    "PRIMARY KEY (chain, height))")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_blocks(self, chain_key, blocks):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO blocks (chain, height, hash, time) VALUES (?, ?, ?, ?)",
+                                        [(chain_key, block.height, block.hash, str(block.time)) for block in blocks])
+
+    def index_blocks(self, chain_key, blocks, chunk_size=1000):
+        """
+        Passes the blocks through, adding them to the index in chunks on the way
+        """
+        chunk = []
+        try:
+            for block in blocks:
+                chunk.append(block)
+                if len(chunk) >= chunk_size:
+                    self.add_blocks(chain_key, chunk)
+                    chunk = []
+                yield block
+        finally:
+            self.add_blocks(chain_key, chunk)
+
+    def iter_range(self, chain_key, fromm, to):
+        """
+        Generates the indexed blocks from fromm to to (inclusive), lowest first
+        """
+        cursor = self.connection.execute("SELECT hash, height, time FROM blocks "
+                                         "WHERE chain = ? AND height BETWEEN ? AND ? ORDER BY height",
+                                         (chain_key, fromm, to))
+        for block_hash, height, time in cursor:
+            yield TendermintBlock({"header": {"app_hash": block_hash, "height": height, "time": time}})
+
+    def missing_ranges(self, chain_key, fromm, to):
+        """
+        :return: a list of (fromm, to) tuples (inclusive) of heights which are not in the index
+        """
+        cursor = self.connection.execute("SELECT height FROM blocks "
+                                         "WHERE chain = ? AND height BETWEEN ? AND ? ORDER BY height",
+                                         (chain_key, fromm, to))
+        missing = []
+        expected = fromm
+        for (height,) in cursor:
+            if height > expected:
+                missing.append((expected, height - 1))
+            expected = height + 1
+        if expected <= to:
+            missing.append((expected, to))
+        return missing
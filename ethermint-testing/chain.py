@@ -1,52 +1,196 @@
+import threading
+import time
+
 import boto3
+import dateutil.parser
 
+from settings import INSTANCE_DESCRIPTION_TTL
 from tendermint_app_interface import TendermintAppInterface, EthermintInterface
-from utils import get_region_name
+from utils import get_region_name, thread_map
+
+_ec2_resources = {}
+_ec2_resources_lock = threading.Lock()
+
+
+def get_ec2(region_name):
+    """
+    The EC2 resource of a region, shared by all of the RegionInstancePairs of the region
+    """
+    with _ec2_resources_lock:
+        if region_name not in _ec2_resources:
+            _ec2_resources[region_name] = boto3.session.Session().resource('ec2', region_name=region_name)
+        return _ec2_resources[region_name]
 
 
-class RegionInstancePair:
+def _described(key):
+    """
+    A property borrowed from the cached description of the instance, like the boto3 Instance one
+    """
+    def get(self):
+        if self._offline and key not in self._description:
+            # the chain file only carries some of the description
+            self.refresh()
+        return self.description.get(key)
+    return property(get)
+
+
+class RegionInstancePair(object):
     """
     Region and ec2-resource bound instance. Picklable, workable as a boto3 Instance instance
 
     Main reason for this class is being picklable, which in turn is needed by our current parallel processing
+    The description of the instance is cached, so reading its properties doesn't call AWS every time;
+    use describe_all to describe the instances of a chain in one call per region
+    Offline descriptions, read from a chain file, don't expire; they are only described again on refresh
     """
+    __slots__ = ("region_name", "id", "_description", "_described_at", "_offline")
+
+    # seconds after which the cached description is refreshed on access, None to keep it until refresh
+    ttl = INSTANCE_DESCRIPTION_TTL
 
-    def __init__(self, region_name, instance_id):
+    key_name = _described("KeyName")
+    public_ip_address = _described("PublicIpAddress")
+    block_device_mappings = _described("BlockDeviceMappings")
+    image_id = _described("ImageId")
+    security_groups = _described("SecurityGroups")
+    tags = _described("Tags")
+    placement = _described("Placement")
+    launch_time = _described("LaunchTime")
+
+    def __init__(self, region_name, instance_id, description=None, offline=False):
+        """
+        :param description: optional DescribeInstances data of the instance, to start the cache with
+        :param offline: the description is a partial one from a chain file, see metadata
+        """
         self.region_name = region_name
         self.id = instance_id
+        self._description = None
+        self._described_at = None
+        self._offline = False
+        if description is not None:
+            self._cache(description, offline)
 
-        # borrow the properties from the boto3 Instance defined by region/id
-        # set new properties on RegionInstancePair class by copying properties from self.instance
-        for prop in ['key_name', 'public_ip_address', 'block_device_mappings', 'image_id', 'security_groups',
-                     'tags', 'volumes', 'placement']:
-            iife = lambda iife_prop: lambda innerself: getattr(innerself.instance, iife_prop)
-            setattr(self.__class__, prop, property(iife(prop)))
+    def __getstate__(self):
+        return dict((slot, getattr(self, slot)) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
 
     @staticmethod
     def from_boto(instance):
-        return RegionInstancePair(get_region_name(instance.placement["AvailabilityZone"]), instance.id)
+        return RegionInstancePair(get_region_name(instance.placement["AvailabilityZone"]), instance.id,
+                                  description=instance.meta.data)
+
+    @staticmethod
+    def from_metadata(region_name, metadata):
+        """
+        Creates an instance with an offline description from the metadata of a chain file
+        :param metadata: a dictionary, as returned by metadata
+        """
+        tags = [{"Key": "Name", "Value": metadata["name"]}] if metadata.get("name") else []
+        launch_time = metadata.get("launch_time")
+        return RegionInstancePair(region_name, metadata["id"], description={
+            "InstanceId": metadata["id"],
+            "KeyName": metadata.get("key_name"),
+            "PublicIpAddress": metadata.get("public_ip_address"),
+            "Tags": tags,
+            "Placement": {"AvailabilityZone": metadata.get("availability_zone")},
+            "LaunchTime": dateutil.parser.parse(launch_time) if launch_time else None,
+        }, offline=True)
+
+    def metadata(self):
+        """
+        The metadata of the instance kept in chain files, so that nodes can be reached without asking AWS
+        :return: a dictionary
+        """
+        launch_time = self.launch_time
+        return {
+            "public_ip_address": self.public_ip_address,
+            "name": next((tag["Value"] for tag in self.tags or [] if tag["Key"] == "Name"), None),
+            "availability_zone": self.placement["AvailabilityZone"],
+            "launch_time": launch_time.isoformat() if launch_time else None,
+        }
+
+    def _cache(self, description, offline=False):
+        self._description = description
+        self._described_at = time.time()
+        self._offline = offline
+
+    @property
+    def is_stale(self):
+        if self._description is None:
+            return True
+        return not self._offline and self.ttl is not None and time.time() - self._described_at > self.ttl
+
+    @property
+    def description(self):
+        """
+        The DescribeInstances data of the instance, described again if missing or older than ttl
+        """
+        if self.is_stale:
+            self.refresh()
+        return self._description
+
+    def refresh(self):
+        RegionInstancePair.describe_all([self], force=True)
+
+    @staticmethod
+    def describe_all(region_instance_pairs, force=False):
+        """
+        Describes many instances with a single DescribeInstances call per region and caches the descriptions;
+        the regions are described concurrently
+        :param region_instance_pairs: RegionInstancePairs
+        :param force: describe all of them, not only those whose description is missing or stale
+        :return: -
+        """
+        pairs_by_region = {}
+        for region_instance_pair in region_instance_pairs:
+            if force or region_instance_pair.is_stale:
+                pairs_by_region.setdefault(region_instance_pair.region_name, []).append(region_instance_pair)
+
+        def describe(region_pairs):
+            # the clients of the shared resources are thread-safe
+            region_name, pairs = region_pairs
+            reservations = get_ec2(region_name).meta.client.describe_instances(
+                InstanceIds=sorted(set(pair.id for pair in pairs)))["Reservations"]
+            return dict((instance["InstanceId"], instance)
+                        for reservation in reservations for instance in reservation["Instances"])
+
+        items = pairs_by_region.items()
+        for (_, pairs), descriptions in zip(items, thread_map(describe, items)):
+            for pair in pairs:
+                pair._cache(descriptions[pair.id])
 
     @property
     def instance(self):
         """
         use instance.instance to instantiate the instance instance for instance id
+        its attributes are those of the cached description, until it's loaded (not for offline descriptions)
         :return:
         """
-        return self.ec2.Instance(self.id)
+        instance = self.ec2.Instance(self.id)
+        if not self._offline:
+            instance.meta.data = self.description
+        return instance
 
     @property
     def ec2(self):
-        return boto3.resource('ec2', region_name=self.region_name)
+        return get_ec2(self.region_name)
+
+    @property
+    def volumes(self):
+        return self.instance.volumes
 
     @property
     def instance_name(self):
         name = None
-        for tag in self.instance.tags:
+        for tag in self.tags or []:
             if tag["Key"] == "Name":
                 name = tag["Value"]
                 break
         if not name:
-            name = "Node_" + self.instance.id
+            name = "Node_" + self.id
         return name
 
 
@@ -63,9 +207,21 @@ class Chain:
             result += "{}:{}\n".format(instance.region_name, instance.id)
         return result
 
-    def serialize(self):
+    def hydrate(self, force=False):
+        """
+        Describes all of the instances of the chain up front, with one DescribeInstances call per region and
+        the regions concurrently, so that reading their IPs, key names, tags etc. doesn't call AWS anymore
+        :param force: describe all of the instances again, not only those not described yet or described too long ago
+        :return: the chain itself
+        """
+        RegionInstancePair.describe_all(self.instances, force)
+        return self
+
+    def serialize(self, metadata=False):
         """
         Chain serialization to JSON
+        :param metadata: also keep the IPs, names, availability zones and launch times of the instances,
+        so that the deserialized chain can be checked without asking AWS
         :return: a dictionary
         """
         result = {
@@ -74,22 +230,30 @@ class Chain:
             "type": self.chain_type
         }
         for region_instance_pair in self.instances:
-            result["instances"].append(dict(instance={
+            instance_data = {
                 "id": region_instance_pair.id,
                 "region": region_instance_pair.region_name,
                 "key_name": region_instance_pair.key_name,
-            }))
+            }
+            if metadata:
+                instance_data.update(region_instance_pair.metadata())
+            result["instances"].append(dict(instance=instance_data))
         return result
 
     @staticmethod
     def deserialize(data):
         """
         Create a new chain instance from dict serialization
+        Instances serialized with their metadata get offline descriptions, see RegionInstancePair.from_metadata
         :param data:
         :return: chain object
         """
         instances = []
         for instance_data in data["instances"]:
+            if "public_ip_address" in instance_data["instance"]:
+                instances.append(RegionInstancePair.from_metadata(instance_data["instance"]["region"],
+                                                                  instance_data["instance"]))
+                continue
             instances.append(RegionInstancePair(instance_data["instance"]["region"],
                                                 instance_data["instance"]["id"]))
         return Chain(instances, name=data.get("name", ""), chain_type=data.get("chain_type", "ethermint"))
@@ -1,6 +1,7 @@
 import logging
 import os
 import subprocess
+import threading
 import time
 from datetime import datetime, timedelta
 from uuid import uuid4
@@ -8,16 +9,22 @@ from uuid import uuid4
 import boto3
 import dateutil
 import pytz
-from pathos.multiprocessing import ProcessingPool
+import requests
 
+from ami_registry import AMIRegistry
 from amibuilder import AMIBuilder
 from chain import RegionInstancePair, Chain
 from fill_validators import fill_validators, prepare_validators
 from instance_creator import InstanceCreator
+from resource_gc import chainshot_resources, delete_resources, resources_in_use
 from settings import DEFAULT_INSTANCE_NAME, \
     DEFAULT_SECURITY_GROUP_DESCRIPTION, DEFAULT_PORTS, \
-    DEFAULT_FILES_LOCATION, DEFAULT_LIVENESS_THRESHOLD
-from utils import create_keyfile, run_sh_script, get_shh_key_file, run_ethermint
+    DEFAULT_FILES_LOCATION, DEFAULT_LIVENESS_THRESHOLD, DEFAULT_STATUS_CONCURRENCY, DEFAULT_RPC_TIMEOUT, \
+    DEFAULT_SSH_CONCURRENCY, DEFAULT_DEVICE, NODE_PREPARATION_TRIES, AMI_REGISTRY_FILE_NAME, \
+    SECURITY_GROUP_NAME_PREFIX, KEY_NAME_PREFIX, SEED_START_TIMEOUT
+from utils import create_keyfile, run_sh_script, get_shh_key_file, run_ethermint, thread_map, SSH_OPTIONS, \
+    run_on_chain, raise_for_failures
+from waiting_for_ec2 import iter_terminated_instances, iter_available_volumes
 
 NETWORK_FAULT_PREPARATION_TIME_PER_INSTANCE = 10
 
@@ -59,6 +66,7 @@ class Chainmanager:
         :param chains: a list of Chain objects
         :return: a dictionary
         """
+        RegionInstancePair.describe_all(region_pair for chain in chains for region_pair in chain.instances)
         master_roster = {}
         for chain_idx, chain in enumerate(chains):
             for region_pair in chain.instances:
@@ -71,30 +79,172 @@ class Chainmanager:
         return master_roster
 
     @staticmethod
-    def _prepare_ethermint(chain):
+    def _prepare_node(node, ethermint_files_location):
+        """
+        Prepares the ethermint environment on a single node and uploads the chain data and its validator file
+        :param node: a tuple (validator number, instance id, key name, public IP)
+        """
+        validator_number, instance_id, key_name, ip = node
+        logger.info("Preparing ethermint on instance ID: {}".format(instance_id))
+        run_sh_script("shell_scripts/prepare_ethermint_env.sh", key_name, ip)
+
+        # copy the pre-inited chain data
+        # FIXME: better to init on the remote host using remote ethermint?
+        # this could only upload the genesis.json
+        data_path = os.path.join(ethermint_files_location, "data")
+        if os.system("scp {} -C -i {} -r {} ubuntu@{}:/ethermint".format(
+                SSH_OPTIONS, get_shh_key_file(key_name), data_path, ip)) != 0:
+            raise IOError("Unable to copy {} to instance {}".format(data_path, instance_id))
+
+        # copy the validator file
+        validator_filename = "priv_validator.json.{}".format(validator_number)
+        src_validator_path = os.path.join(ethermint_files_location, validator_filename)
+        if os.system("scp {} -C -i {} {} ubuntu@{}:/ethermint/data/priv_validator.json".format(
+                SSH_OPTIONS, get_shh_key_file(key_name), src_validator_path, ip)) != 0:
+            raise IOError("Unable to copy {} to instance {}".format(src_validator_path, instance_id))
+
+    @staticmethod
+    def _prepare_genesis(num_validators):
+        """
+        Generates the validator files and the genesis with all of the validators; doesn't depend on the instances
+        :return: the location of the ethermint files
+        """
         ethermint_files_location = os.path.join(DEFAULT_FILES_LOCATION, "ethermint")
         ethermint_genesis = os.path.join(ethermint_files_location, "data", "genesis.json")
-        prepare_validators(len(chain.instances), ethermint_files_location)
-        fill_validators(len(chain.instances), ethermint_genesis, ethermint_genesis, ethermint_files_location)
-
-        for i, instance in enumerate(chain.instances):
-            logger.info("Preparing ethermint on instance ID: {}".format(instance.id))
-            run_sh_script("shell_scripts/prepare_ethermint_env.sh", instance.key_name, instance.public_ip_address)
-
-            # copy the pre-inited chain data
-            # FIXME: better to init on the remote host using remote ethermint?
-            # this could only upload the genesis.json
-            os.system(
-                "scp -o StrictHostKeyChecking=no -C -i {} -r {} ubuntu@{}:/ethermint".format(
-                    get_shh_key_file(instance.key_name), os.path.join(ethermint_files_location, "data"),
-                    instance.public_ip_address))
-
-            # copy the validator file
-            validator_filename = "priv_validator.json.{}".format(i + 1)
-            src_validator_path = os.path.join(ethermint_files_location, validator_filename)
-            os.system(
-                "scp -o StrictHostKeyChecking=no -C -i {} {} ubuntu@{}:/ethermint/data/priv_validator.json".format(
-                    get_shh_key_file(instance.key_name), src_validator_path, instance.public_ip_address))
+        prepare_validators(num_validators, ethermint_files_location)
+        fill_validators(num_validators, ethermint_genesis, ethermint_genesis, ethermint_files_location)
+        return ethermint_files_location
+
+    @staticmethod
+    def _prepare_ethermint(chain, concurrency=DEFAULT_SSH_CONCURRENCY, tries=NODE_PREPARATION_TRIES):
+        """
+        Prepares all of the nodes for running ethermint, in a pool of at most concurrency workers;
+        nodes that failed are retried, up to tries times
+        :return: a dictionary instance id -> {"prepared": bool, "tries": int, "error": str or None}
+        """
+        ethermint_files_location = Chainmanager._prepare_genesis(len(chain.instances))
+
+        def try_prepare(node):
+            try:
+                Chainmanager._prepare_node(node, ethermint_files_location)
+            except IOError as e:
+                logger.warning("Preparing ethermint on instance ID: {} failed: {}".format(node[1], e))
+                return str(e)
+
+        # AWS lookups are done up front, so that the worker threads only talk to the nodes
+        pending = [(i + 1, instance.id, instance.key_name, instance.public_ip_address)
+                   for i, instance in enumerate(chain.instances)]
+        report = {}
+        for attempt in xrange(1, tries + 1):
+            errors = thread_map(try_prepare, pending, concurrency)
+            for node, error in zip(pending, errors):
+                report[node[1]] = {"prepared": error is None, "tries": attempt, "error": error}
+            pending = [node for node, error in zip(pending, errors) if error is not None]
+            if not pending:
+                break
+
+        if pending:
+            raise RuntimeError("Unable to prepare ethermint on instances {}".format(
+                ", ".join(node[1] for node in pending)))
+        return report
+
+    def _create_pipelined(self, instances_config, concurrency=DEFAULT_SSH_CONCURRENCY,
+                          tries=NODE_PREPARATION_TRIES):
+        """
+        Launches the instances and brings every node up (prepare, start ethermint) as soon as its instance is ready,
+        instead of waiting for all of the instances at every stage.
+        The first node is the seed: the others are prepared independently, but only started once the seed is started
+        :param concurrency: how many nodes to run SSH/SCP commands on at once
+        :param tries: how many times to try preparing a node
+        :return: a tuple (list of instance objects, dictionary instance id -> seconds from the start of the launch
+        until the node was ready, prepared and started)
+        """
+        ethermint_files_location = self._prepare_genesis(len(instances_config))
+
+        ssh_slots = threading.Semaphore(concurrency)
+        seed_started = threading.Event()
+        seed = {}
+        timings = {}
+        threads = []
+        start = time.time()
+
+        def bring_up(node):
+            validator_number, instance_id, key_name, ip = node
+            timings[instance_id] = {"ready": time.time() - start}
+            try:
+                for attempt in xrange(1, tries + 1):
+                    try:
+                        with ssh_slots:
+                            self._prepare_node(node, ethermint_files_location)
+                        break
+                    except IOError as e:
+                        logger.warning("Preparing ethermint on instance ID: {} failed: {}".format(instance_id, e))
+                        if attempt == tries:
+                            raise
+                timings[instance_id]["prepared"] = time.time() - start
+
+                if validator_number == 1:
+                    logger.info("Running ethermint on seed instance ID: {}".format(instance_id))
+                    script = "shell_scripts/run_ethermint.sh"
+                else:
+                    if not seed_started.wait(SEED_START_TIMEOUT):
+                        raise RuntimeError("the seed node didn't start in {}s".format(SEED_START_TIMEOUT))
+                    if "address" not in seed:
+                        raise RuntimeError("the seed node didn't start: {}".format(seed.get("error")))
+                    script = "shell_scripts/run_ethermint.sh {}".format(seed["address"])
+                with ssh_slots:
+                    run_sh_script(script, key_name, ip)
+                timings[instance_id]["started"] = time.time() - start
+                if validator_number == 1:
+                    seed["address"] = str(ip) + ":46656"
+            except (IOError, RuntimeError) as e:
+                logger.error("Bringing up ethermint on instance ID: {} failed: {}".format(instance_id, e))
+                if validator_number == 1:
+                    seed["error"] = str(e)
+            finally:
+                if validator_number == 1:
+                    seed_started.set()
+
+        def on_ready(index, instance):
+            node = (index + 1, instance.id, instance.key_name, instance.public_ip_address)
+            thread = threading.Thread(target=bring_up, args=(node,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            nodes = self.instance_creator.create_ec2s_from_json(instances_config, on_ready=on_ready)
+        except Exception as e:
+            # the seed may never be handed over, so the nodes waiting for it are let go
+            seed.setdefault("error", "launching the instances failed: {}".format(e))
+            seed_started.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+
+        failed = [node.id for node in nodes if "started" not in timings.get(node.id, {})]
+        if failed:
+            raise RuntimeError("Unable to bring up ethermint on instances {}".format(", ".join(failed)))
+        return nodes, timings
+
+    def _bring_up(self, instances_config, pipelined=False):
+        """
+        Launches the instances and starts ethermint on them, either stage by stage or pipelined
+        :return: a list of instance objects
+        """
+        if pipelined:
+            nodes, timings = self._create_pipelined(instances_config)
+            logger.info("All {} nodes started, the last one {:.1f}s after launching".format(
+                len(nodes), max(timing["started"] for timing in timings.values())))
+            return nodes
+
+        nodes = self.instance_creator.create_ec2s_from_json(instances_config)
+        logger.info("All minion {} instances running".format(len(nodes)))
+        chain = Chain(map(RegionInstancePair.from_boto, nodes))
+        self._prepare_ethermint(chain)
+        run_ethermint(chain, DEFAULT_SSH_CONCURRENCY)
+        return nodes
 
     @staticmethod
     def _fix_ethermint_version(ethermint_version):
@@ -109,14 +259,54 @@ class Chainmanager:
         else:
             return ethermint_version
 
+    @staticmethod
+    def _resolve_amis(regions, ethermint_version, name_root, no_ami_cache=False):
+        """
+        Finds the AMI ID for each region, in the local registry first and in AWS only if needed;
+        the missing AMIs are built once and copied to all the other regions, instead of a build per region
+        :param regions: a set of regions
+        :return: a dictionary region -> AMI ID
+        """
+        registry = AMIRegistry(os.path.join(DEFAULT_FILES_LOCATION, AMI_REGISTRY_FILE_NAME))
+        if no_ami_cache:
+            for region, image_ids in registry.refresh(ethermint_version, regions).items():
+                ec2 = boto3.resource('ec2', region_name=region)
+                for image_id in image_ids:
+                    logger.info("Deregistering AMI for {} in region {}".format(ethermint_version, region))
+                    ec2.Image(image_id).deregister()
+            registry.forget(ethermint_version)
+            amis = {}
+        else:
+            amis = registry.lookup(ethermint_version, regions)
+            for region in amis:
+                logger.info("AMI for {} in region {} already exists".format(ethermint_version, region))
+
+        missing_regions = sorted(regions - set(amis.keys()))
+        if missing_regions:
+            logger.info("Creating AMI for {} in regions {}".format(ethermint_version, ", ".join(missing_regions)))
+            ami_builder = AMIBuilder(packer_file_name="packer-file-ethermint-salt-ssh")
+            full_name = "{}_ethermint{}_ami-ssh".format(name_root, ethermint_version[:8])
+            built = ami_builder.create_amis(ethermint_version, full_name, regions=missing_regions)
+            for region, ami in built.items():
+                registry.add(ethermint_version, region, ami)
+            amis.update(built)
+        registry.save()
+
+        not_built = [region for region in missing_regions if region not in amis]
+        if not_built:
+            raise RuntimeError("Failed to create AMI for {} in regions {}".format(
+                ethermint_version, ", ".join(not_built)))
+        return amis
+
     def create_ethermint_network(self, regions, ethermint_version,
-                                 name_root="test", no_ami_cache=False):
+                                 name_root="test", no_ami_cache=False, pipelined=False):
         """
         Creates an ethermint network in aws regions
         :param regions: A list of regions; one instance is created per region
         :param ethermint_version: hash (as str) or "local"
         :param name_root: Root of the names of amis to create
         :param no_ami_cache: Force rebuilding of Ethermint AMIs
+        :param pipelined: Bring every node up as soon as its instance is ready, instead of stage by stage
         :return: a Chain object
         """
         for check in ["tendermint version", "ethermint -h", "packer version"]:
@@ -127,32 +317,11 @@ class Chainmanager:
 
         distinct_regions = set(regions)
 
-        # Find AMI ID for each region and create AMIs if missing
-        amis = {}
-        ami_builder = AMIBuilder(packer_file_name="packer-file-ethermint-salt-ssh")
-        for region in distinct_regions:
-            ec2 = boto3.resource('ec2', region_name=region)
-            images = list(ec2.images.filter(Owners=['self'], Filters=[{'Name': 'tag:Ethermint',
-                                                                       'Values': [ethermint_version]}]))
-            if len(images) > 0 and no_ami_cache:
-                for image in images:
-                    logger.info("Deregistering AMI for {} in region {}".format(ethermint_version, region))
-                    image.deregister()
-                images = []
-
-            if len(images) > 0:
-                logger.info("AMI for {} in region {} already exists".format(ethermint_version, region))
-                amis[region] = images[0].id
-            else:
-                logger.info("Creating AMI for {} in region {}".format(ethermint_version, region))
-                full_name = "{}_ethermint{}_ami-ssh".format(name_root, ethermint_version[:8])
-                ami_id = ami_builder.create_ami(ethermint_version, full_name,
-                                                regions=[region])
-                amis[region] = ami_id
+        amis = self._resolve_amis(distinct_regions, ethermint_version, name_root, no_ami_cache)
 
         # Create security groups in all regions
         security_groups = {}
-        security_group_name = "ethermint-security_group-salt-ssh-" + str(datetime.now())
+        security_group_name = SECURITY_GROUP_NAME_PREFIX + str(datetime.now())
         for region in distinct_regions:
             group = self._create_security_group(security_group_name, DEFAULT_PORTS, region)
             security_groups[region] = group.id
@@ -160,7 +329,7 @@ class Chainmanager:
         instances_config = []
 
         # Create a common key in all regions
-        ethermint_network_keyfile = "salt-instance-" + str(int(time.time())) + "_" + uuid4().hex
+        ethermint_network_keyfile = KEY_NAME_PREFIX + str(int(time.time())) + "_" + uuid4().hex
         create_keyfile(ethermint_network_keyfile, distinct_regions)
 
         logger.info("Nodes SSH key in {}".format(ethermint_network_keyfile))
@@ -180,24 +349,17 @@ class Chainmanager:
                 "add_volume": True
             })
 
-        nodes = self.instance_creator.create_ec2s_from_json(instances_config)
+        nodes = self._bring_up(instances_config, pipelined)
         chain = Chain(map(RegionInstancePair.from_boto, nodes))
 
-        logger.info("All minion {} instances running".format(len(regions)))
-
-        self._prepare_ethermint(chain)
-        run_ethermint(chain)
-
-        for node in nodes:
-            logger.info("Checking ethermint version {} on {}".format(ethermint_version,
-                                                                     node.id))
-            real_version = run_sh_script("shell_scripts/get_ethermint_version.sh",
-                                         node.key_name,
-                                         node.public_ip_address)
-            real_version = real_version.strip()
+        logger.info("Checking ethermint version {} on all instances".format(ethermint_version))
+        results = run_on_chain(chain, "shell_scripts/get_ethermint_version.sh", fail_fast=True)
+        raise_for_failures(results, "shell_scripts/get_ethermint_version.sh")
+        for result in results:
+            real_version = result.output.strip()
             if real_version != ethermint_version:
                 raise RuntimeError("Instance {} appears to be running ethermint {} instead of {}".format(
-                    node.id, real_version, ethermint_version
+                    result.instance_id, real_version, ethermint_version
                 ))
 
         for node in nodes:
@@ -206,13 +368,99 @@ class Chainmanager:
         return chain
 
     @staticmethod
-    def isalive(chain):
+    def destroy_ethermint_network(chain, delete_groups_and_keys=False, chainshots=()):
+        """
+        Terminates all of the instances of the chain, with one call per region, and then deletes the network's
+        ethermint volumes, and optionally its security groups and key pairs, except those other instances still use;
+        all of the regions are handled concurrently
+        :param chain: Chain object
+        :param delete_groups_and_keys: also delete the security groups and key pairs; chainshots of the chain are
+        thawed with them, so by default they're kept, for the garbage collection, which knows of the chainshots
+        :param chainshots: chainshot dictionaries, whose security groups and key pairs are kept
+        :return: a dictionary {"terminated": {region: instance ids}, "deleted": report of delete_resources}
+        """
+        instance_ids = {}
+        for region_instance_pair in chain.instances:
+            instance_ids.setdefault(region_instance_pair.region_name, []).append(region_instance_pair.id)
+        # clients are thread-safe, unlike resources
+        clients = dict((region, boto3.client('ec2', region_name=region)) for region in instance_ids)
+
+        def describe(region):
+            """
+            :return: a tuple (the resources of the instances which don't go away with them,
+            dictionary security group id -> name)
+            """
+            reservations = clients[region].describe_instances(InstanceIds=instance_ids[region])["Reservations"]
+            instances = [instance for reservation in reservations for instance in reservation["Instances"]]
+            groups = dict((group["GroupId"], group["GroupName"]) for instance in instances
+                          for group in instance.get("SecurityGroups", []))
+            return {
+                "volumes": sorted(set(mapping["Ebs"]["VolumeId"] for instance in instances
+                                      for mapping in instance.get("BlockDeviceMappings", [])
+                                      if mapping["DeviceName"] == DEFAULT_DEVICE
+                                      and not mapping["Ebs"].get("DeleteOnTermination"))),
+                "security_groups": sorted(groups.keys()),
+                "key_pairs": sorted(set(instance["KeyName"] for instance in instances if instance.get("KeyName"))),
+            }, groups
+
+        regions = instance_ids.keys()
+        described = dict(zip(regions, thread_map(describe, regions)))
+        resources = dict((region, region_resources) for region, (region_resources, _) in described.items())
+
+        logger.info("Terminating instances {}".format(instance_ids))
+        thread_map(lambda region: clients[region].terminate_instances(InstanceIds=instance_ids[region]), regions)
+        for region, instance_id in iter_terminated_instances(instance_ids, clients):
+            logger.info("Instance {} in {} terminated".format(instance_id, region))
+
+        # the volumes detach once their instances are terminated
+        volume_ids = dict((region, resources[region]["volumes"]) for region in regions)
+        for region, volume_id in iter_available_volumes(volume_ids, clients):
+            logger.info("Volume {} in {} detached".format(volume_id, region))
+
+        if delete_groups_and_keys:
+            group_names = dict((region, groups) for region, (_, groups) in described.items())
+            Chainmanager._keep_shared_resources(resources, group_names, clients, chainshots)
+        else:
+            for region in regions:
+                resources[region] = {"volumes": resources[region]["volumes"]}
+
+        return {"terminated": instance_ids, "deleted": delete_resources(resources)}
+
+    @staticmethod
+    def _keep_shared_resources(resources, group_names, clients, chainshots):
+        """
+        Leaves the security groups and key pairs which are still needed out of resources: other chains, e.g. thawed
+        from a chainshot of this one, may share them, and the chainshots are thawed with them
+        :param resources: a dictionary region -> {resource kind -> list of ids}, which is updated
+        :param group_names: a dictionary region -> {security group id: name}
+        :param chainshots: chainshot dictionaries
+        :return: -
+        """
+        referenced = chainshot_resources(chainshots)
+        regions = resources.keys()
+        in_use = thread_map(lambda region: resources_in_use(clients[region]), regions)
+        for region, (in_use_groups, in_use_keys) in zip(regions, in_use):
+            referenced_groups, referenced_keys = referenced.get(region, (set(), set()))
+            shared = {
+                "security_groups": in_use_groups | set(group_id for group_id, name in group_names[region].items()
+                                                       if name in referenced_groups),
+                "key_pairs": in_use_keys | referenced_keys,
+            }
+            for kind, resource_ids in shared.items():
+                for resource_id in set(resources[region][kind]) & resource_ids:
+                    logger.info("Keeping {} {} in {}, still needed".format(kind, resource_id, region))
+                    resources[region][kind].remove(resource_id)
+
+    @staticmethod
+    def isalive(chain, concurrency=DEFAULT_STATUS_CONCURRENCY, timeout=DEFAULT_RPC_TIMEOUT):
         """
         Checks if the consensus on the chain is making progress; for more details, use status
         :param chain: Chain object
+        :param concurrency: the maximum number of nodes queried at once
+        :param timeout: how long to wait for a single node (seconds)
         :return: bool
         """
-        return Chainmanager.get_status(chain)['is_alive']
+        return Chainmanager.get_status(chain, concurrency, timeout)['is_alive']
 
     @staticmethod
     def _is_alive(block):
@@ -220,38 +468,96 @@ class Chainmanager:
         return abs((now - block.time).total_seconds()) <= DEFAULT_LIVENESS_THRESHOLD.total_seconds()
 
     @staticmethod
-    def get_status(chain):
+    def _get_node_status(chain_interface, node, timeout):
+        """
+        Queries a single node for its latest block; unreachable nodes, and nodes answering with malformed JSON or
+        an RPC error, are reported as dead, with the error
+        :param node: a tuple (RegionInstancePair, name)
+        :return: dict
+        """
+        region_instance_pair, name = node
+        result = {
+            'instance_id': region_instance_pair.id,
+            'instance_region': region_instance_pair.region_name,
+            'name': name,
+        }
+        try:
+            # not retried, so that a node which doesn't answer is given up on after timeout
+            last_block = chain_interface.get_latest_block(region_instance_pair, timeout=timeout, retries=False)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.warning("Unable to get status of instance {}: {}".format(region_instance_pair.id, e))
+            result.update({
+                'height': None,
+                'last_block_time': None,
+                'last_block_height': None,
+                'is_alive': False,
+                'error': str(e)
+            })
+            return result
+
+        result.update({
+            'height': last_block.height,
+            'last_block_time': last_block.time.isoformat(),
+            'last_block_height': last_block.height,
+            'is_alive': Chainmanager._is_alive(last_block)
+        })
+        return result
+
+    @staticmethod
+    def get_status(chain, concurrency=DEFAULT_STATUS_CONCURRENCY, timeout=DEFAULT_RPC_TIMEOUT):
         """
         Checks the status of all of the nodes that form the chain
+        The nodes are queried concurrently; nodes which can't be reached in time are reported as not alive
         :param chain: Chain object
+        :param concurrency: the maximum number of nodes queried at once
+        :param timeout: how long to wait for a single node (seconds)
         :return: dict
         """
-        result = {'nodes': []}
+        # AWS lookups are done up front, in one call per region (none for chain files with metadata),
+        # so that the worker threads only talk to the nodes
+        chain.hydrate()
+        nodes = [(region_instance_pair, region_instance_pair.instance_name) for region_instance_pair in chain.instances]
 
-        for region_instance_pair in chain.instances:
-            last_block = chain.chain_interface.get_latest_block(region_instance_pair.instance)
-            result['nodes'].append({
-                'instance_id': region_instance_pair.id,
-                'instance_region': region_instance_pair.region_name,
-                'name': region_instance_pair.instance_name,
-                'height': last_block.height,
-                'last_block_time': last_block.time.isoformat(),
-                'last_block_height': last_block.height,
-                'is_alive': Chainmanager._is_alive(last_block)
-            })
+        result = {'nodes': thread_map(lambda node: Chainmanager._get_node_status(chain.chain_interface, node, timeout),
+                                      nodes, concurrency)}
         result['is_alive'] = all(node['is_alive'] for node in result['nodes'])
-        heights = map(lambda node: node['height'], result['nodes'])
-        result['height'] = reduce(lambda x, y: x + y, heights) / len(heights)
+        heights = [node['height'] for node in result['nodes'] if node['height'] is not None]
+        result['height'] = sum(heights) / len(heights) if heights else None
         result['age'] = None  # TODO: the total time that the chain has been running
         return result
 
     @staticmethod
-    def get_history(chain, fromm=None, to=None):
+    def _chain_key(chain):
+        return chain.name or ",".join(sorted(region_instance_pair.id for region_instance_pair in chain.instances))
+
+    @staticmethod
+    def _iter_indexed_blocks(chain, instance, fromm, to, block_index):
+        """
+        Generates blocks from the block index, fetching only the missing ranges from the node (and indexing them)
+        """
+        chain_key = Chainmanager._chain_key(chain)
+        indexed_from = fromm
+        for low, high in block_index.missing_ranges(chain_key, fromm, to):
+            for block in block_index.iter_range(chain_key, indexed_from, low - 1):
+                yield block
+            for block in block_index.index_blocks(chain_key, chain.chain_interface.iter_blocks(instance, low, high)):
+                yield block
+            indexed_from = high + 1
+        for block in block_index.iter_range(chain_key, indexed_from, to):
+            yield block
+
+    @staticmethod
+    def iter_history(chain, fromm=None, to=None, block_index=None):
+        """
+        Generates (block time delta, block time, height) tuples of consecutive blocks between fromm and to;
+        blocks are streamed from the node page by page, so long histories are processed in constant memory
+        :param block_index: optional BlockIndex; only blocks missing from it are fetched from the node
+        """
         # FIXME: just pick a single instance to check history
         # FIXME: avoid digging into chain's internals? are these internals?
         # FIXME: rethink avoiding off-by-one errors with fromm/to according to some convention.
         #        Currently: returns to - from deltas, so to is inclusive, a'la tendermint RPC
-        instance = chain.instances[0].instance
+        instance = chain.instances[0]
 
         interface = chain.chain_interface
         if to is None:
@@ -261,23 +567,35 @@ class Chainmanager:
         if fromm + 1 > to:
             raise ValueError("need at least 1 block between from and two to get block times")
 
-        result = []
-
-        blocks = list(reversed(interface.get_blocks(instance, fromm, to)))
+        if block_index is None:
+            blocks = interface.iter_blocks(instance, fromm, to)
+        else:
+            blocks = Chainmanager._iter_indexed_blocks(chain, instance, fromm, to, block_index)
 
-        time = dateutil.parser.parse(blocks[0].time)
-        for block in blocks[1:]:
+        first_block = next(blocks, None)
+        if first_block is None:
+            return
+        time = dateutil.parser.parse(first_block.time)
+        for block in blocks:
             newtime = dateutil.parser.parse(block.time)
             delta = (newtime - time).total_seconds()
-            result.append((delta, newtime.isoformat(), block.height))
+            yield delta, newtime.isoformat(), block.height
             time = newtime
 
-        return result
+    @staticmethod
+    def get_history(chain, fromm=None, to=None, block_index=None):
+        """
+        :return: a list of (block time delta, block time, height), see iter_history
+        """
+        return list(Chainmanager.iter_history(chain, fromm, to, block_index))
 
     @staticmethod
     def get_network_fault(chain, num_steps, delay_step, interval):
         # FIXME: using zeroth instance height & time as reference, consider checking instances' synchronisation?
-        start_block = Chainmanager.get_status(chain)['nodes'][0]['height']
+        heights = [node['height'] for node in Chainmanager.get_status(chain)['nodes'] if node['height'] is not None]
+        if not heights:
+            raise RuntimeError("None of the nodes of the chain reports its height, unable to start a network fault")
+        start_block = heights[0]
 
         # NOTE: "synchronized" is assumed here, should be in sync if NTP is running out there...
         remote_synchronized_time = run_sh_script('shell_scripts/get_datetime.sh',
@@ -296,19 +614,14 @@ class Chainmanager:
             delay_start_time.isoformat()
         )
 
-        # NOTE: this multiprocessing is OK with moto
-        pool = ProcessingPool(len(chain.instances))
-        delay_step_times = pool.map((lambda instance:
-                                     run_sh_script(delaying_command,
-                                                   instance.key_name,
-                                                   instance.public_ip_address)), chain.instances)
-        pool.close()
-        pool.join()
+        # all of the nodes at once, they wait for delay_start_time themselves
+        results = run_on_chain(chain, delaying_command, concurrency=None)
+        raise_for_failures(results, delaying_command)
 
-        # delay_step_times is a by-instance array of strings of by-step delays
+        # results' outputs are strings of by-step delays
         # grab zeroth instance results for now
         # FIXME: check consistence of per instance results?
-        single_delay_step_times = delay_step_times[0].split('\n')
+        single_delay_step_times = results[0].output.split('\n')
 
         delays = [delay_step * step for step in xrange(1, num_steps + 1)]
         # this zero relates to the last remote time measurement - final deleting of the netem delay
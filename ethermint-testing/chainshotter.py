@@ -1,67 +1,291 @@
 import logging
+import threading
+import time
+from datetime import datetime
+from uuid import uuid4
 
 import boto3
+import pytz
+import requests
 
 from chain import Chain
 from chainmanager import RegionInstancePair
 from instance_creator import InstanceCreator
-from settings import DEFAULT_DEVICE
-from utils import run_sh_script, get_region_name, run_ethermint, halt_ethermint
-from waiting_for_ec2 import wait_for_available_volume
+from settings import DEFAULT_DEVICE, ROLLING_CATCH_UP_TIMEOUT, ROLLING_CATCH_UP_TOLERANCE, WAIT_MIN_INTERVAL, \
+    ETHERMINT_VOLUME_NAME, SNAPSHOT_DESCRIPTION
+from tendermint_app_interface import TendermintAppInterface
+from utils import get_region_name, run_ethermint, halt_ethermint, run_on_chain, raise_for_failures, thread_map
+from waiting_for_ec2 import iter_available_volumes, iter_completed_snapshots
 
 logger = logging.getLogger(__name__)
 
 
+def restorable_heights(heights):
+    """
+    Tells whether the nodes snapshotted at heights can be restored to a consistent height.
+    Consensus can resume from the height that more than 2/3 of the nodes have reached; the nodes behind it
+    catch up from their peers
+    :param heights: the block height of each node, None where unknown
+    :return: a dictionary
+    """
+    known = sorted((h for h in heights if h is not None), reverse=True)
+    quorum = len(heights) * 2 // 3 + 1
+    restorable_height = known[quorum - 1] if len(known) >= quorum else None
+    return {
+        "heights": heights,
+        "min_height": min(known) if known else None,
+        "max_height": max(known) if known else None,
+        "consistent": len(known) == len(heights) and len(set(known)) == 1,
+        "restorable": restorable_height is not None,
+        "restorable_height": restorable_height,
+    }
+
+
 class Chainshotter:
-    def __init__(self, num_processes=None):
+    def __init__(self, num_processes=None, concurrency=1):
+        """
+        :param num_processes: passed on to InstanceCreator
+        :param concurrency: how many nodes to halt/start ethermint on at once
+        """
         self.instance_creator = InstanceCreator(num_processes)
+        self.concurrency = concurrency
 
-    def chainshot(self, name, chain):
+    @staticmethod
+    def _get_heights(instances):
         """
-        Makes a snapshot of a chain
+        The latest block height of each of the nodes, None for the nodes that don't answer
+        :param instances: loaded boto3 Instances, so that the worker threads only talk to the nodes
+        """
+        def height(instance):
+            try:
+                return TendermintAppInterface.get_latest_block(instance).height
+            except requests.RequestException as e:
+                logger.warning("Unable to get the height of instance {}: {}".format(instance.id, e))
+                return None
 
-        :param chain: Chain object
-        :param name: The name of the chainshot
-        :return: a dictionary containing the snapshot info
+        return thread_map(height, instances)
+
+    @staticmethod
+    def _new_chainshot(name, chain, parent):
+        """
+        The chainshot skeleton, the loaded instances and their ethermint volumes, looked up before anything is halted
+        :return: a tuple (chainshot dictionary, list of instances, list of (region, volume id), dict region -> client)
         """
+        # chainshots made before lineage tracking have no id nor lineage; such a parent starts a lineage of its own
+        parent_id = parent.get("id", parent["chainshot_name"]) if parent else None
         results = {
             "chainshot_name": name,
+            "id": uuid4().hex,
+            "parent": parent_id,
+            "created": datetime.now(tz=pytz.UTC).isoformat(),
             "instances": []
         }
+        results["lineage"] = parent.get("lineage", parent_id) if parent else results["id"]
+        all_ids = {}
         for region_instance_pair in chain.instances:
-            all_ids = [instance.id for instance in list(region_instance_pair.ec2.instances.all())]
-            if region_instance_pair.id not in all_ids:
-                raise IndexError("Instance {} not found in region {}".format(region_instance_pair.id,
-                                                                             region_instance_pair.region_name))
-
-        halt_ethermint(chain)
-
-        for region_instance_pair in chain.instances:
-            instance = region_instance_pair.instance
+            region_name = region_instance_pair.region_name
+            if region_name not in all_ids:
+                all_ids[region_name] = [instance.id for instance in region_instance_pair.ec2.instances.all()]
+            if region_instance_pair.id not in all_ids[region_name]:
+                raise IndexError("Instance {} not found in region {}".format(region_instance_pair.id, region_name))
+
+        # AWS lookups are done before halting, so that they don't add to the downtime
+        RegionInstancePair.describe_all(chain.instances, force=True)
+        instances = [region_instance_pair.instance for region_instance_pair in chain.instances]
+        volumes = []
+        for region_instance_pair, instance in zip(chain.instances, instances):
             volumes_collection = instance.volumes.filter(Filters=[
                 {'Name': 'tag-key', 'Values': ["Name"]},
-                {'Name': 'tag-value', 'Values': ['ethermint_volume']}
+                {'Name': 'tag-value', 'Values': [ETHERMINT_VOLUME_NAME]}
             ])
-            volume = list(volumes_collection)[0]
+            volumes.append((region_instance_pair.region_name, list(volumes_collection)[0].id))
+        clients = dict((region, boto3.client('ec2', region_name=region)) for region, _ in volumes)
+        return results, instances, volumes, clients
 
-            snapshot_info = self._snapshot(instance, volume, region_instance_pair.ec2)
+    @staticmethod
+    def _heights_range(parent, height):
+        parent_height = parent.get("heights", {}).get("to") if parent else None
+        return {"from": parent_height + 1 if parent_height is not None else 1, "to": height}
 
-            results["instances"].append(snapshot_info)
+    def chainshot(self, name, chain, parent=None):
+        """
+        Makes a snapshot of a chain
+
+        Ethermint is only halted until all of the snapshots are initiated, since EBS takes the point-in-time copy
+        at initiation; the snapshots complete while the network is running again.
+        Chainshots form a lineage: each one records its parent and the block heights added since the parent
 
-        run_ethermint(chain)
+        :param chain: Chain object
+        :param name: The name of the chainshot
+        :param parent: the previous chainshot of the chain, if any
+        :return: a dictionary containing the snapshot info
+        """
+        results, instances, volumes, clients = self._new_chainshot(name, chain, parent)
+
+        # the height right before halting; a block committed in between is also in the snapshots
+        heights = [h for h in self._get_heights(instances) if h is not None]
+        height = max(heights) if heights else None
+        results["heights"] = self._heights_range(parent, height)
+
+        halt_start = time.time()
+        halt_timings = halt_ethermint(chain, self.concurrency)
+        logger.info("Halted ethermint, timings: {}".format(halt_timings))
+
+        try:
+            snapshots = thread_map(lambda volume: self._start_snapshot(clients[volume[0]], volume[1], height),
+                                   volumes)
+        finally:
+            # the network is brought back even if the snapshots couldn't be initiated
+            run_timings = run_ethermint(chain, self.concurrency)
+        downtime = time.time() - halt_start
+        logger.info("Restarted ethermint after {:.1f}s, timings: {}".format(downtime, run_timings))
+
+        completion_timings = self._wait_for_snapshots(volumes, snapshots, clients)
+
+        for region_instance_pair, instance, (snapshot, initiation_time) in zip(chain.instances, instances, snapshots):
+            snapshot_info = self._snapshot_info(instance, snapshot, height)
+            snapshot_info["timings"] = {
+                "halt": halt_timings[region_instance_pair.id],
+                "snapshot_initiation": initiation_time,
+                "snapshot_completion": completion_timings[snapshot["SnapshotId"]],
+                "run": run_timings[region_instance_pair.id],
+            }
+            results["instances"].append(snapshot_info)
+        results["downtime"] = downtime
 
         logger.info("Finished chainshotting, the results:")
         logger.info(results)
 
         return results
 
-    def _snapshot(self, instance, volume, ec2):
-        logger.info("Creating snapshot of volume {} of instance {}".format(volume.id, instance.id))
+    def rolling_chainshot(self, name, chain, parent=None, batch_size=None, catch_up_timeout=ROLLING_CATCH_UP_TIMEOUT):
+        """
+        Makes a snapshot of a chain without halting the whole network: the nodes are taken out in batches of at most
+        f = (n - 1) / 3 nodes, so that the rest keep reaching consensus, and every batch has to catch up
+        before the next one is taken out.
+        The nodes are snapshotted at different heights, each snapshot is tagged with the BlockHeight its node reported
+        right before it was halted
+
+        :param chain: Chain object
+        :param name: The name of the chainshot
+        :param parent: the previous chainshot of the chain, if any
+        :param batch_size: how many nodes to take out at once, defaults to f (at least 1)
+        :param catch_up_timeout: how long to wait for a batch to catch up with the network (seconds)
+        :return: a dictionary containing the snapshot info, with the heights of the nodes under "rolling"
+        """
+        n = len(chain.instances)
+        if n < 2:
+            raise ValueError("A rolling chainshot needs at least 2 nodes")
+        results, instances, volumes, clients = self._new_chainshot(name, chain, parent)
+        # at least one node has to stay up, as the seed of the restarted ones
+        batch_size = min(batch_size or max(1, (n - 1) // 3), n - 1)
+        if batch_size > (n - 1) // 3:
+            logger.warning("Taking out {} of {} nodes at once stalls the consensus".format(batch_size, n))
+
+        nodes = zip(range(n), chain.instances, instances, volumes)
+        node_heights = [None] * n
+        snapshots = [None] * n
+        timings = [None] * n
+        for batch_start in range(0, n, batch_size):
+            batch = nodes[batch_start:batch_start + batch_size]
+            batch_chain = Chain([region_instance_pair for _, region_instance_pair, _, _ in batch])
+            batch_instances = [instance for _, _, instance, _ in batch]
+            batch_volumes = [volume for _, _, _, volume in batch]
+            others = [instance for i, _, instance, _ in nodes if i < batch_start or i >= batch_start + batch_size]
+
+            # the heights right before halting, like in chainshot; once restarted, the nodes sync past them at once
+            heights = self._get_heights(batch_instances)
+            halt_timings = halt_ethermint(batch_chain, self.concurrency)
+            batch_snapshots = thread_map(lambda j: self._start_snapshot(clients[batch_volumes[j][0]],
+                                                                        batch_volumes[j][1], heights[j]),
+                                         range(len(batch)))
+            script = "shell_scripts/run_ethermint.sh {}:46656".format(others[0].public_ip_address)
+            results_run = run_on_chain(batch_chain, script, self.concurrency, fail_fast=True)
+            raise_for_failures(results_run, script)
+            logger.info("Snapshotted instances {} at heights {}".format(
+                ", ".join(region_instance_pair.id for region_instance_pair in batch_chain.instances), heights))
+
+            for (i, region_instance_pair, _, _), height, snapshot, run_result in zip(
+                    batch, heights, batch_snapshots, results_run):
+                node_heights[i] = height
+                snapshots[i] = snapshot
+                timings[i] = {"halt": halt_timings[region_instance_pair.id], "snapshot_initiation": snapshot[1],
+                              "run": run_result.latency}
+
+            self._wait_for_catch_up(batch_instances, others, catch_up_timeout)
+
+        completion_timings = self._wait_for_snapshots(volumes, snapshots, clients)
+        for instance, (snapshot, _), height, node_timings in zip(instances, snapshots, node_heights, timings):
+            snapshot_info = self._snapshot_info(instance, snapshot, height)
+            node_timings["snapshot_completion"] = completion_timings[snapshot["SnapshotId"]]
+            snapshot_info["timings"] = node_timings
+            results["instances"].append(snapshot_info)
 
-        snapshot = ec2.create_snapshot(VolumeId=volume.id, Description='ethermint-backup')
-        snapshot.wait_until_completed()
-        logger.info("Created snapshot {}".format(snapshot.id))
+        results["rolling"] = restorable_heights(node_heights)
+        results["heights"] = self._heights_range(parent, results["rolling"]["restorable_height"])
 
+        logger.info("Finished rolling chainshot, the results:")
+        logger.info(results)
+
+        return results
+
+    def _wait_for_catch_up(self, instances, others, timeout):
+        """
+        Waits until all of the nodes are within ROLLING_CATCH_UP_TOLERANCE blocks of the highest of the other nodes,
+        which keep adding blocks meanwhile, so their heights are read again on every poll
+        :param instances: the restarted nodes
+        :param others: the nodes which stayed up
+        """
+        deadline = time.time() + timeout
+        while True:
+            network_heights = [h for h in self._get_heights(others) if h is not None]
+            if not network_heights:
+                logger.warning("Heights of the network unknown, not waiting for instances {} to catch up".format(
+                    ", ".join(instance.id for instance in instances)))
+                return
+            height = max(network_heights) - ROLLING_CATCH_UP_TOLERANCE
+            heights = self._get_heights(instances)
+            if all(h is not None and h >= height for h in heights):
+                return
+            if time.time() > deadline:
+                raise RuntimeError("Instances {} didn't catch up with height {} in {}s, their heights: {}".format(
+                    ", ".join(instance.id for instance in instances), height, timeout, heights))
+            time.sleep(WAIT_MIN_INTERVAL)
+
+    @staticmethod
+    def _start_snapshot(ec2_client, volume_id, height=None):
+        """
+        Initiates a snapshot of a volume, without waiting for it to complete
+        :param height: the block height of the node, which the snapshot is tagged with
+        :return: a tuple (the create_snapshot response, how long initiating took in seconds)
+        """
+        logger.info("Creating snapshot of volume {}".format(volume_id))
+        start = time.time()
+        snapshot = ec2_client.create_snapshot(VolumeId=volume_id, Description=SNAPSHOT_DESCRIPTION)
+        initiation_time = time.time() - start
+        if height is not None:
+            ec2_client.create_tags(Resources=[snapshot["SnapshotId"]], Tags=[{"Key": "BlockHeight",
+                                                                              "Value": str(height)}])
+        return snapshot, initiation_time
+
+    @staticmethod
+    def _wait_for_snapshots(volumes, snapshots, clients):
+        """
+        :return: a dictionary snapshot id -> seconds from initiating all of the snapshots until it completed
+        """
+        snapshot_ids = {}
+        for (region, _), (snapshot, _) in zip(volumes, snapshots):
+            snapshot_ids.setdefault(region, []).append(snapshot["SnapshotId"])
+
+        start = time.time()
+        timings = {}
+        for _, snapshot_id in iter_completed_snapshots(snapshot_ids, clients):
+            timings[snapshot_id] = time.time() - start
+            logger.info("Created snapshot {}".format(snapshot_id))
+        return timings
+
+    @staticmethod
+    def _snapshot_info(instance, snapshot, height=None):
         snapshot_info = {
             "instance": {
                 "id": instance.id,
@@ -78,9 +302,10 @@ class Chainshotter:
                 # NOTE if we want to repeat chainshot() - thaw() multiple times,
                 # we need to save the launch time in S3, so that it is not reset each time an instance is run
                 "from": instance.launch_time.isoformat(),
-                "to": snapshot.start_time.isoformat(),
+                "to": snapshot["StartTime"].isoformat(),
+                "height": height,
 
-                "id": snapshot.id
+                "id": snapshot["SnapshotId"]
             }
         }
         return snapshot_info
@@ -91,40 +316,49 @@ class Chainshotter:
 
         For each snapshot/instance in the file,
         it restarts the instance (by creating a new instance with the same parameters) and attaches the snapshot
-        as volume and mounts it
+        as volume and mounts it.
+        The instances are launched together, a volume is created from the snapshot as soon as its instance is running
+        and the volumes are attached as soon as they are available
 
         :param chainshot: the config created by chainshot()
         :return: Chain object
         """
-        instances = []
-
-        for snapshot_info in chainshot["instances"]:
-            ec2 = boto3.resource('ec2', region_name=snapshot_info["instance"]["region"])
-            new_instance = self.instance_creator.create_ec2s_from_json([snapshot_info["instance"]])[0]
-            logger.info("Created new instance {} from AMI {}".format(new_instance.id, snapshot_info["instance"]["ami"]))
-
-            snapshot = ec2.Snapshot(snapshot_info["snapshot"]["id"])
+        instances_config = [snapshot_info["instance"] for snapshot_info in chainshot["instances"]]
+        snapshot_ids = [snapshot_info["snapshot"]["id"] for snapshot_info in chainshot["instances"]]
+        # clients are thread-safe, unlike resources, and are used from the launching threads
+        clients = dict((get_region_name(config["region"]), boto3.client('ec2', region_name=config["region"]))
+                       for config in instances_config)
+        new_volumes = {}  # region -> {volume id: (index, instance id)}
+        volumes_lock = threading.Lock()
+
+        def restore_volume(index, new_instance):
+            region = get_region_name(new_instance.placement["AvailabilityZone"])
+            logger.info("Created new instance {} from AMI {}".format(new_instance.id, instances_config[index]["ami"]))
+            volume = clients[region].create_volume(SnapshotId=snapshot_ids[index],
+                                                   AvailabilityZone=new_instance.placement["AvailabilityZone"])
+            with volumes_lock:
+                new_volumes.setdefault(region, {})[volume["VolumeId"]] = (index, new_instance.id)
+
+        instances = self.instance_creator.create_ec2s_from_json(instances_config, on_ready=restore_volume)
+
+        # attach each volume as soon as it is available
+        for region, volume_id in iter_available_volumes({region: volumes.keys()
+                                                         for region, volumes in new_volumes.items()}, clients):
+            index, instance_id = new_volumes[region][volume_id]
+            clients[region].attach_volume(InstanceId=instance_id, VolumeId=volume_id, Device=DEFAULT_DEVICE)
+            logger.info("Attached volume {} containing snapshot {} to instance {}".format(volume_id,
+                                                                                          snapshot_ids[index],
+                                                                                          instance_id))
 
-            volume = ec2.create_volume(SnapshotId=snapshot.id,
-                                       AvailabilityZone=new_instance.placement["AvailabilityZone"])
-
-            wait_for_available_volume(volume, get_region_name(new_instance.placement["AvailabilityZone"]))
-
-            new_instance.attach_volume(VolumeId=volume.id, Device=DEFAULT_DEVICE)
-            logger.info("Attached volume {} containing snapshot {} to instance {}".format(volume.id,
-                                                                                          snapshot.id,
-                                                                                          new_instance.id))
-
-            instances.append(new_instance)
+        chain = Chain(map(RegionInstancePair.from_boto, instances))
 
-            run_sh_script("shell_scripts/mount_snapshot.sh", snapshot_info["instance"]["key_name"],
-                          new_instance.public_ip_address)
+        results = run_on_chain(chain, "shell_scripts/mount_snapshot.sh", self.concurrency, fail_fast=True)
+        raise_for_failures(results, "shell_scripts/mount_snapshot.sh")
 
         for instance in instances:
             logger.info("Instance ID: {} unfreezed from chainshot".format(instance.id))
 
-        chain = Chain(map(RegionInstancePair.from_boto, instances))
-        run_ethermint(chain)
+        run_ethermint(chain, self.concurrency)
 
         logger.info("Done starting ethermint on instances")
 
@@ -1,11 +1,14 @@
-import multiprocessing
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import boto3
 import logging
 
-from settings import DEFAULT_INSTANCE_TYPE, DEFAULT_SNAPSHOT_VOLUME_SIZE, DEFAULT_DEVICE
-from utils import get_region_name, run_sh_script
-from waiting_for_ec2 import wait_for_available_volume
+from settings import DEFAULT_INSTANCE_TYPE, DEFAULT_SNAPSHOT_VOLUME_SIZE, DEFAULT_DEVICE, DEFAULT_SSH_CONCURRENCY, \
+    ETHERMINT_VOLUME_NAME
+from utils import get_region_name, run_sh_script, thread_map
+from waiting_for_ec2 import iter_running_instance_descriptions, iter_available_volumes
 
 logger = logging.getLogger(__name__)
 
@@ -14,85 +17,130 @@ class InstanceCreator:
     """
     Internal class which handles spinning up of ec2 instances according to configuration
     """
-    def __init__(self, num_processes):
+    def __init__(self, num_processes=None):
+        """
+        :param num_processes: how many launches to run at once, defaults to all of them
+        """
         self.num_processes = num_processes
+        self._local = threading.local()
+        self._region_locks = {}
+        self._region_locks_lock = threading.Lock()
+
+    def _get_ec2(self, region):
+        """
+        EC2 resource of a boto3 session of the calling thread
+        boto3 sessions and resources aren't thread-safe, so every launching thread has its own
+        """
+        resources = self._local.__dict__.setdefault("resources", {})
+        if region not in resources:
+            resources[region] = boto3.session.Session().resource('ec2', region_name=region)
+        return resources[region]
 
-    def create_ec2s_from_json(self, config):
+    def _region_lock(self, region):
+        """
+        The lock which serializes the launches of a region, when a region has more than one launch group
+        """
+        with self._region_locks_lock:
+            return self._region_locks.setdefault(region, threading.Lock())
+
+    def create_ec2s_from_json(self, config, on_ready=None):
         """
         Runs Ec2 instances based on config and returns the list of instance objects
+        Instances with the same region, AMI, security groups and key are launched with a single call,
+        and the launches of different regions run in parallel threads
         :param config: config consists of a list of instance configs
         each instance config HAS TO contain the following fields:
         "region", "ami", "security_groups", "key_name", "tags"
         the config MAY contain also:
         "add_volume", "tags" (additional tags)
-        :return: a list of instance objects
+        :param on_ready: optional callback (index in config, instance), called from a launching or a mounting thread
+        as soon as an instance is running and has its volume mounted; it should hand the instance over rather than
+        block
+        :return: a list of instance objects, in the order of config
         """
-
-        if self.num_processes is None or self.num_processes == 1:
-            instances_ids = []
-            for conf in config:
-                instances_ids.append(_create_instance(conf))
-        else:
-            # run in parallel, but this fails tests (because of moto), hence is based on an option
-            # tried multiprocessing.ThreadPool which is ok with moto but has random errors
-            # so, the default for tests is the sequential version above
-            pool = multiprocessing.Pool(self.num_processes)
-            instances_ids = pool.map_async(_create_instance, config).get(600)
+        launches = OrderedDict()
+        for index, conf in enumerate(config):
+            key = (get_region_name(conf["region"]), conf["ami"], tuple(conf["security_groups"]), conf["key_name"])
+            launches.setdefault(key, []).append(index)
+
+        def _launch(launch):
+            (region, ami, security_groups, key_name), indices = launch
+            ready = (lambda position, instance: on_ready(indices[position], instance)) if on_ready else None
+            with self._region_lock(region):
+                return self._create_instances(region, ami, list(security_groups), key_name,
+                                              [config[index] for index in indices], ready)
+
+        instances_ids = [None] * len(config)
+        for indices, ids in zip(launches.values(), thread_map(_launch, launches.items(), self.num_processes)):
+            for index, instance_id in zip(indices, ids):
+                instances_ids[index] = instance_id
+
+        return [boto3.resource('ec2', region_name=get_region_name(instance_config["region"])).Instance(instance_id)
+                for instance_config, instance_id in zip(config, instances_ids)]
+
+    def _create_instances(self, region, ami, security_groups, key_name, configs, on_ready=None):
+        """
+        Launches len(configs) instances with one RunInstances call, then tags them and adds volumes
+        :param on_ready: optional callback (position in configs, instance)
+        :return: the created instances' ids, in the order of configs
+        """
+        ec2 = self._get_ec2(region)
+        instances = ec2.create_instances(ImageId=ami,
+                                         InstanceType=DEFAULT_INSTANCE_TYPE,
+                                         MinCount=len(configs),
+                                         MaxCount=len(configs),
+                                         SecurityGroupIds=security_groups,
+                                         KeyName=key_name)
+        instances_ids = [instance.id for instance in instances]
+        configs_by_id = dict(zip(instances_ids, configs))
+        positions = dict((instance_id, position) for position, instance_id in enumerate(instances_ids))
+
+        def ready(instance):
+            if on_ready:
+                on_ready(positions[instance.id], instance)
+
+        # every instance is tagged as soon as it is running, and its volume is created, attached and mounted
+        # in the pool, without waiting for the other instances
+        client = ec2.meta.client
+        pool = ThreadPool(min(DEFAULT_SSH_CONCURRENCY, len(configs)))
+        try:
+            mounts = []
+            for _, description in iter_running_instance_descriptions({region: instances_ids},
+                                                                     clients={region: client}):
+                # the description of the batched describe call, instead of loading every instance
+                instance = ec2.Instance(description["InstanceId"])
+                instance.meta.data = description
+                instance_config = configs_by_id[instance.id]
+                if instance_config.get("tags"):
+                    client.create_tags(Resources=[instance.id], Tags=instance_config["tags"])
+                logger.info("Created instance with ID {} in {}".format(instance.id, region))
+                if instance_config.get("add_volume"):
+                    mounts.append(pool.apply_async(_add_volume, (client, region, instance, ready)))
+                else:
+                    ready(instance)
+            for mount in mounts:
+                mount.get()
+        finally:
             pool.close()
             pool.join()
-
-        ec2s = [boto3.resource('ec2', region_name=instance_config["region"]) for
-                instance_config in config]
-
-        instances = [ec2.Instance(instace_id) for ec2, instace_id in zip(ec2s, instances_ids)]
-        return instances
+        return instances_ids
 
 
-def _create_instance(instance_config):
-    """
-    Helper - outside Chainmanager due to pickling for multiprocessing
-    :param instance_config:
-    :return: created instance's id
-    """
-    ec2 = boto3.resource('ec2', region_name=get_region_name(instance_config["region"]))
-    # create instances returns a list of instances, we want the first element
-    instance = ec2.create_instances(ImageId=instance_config["ami"],
-                                    InstanceType=DEFAULT_INSTANCE_TYPE,
-                                    MinCount=1,
-                                    MaxCount=1,
-                                    SecurityGroupIds=instance_config["security_groups"],
-                                    KeyName=instance_config["key_name"])[0]
-    instance.wait_until_running()
-    instance.reload()
-    if "add_volume" in instance_config and instance_config["add_volume"]:
-        _add_volume(instance)
-    if "tags" in instance_config and instance_config["tags"]:
-        instance.create_tags(Tags=instance_config["tags"])
-    logger.info("Created instance with ID {}".format(instance.id))
-    return instance.id
-
-
-def _add_volume(instance):
+def _add_volume(client, region, instance, on_mounted=None):
     """
-    Outside Chainmanager due to pickling for multiprocessing
-    Allows to create a new volume and attach it to an instance and mount it
-    The volume is created in the same zone as the instnace
-    :param instance: the instance object
+    Creates a new volume in the same zone as the instance, attaches it as soon as it is available and mounts it
+    :param client: the EC2 client of the region; clients are thread-safe, unlike resources
+    :param on_mounted: optional callback (instance), called once the volume is mounted
     :return: -
     """
-    region = get_region_name(instance.placement.get("AvailabilityZone"))
-    ec2 = boto3.resource('ec2', region_name=region)
-
-    volume = ec2.create_volume(Size=DEFAULT_SNAPSHOT_VOLUME_SIZE,
-                               AvailabilityZone=instance.placement.get("AvailabilityZone"))
-    volume = ec2.Volume(volume.id)
-    volume.create_tags(Tags=[{'Key': 'Name', 'Value': 'ethermint_volume'}])
-
-    assert volume.availability_zone == instance.placement.get("AvailabilityZone")
-
-    wait_for_available_volume(volume, get_region_name(instance.placement["AvailabilityZone"]))
-
-    instance.attach_volume(VolumeId=volume.id, Device=DEFAULT_DEVICE)
-    logger.info("Attached volume {} to instance {}".format(volume.id, instance.id))
+    zone = instance.placement["AvailabilityZone"]
+    volume_id = client.create_volume(Size=DEFAULT_SNAPSHOT_VOLUME_SIZE, AvailabilityZone=zone)["VolumeId"]
+    client.create_tags(Resources=[volume_id], Tags=[{'Key': 'Name', 'Value': ETHERMINT_VOLUME_NAME}])
+    for _ in iter_available_volumes({region: [volume_id]}, clients={region: client}):
+        pass
+    client.attach_volume(InstanceId=instance.id, VolumeId=volume_id, Device=DEFAULT_DEVICE)
+    logger.info("Attached volume {} to instance {}".format(volume_id, instance.id))
 
     run_sh_script("shell_scripts/mount_new_volume.sh", instance.key_name, instance.public_ip_address)
+    if on_mounted:
+        on_mounted(instance)
@@ -0,0 +1,73 @@
+import json
+import logging
+
+import dateutil.parser
+
+logger = logging.getLogger(__name__)
+
+
+def load_chainshots(paths):
+    """
+    :param paths: paths of chainshot files
+    :return: a list of chainshot dictionaries
+    """
+    chainshots = []
+    for path in paths:
+        with open(path) as f:
+            chainshots.append(json.load(f))
+    return chainshots
+
+
+def _created(chainshot):
+    # chainshots made before lineage tracking have no creation time and count as the oldest
+    if "created" not in chainshot:
+        return 0, None
+    return 1, dateutil.parser.parse(chainshot["created"])
+
+
+def _has_lineage(chainshot):
+    if "heights" not in chainshot:
+        logger.warning("Chainshot {} has no lineage information".format(chainshot["chainshot_name"]))
+        return False
+    return True
+
+
+def coverage(chainshots):
+    """
+    Which block heights the chainshots cover, lineage by lineage
+    :return: a dictionary lineage id -> list of {"id", "name", "parent", "from", "to", "created"}, oldest first;
+    a chainshot covers the heights from its parent's last height + 1 up to its own last height
+    """
+    lineages = {}
+    for chainshot in filter(_has_lineage, chainshots):
+        lineages.setdefault(chainshot["lineage"], []).append({
+            "id": chainshot["id"],
+            "name": chainshot["chainshot_name"],
+            "parent": chainshot["parent"],
+            "from": chainshot["heights"]["from"],
+            "to": chainshot["heights"]["to"],
+            "created": chainshot["created"],
+        })
+    for entries in lineages.values():
+        entries.sort(key=lambda entry: dateutil.parser.parse(entry["created"]))
+    return lineages
+
+
+def find_chainshot(chainshots, height=None):
+    """
+    Picks the chainshot to thaw
+    :param height: the block height to restore; the chain is restored to the end of the range of the chainshot
+    covering the height. None for the newest chainshot
+    :return: a chainshot dictionary
+    """
+    if height is None:
+        if not chainshots:
+            raise ValueError("No chainshots given")
+        return max(chainshots, key=_created)
+
+    candidates = [chainshot for chainshot in filter(_has_lineage, chainshots)
+                  if chainshot["heights"]["to"] is not None
+                  and chainshot["heights"]["from"] <= height <= chainshot["heights"]["to"]]
+    if not candidates:
+        raise ValueError("No chainshot covers height {}".format(height))
+    return max(candidates, key=_created)
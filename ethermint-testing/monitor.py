@@ -0,0 +1,108 @@
+import csv
+import logging
+import time
+from datetime import datetime
+
+import dateutil.parser
+import pytz
+import requests
+
+from settings import DEFAULT_STATUS_CONCURRENCY, DEFAULT_RPC_TIMEOUT, MONITOR_INTERVAL
+from tendermint_app_interface import TendermintAppInterface, EthermintException
+from utils import thread_map
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ["time", "instance_id", "region", "height", "lag", "new_blocks", "mean_block_time", "last_block_time",
+           "rpc_latency_ms", "error"]
+
+
+def _block_time(block):
+    # /status gives datetimes, /blockchain gives the header's time strings
+    return dateutil.parser.parse(block.time) if isinstance(block.time, basestring) else block.time
+
+
+class ChainMonitor:
+    """
+    Polls all of the nodes of a chain at a fixed interval, for a time-series of their heights, lags and RPC latencies
+    The nodes are reached through the keep-alive connections of rpc_connection_pool, and only the blocks which are new
+    since the previous poll are fetched from them
+    NOTE: only the tendermint side of the nodes is polled, geth isn't checked like in Chainmanager.get_status
+    """
+
+    def __init__(self, chain, concurrency=DEFAULT_STATUS_CONCURRENCY, timeout=DEFAULT_RPC_TIMEOUT):
+        """
+        :param chain: Chain object; it's hydrated on every poll, so that the nodes don't call AWS one by one
+        :param concurrency: the maximum number of nodes queried at once
+        :param timeout: how long to wait for a single node (seconds)
+        """
+        self.chain = chain
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._last_blocks = {}  # instance id -> (height, block time) of the newest block seen
+
+    def _poll_node(self, region_instance_pair):
+        """
+        :return: a row without the lag, a dict
+        """
+        row = dict((column, None) for column in COLUMNS)
+        row.update(instance_id=region_instance_pair.id, region=region_instance_pair.region_name, new_blocks=0)
+
+        start = time.time()
+        try:
+            latest = TendermintAppInterface.get_latest_block(region_instance_pair, timeout=self.timeout, retries=False)
+            row["rpc_latency_ms"] = int((time.time() - start) * 1000)
+
+            last = self._last_blocks.get(region_instance_pair.id)
+            times = []
+            if last is not None and latest.height > last[0]:
+                times = [last[1]] + [_block_time(block) for block in
+                                     TendermintAppInterface.iter_blocks(region_instance_pair, last[0] + 1,
+                                                                        latest.height)]
+        except (requests.RequestException, ValueError, KeyError, EthermintException) as e:
+            logger.warning("Unable to poll instance {}: {}".format(region_instance_pair.id, e))
+            row["error"] = str(e)
+            return row
+
+        if last is None or latest.height > last[0]:
+            self._last_blocks[region_instance_pair.id] = (latest.height, _block_time(latest))
+        row.update(height=latest.height, last_block_time=_block_time(latest).isoformat(),
+                   new_blocks=max(len(times) - 1, 0))
+        if len(times) > 1:
+            row["mean_block_time"] = (times[-1] - times[0]).total_seconds() / (len(times) - 1)
+        return row
+
+    def poll(self):
+        """
+        Polls all of the nodes concurrently
+        :return: a list of rows, dicts with the COLUMNS, one per node in the order of the chain's instances;
+        lag is the number of blocks the node is behind the highest node
+        """
+        now = datetime.now(tz=pytz.UTC).isoformat()
+        # chain files without metadata, or stale descriptions, are described once per region, not per node
+        self.chain.hydrate()
+        rows = thread_map(self._poll_node, self.chain.instances, self.concurrency)
+        heights = [row["height"] for row in rows if row["height"] is not None]
+        for row in rows:
+            row["time"] = now
+            if row["height"] is not None:
+                row["lag"] = max(heights) - row["height"]
+        return rows
+
+    def run(self, output, interval=MONITOR_INTERVAL, ticks=None):
+        """
+        Polls the nodes every interval seconds and writes the rows to output as CSV, flushing after every poll
+        :param output: a file-like object
+        :param ticks: how many polls to make, None to poll until interrupted
+        :return: -
+        """
+        writer = csv.DictWriter(output, COLUMNS)
+        writer.writeheader()
+        tick = 0
+        while ticks is None or tick < ticks:
+            start = time.time()
+            writer.writerows(self.poll())
+            output.flush()
+            tick += 1
+            if ticks is None or tick < ticks:
+                time.sleep(max(interval - (time.time() - start), 0))
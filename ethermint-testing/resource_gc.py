@@ -0,0 +1,234 @@
+import logging
+import time
+from datetime import datetime, timedelta
+
+import boto3
+import pytz
+from botocore.exceptions import ClientError, BotoCoreError
+
+from lineage import coverage
+from settings import ETHERMINT_VOLUME_NAME, SNAPSHOT_DESCRIPTION, SECURITY_GROUP_NAME_PREFIX, KEY_NAME_PREFIX, \
+    GC_GRACE_PERIOD
+from utils import get_region_name, thread_map
+
+logger = logging.getLogger(__name__)
+
+# the order of deletion within a region: volumes before the snapshots, groups and keys nothing depends on anymore
+RESOURCE_KINDS = ["volumes", "snapshots", "security_groups", "key_pairs"]
+
+
+def _kept_chainshots(chainshots, keep):
+    """
+    :return: a tuple (dictionary id -> chainshot, set of the ids of the kept chainshots)
+    """
+    chainshots_by_id = dict((chainshot.get("id", chainshot["chainshot_name"]), chainshot) for chainshot in chainshots)
+    kept = set(chainshots_by_id.keys())
+    if keep is not None:
+        for entries in coverage(chainshots).values():
+            for entry in entries[:max(len(entries) - keep, 0)]:
+                logger.info("Dropping chainshot {} ({})".format(entry["id"], entry["name"]))
+                kept.discard(entry["id"])
+    return chainshots_by_id, kept
+
+
+def chainshot_snapshots(chainshots, keep=None):
+    """
+    Applies the retention policy to the chainshots: the newest keep chainshots of every lineage are kept
+    :param chainshots: chainshot dictionaries
+    :param keep: how many chainshots to keep per lineage, None to keep them all
+    :return: a tuple (ids of the snapshots of the kept chainshots, ids of the snapshots of the dropped ones)
+    """
+    chainshots_by_id, kept = _kept_chainshots(chainshots, keep)
+
+    def snapshot_ids(chainshot_ids):
+        return set(data["snapshot"]["id"] for chainshot_id in chainshot_ids
+                   for data in chainshots_by_id[chainshot_id]["instances"])
+
+    kept_snapshots = snapshot_ids(kept)
+    return kept_snapshots, snapshot_ids(set(chainshots_by_id.keys()) - kept) - kept_snapshots
+
+
+def chainshot_resources(chainshots, keep=None):
+    """
+    The security groups and key pairs that thawing the kept chainshots launches the instances with
+    :param chainshots: chainshot dictionaries
+    :param keep: how many chainshots to keep per lineage, None to keep them all
+    :return: a dictionary region -> (set of security group names, set of key names)
+    """
+    chainshots_by_id, kept = _kept_chainshots(chainshots, keep)
+    resources = {}
+    for chainshot_id in kept:
+        for data in chainshots_by_id[chainshot_id]["instances"]:
+            config = data.get("instance")
+            if not config:
+                continue
+            groups, keys = resources.setdefault(get_region_name(config["region"]), (set(), set()))
+            groups.update(config.get("security_groups", []))
+            if config.get("key_name"):
+                keys.add(config["key_name"])
+    return resources
+
+
+def chainshot_regions(chainshots):
+    """
+    :param chainshots: chainshot dictionaries
+    :return: set of the regions the chainshots' instances ran in
+    """
+    return set(get_region_name(data["instance"]["region"]) for chainshot in chainshots
+               for data in chainshot["instances"] if data.get("instance"))
+
+
+def _is_young(name, prefix, grace_period):
+    """
+    Security group names end with the local time and key names with the epoch time they were made at,
+    see Chainmanager.create_ethermint_network
+    :return: True if the name holds a creation time within the grace period, False if it's older or has none
+    """
+    suffix = name[len(prefix):]
+    try:
+        if prefix == SECURITY_GROUP_NAME_PREFIX:
+            return datetime.now() - datetime.strptime(suffix, "%Y-%m-%d %H:%M:%S.%f") < timedelta(seconds=grace_period)
+        return time.time() - int(suffix.split("_")[0]) < grace_period
+    except ValueError:
+        return False
+
+
+def resources_in_use(client):
+    """
+    The security groups and key pairs of the instances of a region that are still around
+    :return: a tuple (set of security group ids, set of key names)
+    """
+    groups = set()
+    keys = set()
+    reservations = client.describe_instances(Filters=[{
+        'Name': 'instance-state-name', 'Values': ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+    }])["Reservations"]
+    for instance in (instance for reservation in reservations for instance in reservation["Instances"]):
+        groups.update(group["GroupId"] for group in instance.get("SecurityGroups", []))
+        keys.add(instance.get("KeyName"))
+    return groups, keys
+
+
+def _find_region_garbage(region, kept_snapshots, dropped_snapshots, include_orphans, kept_resources, grace_period):
+    """
+    :param kept_resources: a tuple (set of security group names, set of key names) the kept chainshots refer to
+    :param grace_period: resources younger than this are skipped (seconds)
+    :return: a dictionary resource kind -> list of ids (names for key pairs)
+    """
+    client = boto3.session.Session().client('ec2', region_name=region)
+    in_use_groups, in_use_keys = resources_in_use(client)
+    kept_groups, kept_keys = kept_resources
+    cutoff = datetime.now(tz=pytz.UTC) - timedelta(seconds=grace_period)
+
+    snapshots = client.describe_snapshots(OwnerIds=['self'], Filters=[
+        {'Name': 'description', 'Values': [SNAPSHOT_DESCRIPTION]}
+    ])["Snapshots"]
+    volumes = client.describe_volumes(Filters=[
+        {'Name': 'tag:Name', 'Values': [ETHERMINT_VOLUME_NAME]},
+        {'Name': 'status', 'Values': ['available']}
+    ])["Volumes"]
+    groups = client.describe_security_groups()["SecurityGroups"]
+    key_pairs = client.describe_key_pairs()["KeyPairs"]
+
+    # a volume is available between its creation and its attachment, and a snapshot is orphaned until its chainshot
+    # is saved
+    snapshots = [snapshot for snapshot in snapshots if snapshot["StartTime"] < cutoff]
+    volumes = [volume for volume in volumes if volume["CreateTime"] < cutoff]
+    groups = [group for group in groups
+              if not _is_young(group["GroupName"], SECURITY_GROUP_NAME_PREFIX, grace_period)]
+    key_pairs = [key_pair for key_pair in key_pairs
+                 if not _is_young(key_pair["KeyName"], KEY_NAME_PREFIX, grace_period)]
+
+    return {
+        "volumes": [volume["VolumeId"] for volume in volumes],
+        "snapshots": [snapshot["SnapshotId"] for snapshot in snapshots
+                      if snapshot["SnapshotId"] in dropped_snapshots
+                      or (include_orphans and snapshot["SnapshotId"] not in kept_snapshots)],
+        "security_groups": [group["GroupId"] for group in groups
+                            if group["GroupName"].startswith(SECURITY_GROUP_NAME_PREFIX)
+                            and group["GroupId"] not in in_use_groups and group["GroupName"] not in kept_groups],
+        "key_pairs": [key_pair["KeyName"] for key_pair in key_pairs
+                      if key_pair["KeyName"].startswith(KEY_NAME_PREFIX)
+                      and key_pair["KeyName"] not in in_use_keys | kept_keys],
+    }
+
+
+def find_garbage(regions, chainshots=(), keep=None, include_orphans=False, grace_period=GC_GRACE_PERIOD):
+    """
+    Finds the stale ethermint resources, in all of the regions concurrently:
+    detached ethermint volumes, security groups and key pairs of networks which have no instances left,
+    and the snapshots of chainshots dropped by the retention policy
+    :param chainshots: chainshot dictionaries; their snapshots, security groups and key pairs are kept, so that they
+    can be thawed, unless dropped by keep
+    :param keep: how many chainshots to keep per lineage, None to keep them all
+    :param include_orphans: also collect chainshot snapshots that none of the chainshots refer to
+    :param grace_period: resources younger than this are skipped, as a network may still be being created (seconds)
+    :return: a dictionary region -> {resource kind -> list of ids}, or {"error": str} if the region couldn't be read
+    """
+    kept_snapshots, dropped_snapshots = chainshot_snapshots(chainshots, keep)
+    kept_resources = chainshot_resources(chainshots, keep)
+
+    def find(region):
+        try:
+            return _find_region_garbage(region, kept_snapshots, dropped_snapshots, include_orphans,
+                                        kept_resources.get(region, (set(), set())), grace_period)
+        except (ClientError, BotoCoreError) as e:
+            logger.warning("Unable to look for stale resources in region {}: {}".format(region, e))
+            return {"error": str(e)}
+
+    regions = list(regions)
+    return dict(zip(regions, thread_map(find, regions)))
+
+
+def _delete(client, kind, resource_id):
+    if kind == "volumes":
+        client.delete_volume(VolumeId=resource_id)
+    elif kind == "snapshots":
+        client.delete_snapshot(SnapshotId=resource_id)
+    elif kind == "security_groups":
+        client.delete_security_group(GroupId=resource_id)
+    elif kind == "key_pairs":
+        client.delete_key_pair(KeyName=resource_id)
+    else:
+        raise ValueError("Unknown resource kind {}".format(kind))
+
+
+def delete_resources(resources, dry_run=False):
+    """
+    Deletes resources, in all of the regions concurrently; a resource that fails to be deleted doesn't stop the rest
+    :param resources: a dictionary region -> {resource kind -> list of ids}, as returned by find_garbage
+    :param dry_run: only report what would be deleted
+    :return: a dictionary region -> {resource kind -> {"deleted": list of ids, "failed": {id: error}}}
+    """
+    def delete(region_resources):
+        region, kinds = region_resources
+        if "error" in kinds:
+            return kinds
+        client = boto3.session.Session().client('ec2', region_name=region)
+        report = {}
+        for kind in RESOURCE_KINDS:
+            report[kind] = {"deleted": [], "failed": {}}
+            for resource_id in kinds.get(kind, []):
+                if dry_run:
+                    logger.info("Would delete {} {} in {}".format(kind, resource_id, region))
+                    report[kind]["deleted"].append(resource_id)
+                    continue
+                try:
+                    _delete(client, kind, resource_id)
+                    logger.info("Deleted {} {} in {}".format(kind, resource_id, region))
+                    report[kind]["deleted"].append(resource_id)
+                except ClientError as e:
+                    logger.warning("Unable to delete {} {} in {}: {}".format(kind, resource_id, region, e))
+                    report[kind]["failed"][resource_id] = str(e)
+        return report
+
+    items = resources.items()
+    return dict(zip([region for region, _ in items], thread_map(delete, items)))
+
+
+def collect_garbage(regions, chainshots=(), keep=None, include_orphans=False, dry_run=False,
+                    grace_period=GC_GRACE_PERIOD):
+    """
+    Finds and deletes the stale ethermint resources, see find_garbage and delete_resources
+    """
+    return delete_resources(find_garbage(regions, chainshots, keep, include_orphans, grace_period), dry_run)
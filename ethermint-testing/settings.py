@@ -46,3 +46,75 @@ MAX_MACHINE_CALL_TRIES = 5
 
 # how much time difference can there be between multiple nodes for a certain block to consider the nodes as in sync
 DEFAULT_LIVENESS_THRESHOLD = datetime.timedelta(seconds=10)
+
+# how many nodes to query at once when checking the status of a chain
+DEFAULT_STATUS_CONCURRENCY = 20
+
+# how long to wait for a single node to answer an RPC call (seconds)
+DEFAULT_RPC_TIMEOUT = 5
+
+# node RPC calls go through keep-alive connection pools, one pool per node
+RPC_POOL_HOSTS = 100  # how many nodes to keep connection pools for
+RPC_POOL_SIZE = 10  # how many connections to keep open per node
+RPC_RETRIES = 3  # connection errors and 5xx responses are retried ...
+RPC_RETRY_BACKOFF = 0.3  # ... with exponential backoff starting at this many seconds
+RPC_CONNECT_TIMEOUT = 3  # seconds; the read timeout is DEFAULT_RPC_TIMEOUT
+
+# how often the monitor command polls the nodes (seconds)
+MONITOR_INTERVAL = 5
+
+# the width of the buckets of the block propagation and block time histograms (milliseconds)
+BLOCK_EVENTS_BUCKET_MS = 50
+
+# how many JSON-RPC calls to pack into a single batch request
+RPC_BATCH_SIZE = 100
+
+# tendermint returns at most this many blocks from a single /blockchain call
+BLOCKCHAIN_PAGE_SIZE = 20
+
+# the local index of block metadata used by history queries
+DEFAULT_BLOCK_INDEX_FILE = os.path.join(DEFAULT_FILES_LOCATION, "block_index.sqlite")
+
+# how many nodes to run SSH/SCP commands on at once
+DEFAULT_SSH_CONCURRENCY = 10
+
+# how many times to try preparing a node for ethermint before giving up on the network
+NODE_PREPARATION_TRIES = 3
+
+# SSH connections to a node are multiplexed: the first one becomes a master connection that later ones reuse
+# %C is a hash of the local host, remote host, port and user, so the control path is unique per connection and
+# short enough for a unix socket path, with the random suffix ssh appends to it
+SSH_CONTROL_PATH = "/tmp/ethermint-ssh-%C"
+SSH_CONTROL_PERSIST = 300  # seconds an idle master connection is kept open
+
+# failed SSH calls are retried with exponential backoff and jitter
+SSH_RETRY_BASE_DELAY = 1  # seconds
+SSH_RETRY_MAX_DELAY = 30  # seconds
+
+# the local registry of Ethermint AMIs, by ethermint version and region, saved in DEFAULT_FILES_LOCATION
+AMI_REGISTRY_FILE_NAME = "ami_registry.json"
+AMI_REGISTRY_TTL = 24 * 60 * 60  # seconds after which a registered AMI is looked up in AWS again
+
+# the cached descriptions of the chain's instances (IP addresses, key names, tags...) are refreshed after this long
+INSTANCE_DESCRIPTION_TTL = 5 * 60  # seconds
+
+# polling of EC2 for instances and volumes to become ready; the interval doubles while nothing changes
+WAIT_MIN_INTERVAL = 1  # seconds
+WAIT_MAX_INTERVAL = 15  # seconds
+WAIT_TIMEOUT = 600  # seconds
+
+# in a pipelined launch, the nodes wait this long for the seed node to be launched, prepared and started (seconds)
+SEED_START_TIMEOUT = 1200
+
+# rolling chainshots wait this long for each batch of restarted nodes to catch up with the network (seconds)
+ROLLING_CATCH_UP_TIMEOUT = 300
+# how many blocks behind the nodes which stayed up a restarted batch may be to count as caught up
+ROLLING_CATCH_UP_TOLERANCE = 1
+
+# names of the AWS resources made for ethermint networks, which the garbage collection looks for
+ETHERMINT_VOLUME_NAME = "ethermint_volume"  # the Name tag of the volumes attached to the nodes
+SNAPSHOT_DESCRIPTION = "ethermint-backup"  # the description of chainshot snapshots
+SECURITY_GROUP_NAME_PREFIX = "ethermint-security_group-salt-ssh-"
+KEY_NAME_PREFIX = "salt-instance-"
+# resources younger than this may belong to a network which is still being created, so they aren't collected (seconds)
+GC_GRACE_PERIOD = 3600
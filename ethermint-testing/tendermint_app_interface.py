@@ -1,9 +1,20 @@
+import itertools
 import json
+import logging
+import threading
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 import dateutil
 import pytz
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from settings import RPC_POOL_HOSTS, RPC_POOL_SIZE, RPC_RETRIES, RPC_RETRY_BACKOFF, RPC_CONNECT_TIMEOUT, \
+    DEFAULT_RPC_TIMEOUT, RPC_BATCH_SIZE, BLOCKCHAIN_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
 
 
 class EthermintException(Exception):
@@ -36,72 +47,227 @@ class GethBlock:
         self.time = datetime.fromtimestamp(int(data["timestamp"], 16), tz=pytz.UTC)
 
 
+class RPCConnectionPool(object):
+    """
+    A keep-alive HTTP session shared by all of the RPC calls, holding a pool of connections for every node
+    Connection errors and 5xx responses are retried with exponential backoff, unless a call asks not to be, like
+    the status checks, which retrying would stretch well beyond their timeout
+    """
+
+    def __init__(self, hosts=RPC_POOL_HOSTS, connections_per_host=RPC_POOL_SIZE, retries=RPC_RETRIES,
+                 backoff=RPC_RETRY_BACKOFF, connect_timeout=RPC_CONNECT_TIMEOUT, read_timeout=DEFAULT_RPC_TIMEOUT):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        # JSON-RPC calls we make are all reads, so it's safe to retry POSTs too
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[500, 502, 503, 504],
+                      method_whitelist=False)
+        self.adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=connections_per_host, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.no_retry_adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=connections_per_host, max_retries=0)
+        self.no_retry_session = requests.Session()
+        self.no_retry_session.mount("http://", self.no_retry_adapter)
+
+        self._lock = threading.Lock()
+        self.requests_count = 0
+
+    def _timeout(self, timeout):
+        if timeout is None:
+            return self.connect_timeout, self.read_timeout
+        return min(self.connect_timeout, timeout), timeout
+
+    def request(self, method, url, timeout=None, retries=True, **kwargs):
+        """
+        :param timeout: the read timeout in seconds, None for the pool's default
+        :param retries: whether to retry connection errors and 5xx responses
+        :return: requests.Response
+        """
+        with self._lock:
+            self.requests_count += 1
+        session = self.session if retries else self.no_retry_session
+        return session.request(method, url, timeout=self._timeout(timeout), **kwargs)
+
+    def get(self, url, timeout=None, retries=True, **kwargs):
+        return self.request("GET", url, timeout, retries, **kwargs)
+
+    def post(self, url, timeout=None, retries=True, **kwargs):
+        return self.request("POST", url, timeout, retries, **kwargs)
+
+    def stats(self):
+        """
+        Connection reuse counters; every request which didn't need a new connection reused a kept-alive one
+        NOTE: only nodes which still have a pool are counted, see RPC_POOL_HOSTS
+        :return: dict
+        """
+        pools = [adapter.poolmanager.pools[key] for adapter in [self.adapter, self.no_retry_adapter]
+                 for key in adapter.poolmanager.pools.keys()]
+        connections = sum(pool.num_connections for pool in pools)
+        http_requests = sum(pool.num_requests for pool in pools)
+        return {
+            "requests": self.requests_count,
+            "connections": connections,
+            "reused": max(http_requests - connections, 0)
+        }
+
+
+rpc_connection_pool = RPCConnectionPool()
+
+
 class TendermintAppInterface:
     @staticmethod
     def prepare_rpc_result(raw):
         return raw.json()['result'][1]
 
     @staticmethod
-    def get_latest_block(ec2_instance):
+    def get_latest_block(ec2_instance, timeout=None, retries=True):
         """
         NOTE: this had a versions allowing to specify block in 6de9c6269c09c252f32b1b2f970e631aa1d2c3ba
+        :param timeout: seconds to wait for the node, None for the default
+        :param retries: whether to retry failed calls, see RPCConnectionPool
         """
-        raw = requests.get(TendermintAppInterface.rpc(ec2_instance.public_ip_address) + "/status")
+        raw = rpc_connection_pool.get(TendermintAppInterface.rpc(ec2_instance.public_ip_address) + "/status",
+                                      timeout=timeout, retries=retries)
         r = TendermintAppInterface.prepare_rpc_result(raw)
         return TendermintBlock(r)
 
     @staticmethod
     def get_blocks(ec2_instance, fromm, to):
+        """
+        A single /blockchain call; the node returns at most BLOCKCHAIN_PAGE_SIZE blocks, see iter_blocks
+        :return: list, highest block first
+        """
         request_template = "{}/blockchain?minHeight={}&maxHeight={}"
-        raw = requests.get(request_template.format(TendermintAppInterface.rpc(ec2_instance.public_ip_address),
-                                                   fromm,
-                                                   to))
+        raw = rpc_connection_pool.get(request_template.format(
+            TendermintAppInterface.rpc(ec2_instance.public_ip_address), fromm, to))
         r = TendermintAppInterface.prepare_rpc_result(raw)['block_metas']
 
         return [TendermintBlock(block_meta) for block_meta in r]
 
+    @staticmethod
+    def iter_blocks(ec2_instance, fromm, to, page_size=BLOCKCHAIN_PAGE_SIZE):
+        """
+        Generates blocks from fromm to to (inclusive), lowest first, fetching them page by page,
+        so that arbitrarily long ranges can be walked in constant memory.
+        The next page is fetched in the background while the current one is being consumed
+        """
+        def fetch(low):
+            # the node caps a response, keeping the highest blocks, so a short page is completed from below
+            page = []
+            high = min(low + page_size - 1, to)
+            count = high - low + 1
+            while True:
+                blocks = TendermintAppInterface.get_blocks(ec2_instance, low, high)
+                if not blocks:
+                    raise EthermintException("Instance {} returned no blocks for heights {}-{}".format(
+                        ec2_instance.id, low, high))
+                page.extend(blocks)
+                if len(page) >= count:
+                    return page
+                high = min(block.height for block in blocks) - 1
+                if high < low:
+                    logger.warning("Instance {} returned {} blocks for the {} heights from {}".format(
+                        ec2_instance.id, len(page), count, low))
+                    return page
+
+        pool = ThreadPool(1)
+        try:
+            low = fromm
+            next_page = pool.apply_async(fetch, (low,)) if low <= to else None
+            while next_page is not None:
+                page = next_page.get()
+                low += page_size
+                next_page = pool.apply_async(fetch, (low,)) if low <= to else None
+                for block in reversed(page):
+                    yield block
+        finally:
+            pool.close()
+            pool.join()
 
     @staticmethod
     def rpc(ip):
         return "http://{}:46657".format(ip)
 
+    @staticmethod
+    def websocket(ip):
+        return "ws://{}:46657/websocket".format(ip)
+
 
 class EthermintInterface(object, TendermintAppInterface):
-    request_id = 0
+    request_ids = itertools.count()  # next() on a count is atomic, so ids are unique across threads
 
     @staticmethod
     def _get_request_id():
-        current_id = EthermintInterface.request_id
-        EthermintInterface.request_id += 1
-        return current_id
+        return next(EthermintInterface.request_ids)
 
     @staticmethod
-    def _request(ec2_instance, method, params=None):
+    def _request(ec2_instance, method, params=None, timeout=None, retries=True):
         data = json.dumps({"jsonrpc": "2.0", "method": method, "params": params or [],
                            "id": EthermintInterface._get_request_id()})
-        response = requests.post(EthermintInterface.rpc(ec2_instance.public_ip_address), data=data)
+        response = rpc_connection_pool.post(EthermintInterface.rpc(ec2_instance.public_ip_address), data=data,
+                                            timeout=timeout, retries=retries)
         return response.json()
 
+    @staticmethod
+    def _batch_request(ec2_instance, calls, batch_size=RPC_BATCH_SIZE, timeout=None):
+        """
+        Sends many calls as JSON-RPC 2.0 batches, so that there is one HTTP request per batch_size calls
+        :param calls: a list of (method, params) tuples
+        :param batch_size: the maximum number of calls in a single batch
+        :return: a list of responses, in the order of calls; responses are matched to calls by id
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive, got {}".format(batch_size))
+
+        responses = []
+        for start in xrange(0, len(calls), batch_size):
+            batch = [{"jsonrpc": "2.0", "method": method, "params": params or [],
+                      "id": EthermintInterface._get_request_id()}
+                     for method, params in calls[start:start + batch_size]]
+            raw = rpc_connection_pool.post(EthermintInterface.rpc(ec2_instance.public_ip_address),
+                                           data=json.dumps(batch), timeout=timeout)
+            result = raw.json()
+            if not isinstance(result, list):
+                raise EthermintException("Batch request to instance {} failed: {}".format(ec2_instance.id, result))
+
+            by_id = dict((response.get("id"), response) for response in result)
+            for request in batch:
+                if request["id"] not in by_id:
+                    raise EthermintException("No response to {} (id {}) from instance {}".format(
+                        request["method"], request["id"], ec2_instance.id))
+                responses.append(by_id[request["id"]])
+        return responses
+
     @staticmethod
     def rpc(ip):
         return "http://{}:8545".format(ip)
 
     @staticmethod
-    def get_latest_block(ec2_instance):
+    def _check_in_sync(ec2_instance, tendermint_block, ethereum_block):
+        """
+        A tendermint block at height H holds the app hash after the geth block at height H - 1
+        """
+        if ethereum_block.height + 1 != tendermint_block.height:
+            raise EthermintException("Geth/tendermint not in sync in instance {} (height)".format(ec2_instance.id))
+        if ethereum_block.hash != tendermint_block.hash:
+            raise EthermintException("Geth/tendermint not in sync in instance {} (hash)".format(ec2_instance.id))
+
+    @staticmethod
+    def get_latest_block(ec2_instance, timeout=None, retries=True):
         """
         Note that this checks block integrity between TM and ETH, while get_blocks doesn't
-        :param block: None for latest
+        :param timeout: seconds to wait for each of the RPC calls, None for the default
+        :param retries: whether to retry failed calls, see RPCConnectionPool
         """
-        tendermint_latest_block = super(EthermintInterface, EthermintInterface).get_latest_block(ec2_instance)
+        tendermint_latest_block = super(EthermintInterface, EthermintInterface).get_latest_block(
+            ec2_instance, timeout, retries)
         ethermint_height = tendermint_latest_block.height - 1
 
-        r = EthermintInterface._request(ec2_instance, "eth_getBlockByNumber", [str(ethermint_height), False])['result']
+        r = EthermintInterface._request(ec2_instance, "eth_getBlockByNumber", [str(ethermint_height), False],
+                                        timeout=timeout, retries=retries)['result']
         last_ethereum_block = GethBlock(r)
 
-        if last_ethereum_block.height + 1 != tendermint_latest_block.height:
-            raise EthermintException("Geth/tendermint not in sync in instance {} (height)".format(ec2_instance.id))
-        if last_ethereum_block.hash != tendermint_latest_block.hash:
-            raise EthermintException("Geth/tendermint not in sync in instance {} (hash)".format(ec2_instance.id))
+        EthermintInterface._check_in_sync(ec2_instance, tendermint_latest_block, last_ethereum_block)
         return tendermint_latest_block
 
     @staticmethod
@@ -111,3 +277,21 @@ class EthermintInterface(object, TendermintAppInterface):
         :return: list
         """
         return super(EthermintInterface, EthermintInterface).get_blocks(ec2_instance, fromm, to)
+
+    @staticmethod
+    def check_blocks(ec2_instance, fromm, to, batch_size=RPC_BATCH_SIZE, timeout=None):
+        """
+        Checks TM-ETH integrity of all the blocks between fromm and to (inclusive);
+        geth blocks are fetched in batches, so this takes about (to - fromm) / batch_size round trips
+        :return: list of the checked TendermintBlocks
+        """
+        tendermint_blocks = list(EthermintInterface.iter_blocks(ec2_instance, fromm, to))
+        calls = [("eth_getBlockByNumber", [str(block.height - 1), False]) for block in tendermint_blocks]
+        responses = EthermintInterface._batch_request(ec2_instance, calls, batch_size, timeout)
+
+        for tendermint_block, response in zip(tendermint_blocks, responses):
+            if response.get("result") is None:
+                raise EthermintException("Geth block {} missing in instance {}: {}".format(
+                    tendermint_block.height - 1, ec2_instance.id, response.get("error")))
+            EthermintInterface._check_in_sync(ec2_instance, tendermint_block, GethBlock(response["result"]))
+        return tendermint_blocks
@@ -1,5 +1,6 @@
 import subprocess
 import shutil
+import threading
 from os.path import join, dirname
 import os
 
@@ -8,6 +9,7 @@ import pytest
 import responses
 from mock import MagicMock
 from moto import mock_ec2
+from moto.packages.responses.responses import RequestsMock
 
 from chainmanager import Chainmanager
 import fill_validators
@@ -23,7 +25,17 @@ def mockami():
 
 
 @pytest.fixture()
-def moto():
+def moto(monkeypatch):
+    # moto's backends aren't thread-safe, while launches, waits and status checks call AWS from many threads;
+    # the mocked requests are handled one at a time, so that the tests don't depend on the threads' timing
+    lock = threading.RLock()
+    on_request = RequestsMock._on_request
+
+    def locked_on_request(*args, **kwargs):
+        with lock:
+            return on_request(*args, **kwargs)
+
+    monkeypatch.setattr(RequestsMock, '_on_request', locked_on_request)
     mock_ec2().start()
     yield None
     mock_ec2().stop()
@@ -51,6 +63,8 @@ def mocksubprocess(monkeypatch, ethermint_version):
 
     mock = MagicMock(subprocess.check_output, side_effect=_responses)
     monkeypatch.setattr(subprocess, 'check_output', mock)
+    # the no-op commands which open the SSH master connections
+    monkeypatch.setattr(subprocess, 'check_call', MagicMock(subprocess.check_call, return_value=0))
     return mock
 
 
@@ -128,6 +142,7 @@ def mockregions(regionscount):
 def mockamibuilder(mockami, monkeypatch):
     mock = MagicMock(AMIBuilder)
     mock.create_ami.return_value = mockami
+    mock.create_amis.side_effect = lambda ethermint_version, ami_name, regions: {region: mockami for region in regions}
 
     monkeypatch.setattr('chainmanager.AMIBuilder', MagicMock(return_value=mock))
     return mock
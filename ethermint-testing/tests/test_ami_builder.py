@@ -35,6 +35,25 @@ def amibuilder(monkeypatch, mockpacker, tmp_files_dir, mock_aws_credentials):
 
 def test_ami_creation(amibuilder):
     ami_name = "test_ami"
-    amibuilder.create_ami("abcdabcdabcdabcdabcdabcdabcdabcd", ami_name)
+    assert amibuilder.create_ami("abcdabcdabcdabcdabcdabcdabcdabcd", ami_name) == "ami-10d50c06"
     amibuilder.packer.validate.assert_called_once()
     amibuilder.packer.build.assert_called_once()
+
+
+def test_ami_creation_copies_to_regions(amibuilder):
+    amibuilder.packer.build.return_value.stdout = """
+    ==> amazon-ebs: Copying AMI (ami-10d50c06) to other regions...
+    Build 'amazon-ebs' finished.
+
+    ==> Builds finished. The artifacts of successful builds are:
+    --> amazon-ebs: AMIs were created:
+    eu-central-1: ami-7c412f13
+    us-gov-west-1: ami-0fd4f3ba48b0e1d1c
+    us-west-1: ami-10d50c06
+    """
+    amis = amibuilder.create_amis("abcdabcdabcdabcdabcdabcdabcdabcd", "test_ami",
+                                  ["us-west-1", "eu-central-1", "us-gov-west-1"])
+
+    amibuilder.packer.build.assert_called_once()
+    assert amis == {"us-west-1": "ami-10d50c06", "eu-central-1": "ami-7c412f13",
+                    "us-gov-west-1": "ami-0fd4f3ba48b0e1d1c"}
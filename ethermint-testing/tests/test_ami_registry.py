@@ -0,0 +1,84 @@
+import json
+import os
+import time
+
+import pytest
+from mock import MagicMock
+
+import ami_registry
+from ami_registry import AMIRegistry
+
+VERSION = "01230123012301230123012301230123"
+
+
+@pytest.fixture()
+def registry_path(tmpdir):
+    return os.path.join(str(tmpdir), "files", "ami_registry.json")
+
+
+@pytest.fixture()
+def mock_find_images(monkeypatch):
+    mock = MagicMock(side_effect=lambda version, region: ["ami-{}".format(len(region))])
+    monkeypatch.setattr(ami_registry, 'find_images', mock)
+    return mock
+
+
+def test_registry_saves_and_loads(registry_path):
+    registry = AMIRegistry(registry_path)
+    registry.add(VERSION, "us-west-1", "ami-12345678")
+    registry.save()
+
+    assert AMIRegistry(registry_path).get(VERSION, "us-west-1") == "ami-12345678"
+    assert AMIRegistry(registry_path).get(VERSION, "eu-central-1") is None
+    assert AMIRegistry(registry_path).get("otherversion", "us-west-1") is None
+
+
+def test_registry_ttl(registry_path):
+    registry = AMIRegistry(registry_path, ttl=60)
+    registry.add(VERSION, "us-west-1", "ami-12345678")
+    registry.entries[VERSION]["us-west-1"]["updated"] = time.time() - 61
+
+    assert registry.get(VERSION, "us-west-1") is None
+
+
+def test_registry_ignores_malformed_entries(registry_path):
+    os.makedirs(os.path.dirname(registry_path))
+    with open(registry_path, 'w') as f:
+        json.dump({VERSION: {"us-west-1": {"ami": "ami-12345678", "updated": time.time()},
+                             "eu-central-1": {"ami": "not-an-ami", "updated": time.time()},
+                             "ap-northeast-1": {"ami": "ami-12345678"}},
+                   "otherversion": "garbage"}, f)
+
+    registry = AMIRegistry(registry_path)
+    assert registry.entries.keys() == [VERSION]
+    assert registry.entries[VERSION].keys() == ["us-west-1"]
+
+    with open(registry_path, 'w') as f:
+        f.write("{truncated")
+    assert AMIRegistry(registry_path).entries == {}
+
+    with pytest.raises(ValueError):
+        registry.add(VERSION, "us-west-1", "not-an-ami")
+
+
+def test_registry_looks_up_only_stale_regions(registry_path, mock_find_images):
+    registry = AMIRegistry(registry_path)
+    registry.add(VERSION, "us-west-1", "ami-12345678")
+
+    amis = registry.lookup(VERSION, ["us-west-1", "eu-central-1", "ap-northeast-1"])
+
+    assert amis == {"us-west-1": "ami-12345678", "eu-central-1": "ami-12", "ap-northeast-1": "ami-14"}
+    assert sorted(call[0][1] for call in mock_find_images.call_args_list) == ["ap-northeast-1", "eu-central-1"]
+
+    mock_find_images.reset_mock()
+    registry.lookup(VERSION, ["us-west-1", "eu-central-1", "ap-northeast-1"])
+    mock_find_images.assert_not_called()
+
+
+def test_registry_refresh_drops_missing_amis(registry_path, monkeypatch):
+    monkeypatch.setattr(ami_registry, 'find_images', MagicMock(return_value=[]))
+    registry = AMIRegistry(registry_path)
+    registry.add(VERSION, "us-west-1", "ami-12345678")
+
+    assert registry.refresh(VERSION, ["us-west-1"]) == {"us-west-1": []}
+    assert registry.get(VERSION, "us-west-1") is None
@@ -0,0 +1,99 @@
+import json
+import socket
+import time
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+import websocket
+from mock import MagicMock
+
+from block_events import NewBlockSubscriber, histogram, _find_header
+from chain import Chain
+
+START = datetime(2017, 4, 1, tzinfo=pytz.UTC)
+
+
+def header(height):
+    return {"height": height, "time": (START + timedelta(seconds=height)).isoformat(), "app_hash": "hash"}
+
+
+def new_block_event(height):
+    return json.dumps({"jsonrpc": "2.0", "id": "#event",
+                       "result": [0, {"name": "NewBlock", "data": [1, {"block": {"header": header(height)}}]}]})
+
+
+class FakeConnection(object):
+    """
+    Hands out the messages, then times out like an idle websocket
+    """
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.sent = []
+        self.closed = False
+
+    def send(self, message):
+        self.sent.append(json.loads(message))
+
+    def recv(self):
+        if self.messages:
+            return self.messages.pop(0)
+        time.sleep(0.01)
+        raise websocket.WebSocketTimeoutException("timed out")
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture()
+def chain():
+    return Chain([MagicMock(id="i-{}".format(i), public_ip_address="10.0.0.{}".format(i)) for i in range(3)])
+
+
+def test_find_header():
+    assert _find_header(json.loads(new_block_event(7))["result"]) == header(7)
+    assert _find_header([0, {}]) is None
+
+
+def test_histogram():
+    assert histogram([0, 12, 49, 50, 130], 50) == [[0, 3], [50, 1], [100, 1]]
+
+
+def test_report(chain):
+    subscriber = NewBlockSubscriber(chain)
+    for height in [1, 2, 3]:
+        for i, delay in enumerate([0, 0.02, 0.07]):
+            subscriber._record("i-{}".format(i), header(height), 1000 + height + delay)
+    subscriber._record("i-0", header(5), 1005)
+
+    report = subscriber.report(bucket_ms=50)
+
+    assert report["blocks"] == 4
+    assert report["nodes"]["i-0"] == {"blocks": 4, "delays_ms": [[0, 4]]}
+    assert report["nodes"]["i-1"] == {"blocks": 3, "delays_ms": [[0, 3]]}
+    assert report["nodes"]["i-2"] == {"blocks": 3, "delays_ms": [[50, 3]]}
+    # heights 3 and 5 aren't consecutive
+    assert report["block_times_ms"] == [[1000, 2]]
+
+
+def test_run_follows_all_nodes(chain, monkeypatch):
+    connections = {}
+
+    def create_connection(url, timeout):
+        if "10.0.0.2" in url:
+            raise socket.error("Connection refused")
+        connections[url] = FakeConnection([new_block_event(height) for height in [4, 5]])
+        return connections[url]
+    monkeypatch.setattr(websocket, "create_connection", create_connection)
+
+    subscriber = NewBlockSubscriber(chain)
+    subscriber.run(duration=0.2)
+
+    assert sorted(connections.keys()) == ["ws://10.0.0.0:46657/websocket", "ws://10.0.0.1:46657/websocket"]
+    for connection in connections.values():
+        assert connection.sent[0]["method"] == "subscribe" and connection.sent[0]["params"] == ["NewBlock"]
+        assert connection.closed
+    assert sorted(subscriber.arrivals.keys()) == [4, 5]
+    assert sorted(subscriber.arrivals[4].keys()) == ["i-0", "i-1"]
+    assert subscriber.errors.keys() == ["i-2"]
+    assert subscriber.report()["block_times_ms"] == [[1000, 1]]
@@ -0,0 +1,84 @@
+import os
+import re
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+from mock import MagicMock
+
+from block_index import BlockIndex
+from chain import Chain
+from chainmanager import Chainmanager
+from tendermint_app_interface import TendermintBlock
+
+IP = "10.0.0.1"
+START = datetime(2017, 4, 1, tzinfo=pytz.UTC)
+
+
+def block(height):
+    return TendermintBlock({"header": {"app_hash": "hash{}".format(height), "height": height,
+                                       "time": (START + timedelta(seconds=height)).isoformat()}})
+
+
+@pytest.fixture()
+def block_index(tmpdir):
+    with BlockIndex(os.path.join(str(tmpdir), "index", "blocks.sqlite")) as index:
+        yield index
+
+
+def test_block_index_closes(tmpdir):
+    with BlockIndex(os.path.join(str(tmpdir), "blocks.sqlite")) as index:
+        index.add_blocks("chain", [block(1)])
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        list(index.iter_range("chain", 1, 1))
+
+
+def test_block_index_range(block_index):
+    block_index.add_blocks("chain", [block(h) for h in [3, 1, 2, 7]])
+    block_index.add_blocks("other", [block(5)])
+
+    assert [b.height for b in block_index.iter_range("chain", 2, 10)] == [2, 3, 7]
+    indexed = list(block_index.iter_range("chain", 7, 7))[0]
+    assert indexed.hash == "HASH7"
+    assert indexed.time == block(7).time
+
+
+def test_block_index_missing_ranges(block_index):
+    block_index.add_blocks("chain", [block(h) for h in [3, 4, 7, 10]])
+
+    assert block_index.missing_ranges("chain", 1, 12) == [(1, 2), (5, 6), (8, 9), (11, 12)]
+    assert block_index.missing_ranges("chain", 3, 4) == []
+    assert block_index.missing_ranges("other", 3, 4) == [(3, 4)]
+
+
+def test_index_blocks_stores_on_the_way(block_index):
+    blocks = block_index.index_blocks("chain", (block(h) for h in range(1, 6)), chunk_size=2)
+    assert next(blocks).height == 1
+    assert next(blocks).height == 2
+    blocks.close()
+
+    assert [b.height for b in block_index.iter_range("chain", 1, 5)] == [1, 2]
+
+
+def test_history_fetches_only_missing_blocks(block_index, requests_mock):
+    metas = [{"header": {"app_hash": b.hash, "height": b.height, "time": b.time}}
+             for b in reversed(map(block, range(21, 41)))]
+    requests_mock.add(requests_mock.GET, re.compile(r'http://' + IP + r':46657/blockchain\?minHeight=21\&maxHeight=40'),
+                      json={"result": [0, {"block_metas": metas}]}, status=200)
+
+    block_index.add_blocks("test", [block(h) for h in range(1, 21)])
+    pair = MagicMock(id="i-12345678", public_ip_address=IP)
+    chain = Chain([pair], name="test", chain_type="tendermint")
+
+    history = Chainmanager.get_history(chain, 1, 40, block_index=block_index)
+
+    assert len(requests_mock.calls) == 1
+    assert [entry[2] for entry in history] == range(2, 41)
+    assert all(entry[0] == 1 for entry in history)
+    assert block_index.missing_ranges("test", 1, 40) == []
+
+    # everything is indexed now, so the node isn't asked again
+    assert Chainmanager.get_history(chain, 1, 40, block_index=block_index) == history
+    assert len(requests_mock.calls) == 1
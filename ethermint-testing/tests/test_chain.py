@@ -0,0 +1,138 @@
+import json
+import pickle
+from datetime import datetime
+
+import boto3
+import pytest
+import pytz
+from mock import MagicMock
+
+import chain as chain_module
+from chain import Chain, RegionInstancePair
+
+
+def description(instance_id, ip):
+    return {"InstanceId": instance_id, "PublicIpAddress": ip, "KeyName": "key",
+            "Tags": [{"Key": "Name", "Value": "node-" + instance_id}],
+            "Placement": {"AvailabilityZone": "us-west-1a"}}
+
+
+@pytest.fixture()
+def mock_ec2(monkeypatch):
+    """
+    An EC2 resource per region, which describes the instances it is asked for
+    """
+    resources = {}
+
+    def describe_instances(InstanceIds):
+        return {"Reservations": [{"Instances": [description(instance_id, "10.0.0.{}".format(i))
+                                                for i, instance_id in enumerate(InstanceIds)]}]}
+
+    def get_ec2(region_name):
+        if region_name not in resources:
+            resources[region_name] = MagicMock()
+            resources[region_name].meta.client.describe_instances.side_effect = describe_instances
+        return resources[region_name]
+
+    monkeypatch.setattr(chain_module, "get_ec2", get_ec2)
+    return get_ec2
+
+
+def test_describe_all_once_per_region(mock_ec2):
+    pairs = [RegionInstancePair(region, instance_id) for region, instance_id in
+             [("us-west-1", "i-1"), ("eu-central-1", "i-2"), ("us-west-1", "i-3")]]
+
+    RegionInstancePair.describe_all(pairs)
+    assert [pair.public_ip_address for pair in pairs] == ["10.0.0.0", "10.0.0.0", "10.0.0.1"]
+    assert [pair.instance_name for pair in pairs] == ["node-i-1", "node-i-2", "node-i-3"]
+    assert pairs[0].key_name == "key"
+
+    mock_ec2("us-west-1").meta.client.describe_instances.assert_called_once_with(InstanceIds=["i-1", "i-3"])
+    mock_ec2("eu-central-1").meta.client.describe_instances.assert_called_once_with(InstanceIds=["i-2"])
+
+    # only stale descriptions are described again, unless forced
+    RegionInstancePair.describe_all(pairs)
+    assert mock_ec2("us-west-1").meta.client.describe_instances.call_count == 1
+    pairs[0].refresh()
+    assert mock_ec2("us-west-1").meta.client.describe_instances.call_count == 2
+
+
+def test_description_ttl(mock_ec2, monkeypatch):
+    pair = RegionInstancePair("us-west-1", "i-1", description=description("i-1", "10.0.0.9"))
+    client = mock_ec2("us-west-1").meta.client
+
+    assert pair.public_ip_address == "10.0.0.9"
+    assert client.describe_instances.call_count == 0
+
+    monkeypatch.setattr(RegionInstancePair, "ttl", 0)
+    pair._described_at -= 1
+    assert pair.public_ip_address == "10.0.0.0"
+    assert client.describe_instances.call_count == 1
+
+
+def test_pickle_keeps_description(mock_ec2):
+    pair = RegionInstancePair("us-west-1", "i-1", description=description("i-1", "10.0.0.9"))
+
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        unpickled = pickle.loads(pickle.dumps(pair, protocol))
+        assert (unpickled.region_name, unpickled.id) == ("us-west-1", "i-1")
+        assert unpickled.public_ip_address == "10.0.0.9"
+    assert mock_ec2("us-west-1").meta.client.describe_instances.call_count == 0
+
+
+def test_from_boto_and_serialization(moto, mockami):
+    ec2 = boto3.resource('ec2', region_name="us-west-1")
+    instance = ec2.create_instances(ImageId=mockami, MinCount=1, MaxCount=1, KeyName="key")[0]
+    instance.load()
+
+    chain = Chain([RegionInstancePair.from_boto(instance)], name="test")
+    assert chain.instances[0].public_ip_address == instance.public_ip_address
+    data = chain.serialize()
+    assert data["instances"] == [{"instance": {"id": instance.id, "region": "us-west-1", "key_name": "key"}}]
+
+    deserialized = Chain.deserialize(data).instances[0]
+    assert deserialized.image_id == mockami
+    assert deserialized.instance.public_ip_address == instance.public_ip_address
+    assert deserialized.instance_name == "Node_" + instance.id
+
+
+def test_hydrate(mock_ec2):
+    regions = ["us-west-1", "eu-central-1", "ap-northeast-1"]
+    data = {"instances": [{"instance": {"id": "i-{}".format(i), "region": regions[i % 3]}} for i in range(9)]}
+
+    chain = Chain.deserialize(data).hydrate()
+
+    for region in regions:
+        assert mock_ec2(region).meta.client.describe_instances.call_count == 1
+    assert all(instance.key_name == "key" for instance in chain.instances)
+    assert [instance.instance_name for instance in chain.instances] == ["node-i-{}".format(i) for i in range(9)]
+
+    chain.hydrate()
+    assert all(mock_ec2(region).meta.client.describe_instances.call_count == 1 for region in regions)
+    chain.hydrate(force=True)
+    assert all(mock_ec2(region).meta.client.describe_instances.call_count == 2 for region in regions)
+
+
+def test_offline_metadata(mock_ec2, monkeypatch):
+    described = Chain([RegionInstancePair("us-west-1", "i-1", description=dict(
+        description("i-1", "10.0.0.9"), LaunchTime=datetime(2017, 4, 1, tzinfo=pytz.UTC)))], name="test")
+    data = json.loads(json.dumps(described.serialize(metadata=True)))
+    assert data["instances"][0]["instance"] == {"id": "i-1", "region": "us-west-1", "key_name": "key",
+                                                "public_ip_address": "10.0.0.9", "name": "node-i-1",
+                                                "availability_zone": "us-west-1a",
+                                                "launch_time": "2017-04-01T00:00:00+00:00"}
+
+    # offline descriptions don't expire
+    monkeypatch.setattr(RegionInstancePair, "ttl", 0)
+    chain = Chain.deserialize(data).hydrate()
+    pair = chain.instances[0]
+    assert (pair.public_ip_address, pair.key_name, pair.instance_name) == ("10.0.0.9", "key", "node-i-1")
+    assert pair.placement["AvailabilityZone"] == "us-west-1a"
+    assert pair.launch_time == datetime(2017, 4, 1, tzinfo=pytz.UTC)
+    assert mock_ec2("us-west-1").meta.client.describe_instances.call_count == 0
+    monkeypatch.setattr(RegionInstancePair, "ttl", None)
+
+    # whatever the chain file doesn't carry is described
+    assert pair.image_id is None
+    assert mock_ec2("us-west-1").meta.client.describe_instances.call_count == 1
+    assert pair.public_ip_address == "10.0.0.0"
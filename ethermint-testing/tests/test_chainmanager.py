@@ -1,16 +1,19 @@
 import os
 import re
+import subprocess
+import time
 from datetime import datetime, timedelta
 
 import boto3
 import pytest
 import pytz
-from mock.mock import MagicMock
+from mock.mock import MagicMock, patch
 
+import ami_registry
 from chainmanager import Chainmanager, NETWORK_FAULT_PREPARATION_TIME_PER_INSTANCE
 from settings import DEFAULT_DEVICE, DEFAULT_PORTS, DEFAULT_LIVENESS_THRESHOLD
 from tendermint_app_interface import EthermintException
-from utils import get_shh_key_file
+from utils import get_shh_key_file, SSH_OPTIONS
 
 
 @pytest.fixture()
@@ -19,17 +22,19 @@ def create_mock_amis(mockami, mockamibuilder):
     Makes the mockamibuilder pretend to be building amis in regions
     """
 
-    def _create(ethermint_version, ami_name, regions=None):
+    def _create(ethermint_version, ami_name, regions):
+        amis = {}
         for region in regions:
             ec2 = boto3.resource('ec2', region_name=region)
             ec2_client = boto3.client('ec2', region_name=region)
             instance = ec2.create_instances(ImageId=mockami, MinCount=1, MaxCount=1)[0]
             ami = ec2_client.create_image(InstanceId=instance.id, Name=ami_name)
             ec2.Image(ami["ImageId"]).create_tags(Tags=[{'Key': 'Ethermint', "Value": ethermint_version}])
+            amis[region] = ami["ImageId"]
 
-        return mockami
+        return amis
 
-    mockamibuilder.create_ami.side_effect = _create
+    mockamibuilder.create_amis.side_effect = _create
 
 
 def test_creating_ethermint_network(chainmanager, mockami, mockregions, ethermint_version):
@@ -73,46 +78,60 @@ def test_ethermint_network_creates_AMIs(chainmanager, mockregions, mockamibuilde
     compare_ami_name = "test_ethermint{}_ami-ssh".format(ethermint_version[:8])
     chainmanager.create_ethermint_network(mockregions, ethermint_version)
 
-    distinct_regions = set(mockregions)
-    for region in distinct_regions:
-        mockamibuilder.create_ami.assert_any_call(ethermint_version, compare_ami_name, regions=[region])
+    # one build, copied to all the regions
+    mockamibuilder.create_amis.assert_called_once_with(ethermint_version, compare_ami_name,
+                                                       regions=sorted(set(mockregions)))
+
+
+@pytest.mark.parametrize('regionscount', [5])
+def test_ethermint_network_failed_AMI_build(chainmanager, mockregions, mockamibuilder, ethermint_version):
+    mockamibuilder.create_amis.side_effect = lambda ethermint_version, ami_name, regions: {regions[0]: "ami-12345678"}
+
+    with pytest.raises(RuntimeError):
+        chainmanager.create_ethermint_network(mockregions, ethermint_version)
 
 
 @pytest.mark.parametrize('regionscount', [2])
 def test_ethermint_network_uses_existing_AMIs_when_exist(chainmanager, mockregions, mockamibuilder, create_mock_amis,
-                                                         ethermint_version):
+                                                         ethermint_version, monkeypatch):
+    chainmanager.create_ethermint_network(mockregions, ethermint_version)
+    mockamibuilder.create_amis.reset_mock()
+
     chainmanager.create_ethermint_network(mockregions, ethermint_version)
-    mockamibuilder.create_ami.reset_mock()
+    mockamibuilder.create_amis.assert_not_called()
 
+    # AMIs known from the registry aren't looked up in AWS
+    find_images = MagicMock(side_effect=ami_registry.find_images)
+    monkeypatch.setattr(ami_registry, 'find_images', find_images)
     chainmanager.create_ethermint_network(mockregions, ethermint_version)
-    mockamibuilder.create_ami.assert_not_called()
+    find_images.assert_not_called()
 
     chainmanager.create_ethermint_network(mockregions, ethermint_version, no_ami_cache=True)
-    mockamibuilder.create_ami.assert_called()
+    mockamibuilder.create_amis.assert_called()
 
 
 @pytest.mark.parametrize('regionscount', [2])
 def test_ethermint_new_AMIs_for_ethermint_versions(chainmanager, mockregions, mockamibuilder, create_mock_amis,
                                                    ethermint_version, mocksubprocess):
     chainmanager.create_ethermint_network(mockregions, ethermint_version)
-    mockamibuilder.create_ami.reset_mock()
+    mockamibuilder.create_amis.reset_mock()
 
     other_version = "otherohterotherohterotherohter"
     mocksubprocess.side_effect = lambda *args, **kwargs: other_version if "get_ethermint_version.sh" in args[0] else ''
     chainmanager.create_ethermint_network(mockregions, other_version)
-    mockamibuilder.create_ami.assert_called()
+    mockamibuilder.create_amis.assert_called()
 
 
 @pytest.mark.parametrize('regionscount', [2])
 def test_ethermint_network_find_AMI(chainmanager, mockregions, mockamibuilder, create_mock_amis, ethermint_version):
     chainmanager.create_ethermint_network(mockregions, ethermint_version)
-    mockamibuilder.create_ami.reset_mock()
+    mockamibuilder.create_amis.reset_mock()
 
     new_region = "us-gov-west-1"
     mockregions += [new_region]
 
     chainmanager.create_ethermint_network(mockregions, ethermint_version)
-    calls = mockamibuilder.create_ami.call_args_list
+    calls = mockamibuilder.create_amis.call_args_list
     assert len(calls) == 1
     assert calls[0][1]['regions'] == [new_region]
 
@@ -138,7 +157,7 @@ def test_ethermint_network_mounts_volumes(chainmanager, mockregions, mocksubproc
     chain = chainmanager.create_ethermint_network(mockregions, ethermint_version)
 
     for node in chain.instances:
-        mocksubprocess.assert_any_call("ssh -o StrictHostKeyChecking=no -i {0} ubuntu@{1} "
+        mocksubprocess.assert_any_call("ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} "
                                        "'bash -s' < shell_scripts/mount_new_volume.sh".format(
             get_shh_key_file(node.key_name), node.public_ip_address),
             shell=True)
@@ -178,23 +197,51 @@ def test_ethermint_network_prepares_for_ethermint(chainmanager, mockregions, moc
     ethermint_files_location = os.path.join(tmp_files_dir, "ethermint")
 
     for i, node in enumerate(chain.instances):
-        mocksubprocess.assert_any_call("ssh -o StrictHostKeyChecking=no -i {0} ubuntu@{1} "
+        mocksubprocess.assert_any_call("ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} "
                                        "'bash -s' < shell_scripts/prepare_ethermint_env.sh".format(
             get_shh_key_file(node.key_name), node.public_ip_address),
             shell=True)
 
         # make sure files are copied: data folder and priv_validator file
-        mockossystem.assert_any_call("scp -o StrictHostKeyChecking=no -C -i {} -r {} ubuntu@{}:/ethermint".format(
+        mockossystem.assert_any_call("scp " + SSH_OPTIONS + " -C -i {} -r {} ubuntu@{}:/ethermint".format(
             get_shh_key_file(node.key_name), os.path.join(ethermint_files_location, "data"),
             node.public_ip_address))
 
         validator_path = os.path.join(ethermint_files_location, "priv_validator.json.{}".format(i + 1))
         mockossystem.assert_any_call(
-            "scp -o StrictHostKeyChecking=no -C -i {} {} ubuntu@{}:/ethermint/data/priv_validator.json".format(
+            "scp " + SSH_OPTIONS + " -C -i {} {} ubuntu@{}:/ethermint/data/priv_validator.json".format(
                 get_shh_key_file(node.key_name), validator_path,
                 node.public_ip_address))
 
 
+@pytest.mark.parametrize('regionscount', [3])
+def test_ethermint_network_retries_preparation(chainmanager, mockregions, mocksubprocess, mockossystem,
+                                               ethermint_version):
+    failed = []
+
+    def _system(command):
+        # the first validator file upload fails once
+        if "priv_validator.json.1 " in command and not failed:
+            failed.append(command)
+            return 1
+        return 0
+
+    mockossystem.side_effect = _system
+    chainmanager.create_ethermint_network(mockregions, ethermint_version)
+
+    assert len(failed) == 1
+    prepare_calls = [call for call in mocksubprocess.call_args_list if "prepare_ethermint_env.sh" in call[0][0]]
+    assert len(prepare_calls) == len(mockregions) + 1
+
+
+@pytest.mark.parametrize('regionscount', [2])
+def test_ethermint_network_preparation_fails(chainmanager, mockregions, mockossystem, ethermint_version):
+    mockossystem.side_effect = lambda command: 1 if command.startswith("scp") else 0
+
+    with pytest.raises(RuntimeError):
+        chainmanager.create_ethermint_network(mockregions, ethermint_version)
+
+
 @pytest.mark.parametrize('regionscount', [2])
 def test_ethermint_network_runs_ethermint(chainmanager, mockregions, mocksubprocess,
                                           ethermint_version):
@@ -203,18 +250,83 @@ def test_ethermint_network_runs_ethermint(chainmanager, mockregions, mocksubproc
     first = None
     for node in chain.instances:
         if first:
-            mocksubprocess.assert_any_call("ssh -o StrictHostKeyChecking=no -i {0} ubuntu@{1} "
+            mocksubprocess.assert_any_call("ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} "
                                            "'bash -s' < shell_scripts/run_ethermint.sh {2}".format(
                 get_shh_key_file(node.key_name), node.public_ip_address, str(first.public_ip_address) + ":46656"),
                 shell=True)
         else:
-            mocksubprocess.assert_any_call("ssh -o StrictHostKeyChecking=no -i {0} ubuntu@{1} "
+            mocksubprocess.assert_any_call("ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} "
                                            "'bash -s' < shell_scripts/run_ethermint.sh".format(
                 get_shh_key_file(node.key_name), node.public_ip_address),
                 shell=True)
             first = node
 
 
+@pytest.mark.parametrize('regionscount', [4])
+def test_ethermint_network_pipelined(chainmanager, mockregions, mocksubprocess, mockossystem, ethermint_version):
+    chain = chainmanager.create_ethermint_network(mockregions, ethermint_version, pipelined=True)
+
+    commands = [call[0][0] for call in mocksubprocess.call_args_list]
+    seed = chain.instances[0]
+    seed_start = commands.index("ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} 'bash -s' < shell_scripts/run_ethermint.sh"
+                                .format(get_shh_key_file(seed.key_name), seed.public_ip_address))
+    for i, node in enumerate(chain.instances):
+        ssh = "ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} 'bash -s' < ".format(
+            get_shh_key_file(node.key_name), node.public_ip_address)
+        mount = commands.index(ssh + "shell_scripts/mount_new_volume.sh")
+        prepare = commands.index(ssh + "shell_scripts/prepare_ethermint_env.sh")
+        assert mount < prepare
+        validator_path = os.path.join("ethermint", "priv_validator.json.{}".format(i + 1))
+        assert any(validator_path in call[0][0] and node.public_ip_address in call[0][0]
+                   for call in mockossystem.call_args_list)
+        if i > 0:
+            # the other nodes are started only after the seed
+            start = commands.index(ssh + "shell_scripts/run_ethermint.sh {}:46656".format(seed.public_ip_address))
+            assert prepare < start
+            assert seed_start < start
+
+
+@pytest.mark.parametrize('regionscount', [3])
+def test_ethermint_network_pipelined_seed_fails(chainmanager, mockregions, mocksubprocess, ethermint_version):
+    def _responses(command, **kwargs):
+        if str(command).endswith("run_ethermint.sh"):
+            raise subprocess.CalledProcessError(1, command, "")
+        return ""
+
+    mocksubprocess.side_effect = _responses
+    with patch('time.sleep'), pytest.raises(RuntimeError):
+        chainmanager.create_ethermint_network(mockregions, ethermint_version, pipelined=True)
+
+    # no node tries to join a seed that didn't start
+    assert not [call for call in mocksubprocess.call_args_list if ":46656" in call[0][0]]
+
+
+@pytest.mark.parametrize('regionscount', [3])
+def test_ethermint_network_pipelined_seed_not_launched(chainmanager, mockregions, mocksubprocess, ethermint_version,
+                                                       monkeypatch):
+    # the seed's volume can't be mounted, so the seed is never handed over to be brought up
+    def is_seed(ip):
+        instances = [instance for region in set(mockregions)
+                     for reservation in boto3.client('ec2', region_name=region).describe_instances()["Reservations"]
+                     for instance in reservation["Instances"] if instance.get("PublicIpAddress") == ip]
+        return any(tag["Value"].endswith("0") for tag in instances[0].get("Tags", []))
+
+    def _responses(command, **kwargs):
+        if "mount_new_volume.sh" in command and is_seed(command.split("ubuntu@")[1].split(" ")[0]):
+            raise subprocess.CalledProcessError(1, command, "")
+        return ""
+
+    mocksubprocess.side_effect = _responses
+    monkeypatch.setattr("chainmanager.SEED_START_TIMEOUT", 60)
+    start = time.time()
+    with patch('time.sleep'), pytest.raises(IOError):
+        chainmanager.create_ethermint_network(mockregions, ethermint_version, pipelined=True)
+
+    # the other nodes gave up on the seed rather than waiting for it
+    assert time.time() - start < 60
+    assert not [call for call in mocksubprocess.call_args_list if ":46656" in call[0][0]]
+
+
 @pytest.fixture()
 def chain(chainmanager, mockregions, ethermint_version):
     return chainmanager.create_ethermint_network(mockregions, ethermint_version)
@@ -285,6 +397,51 @@ def test_get_status_one_dead(chainmanager, chain, mock_ethermint_requests):
     assert len(filter(lambda instance: not instance['is_alive'], result['nodes'])) == 1
 
 
+@pytest.mark.parametrize('regionscount', [3])
+def test_get_status_unreachable_node(chainmanager, chain, mock_ethermint_requests):
+    # no responses are mocked for the zeroth node, so it can't be reached
+    mock_ethermint_requests(123, datetime.now(tz=pytz.UTC), "hash",
+                            [inst.public_ip_address for inst in chain.instances[1:]])
+
+    result = chainmanager.get_status(chain, concurrency=2, timeout=1)
+    assert not result["is_alive"]
+    assert result["height"] == 123
+    assert [node['instance_id'] for node in result['nodes']] == [inst.id for inst in chain.instances]
+
+    unreachable = result['nodes'][0]
+    assert not unreachable['is_alive']
+    assert unreachable['height'] is None
+    assert 'error' in unreachable
+    assert all(node['is_alive'] for node in result['nodes'][1:])
+
+
+@pytest.mark.parametrize('regionscount', [3])
+def test_get_status_malformed_response(chainmanager, chain, requests_mock, mock_ethermint_requests):
+    mock_ethermint_requests(123, datetime.now(tz=pytz.UTC), "hash",
+                            [inst.public_ip_address for inst in chain.instances[2:]])
+    requests_mock.add(requests_mock.GET, re.compile(r'http://' + chain.instances[0].public_ip_address +
+                                                    r':46657/status'), body="not json", status=200)
+    # an RPC error has no result
+    requests_mock.add(requests_mock.GET, re.compile(r'http://' + chain.instances[1].public_ip_address +
+                                                    r':46657/status'), json={"error": "internal error"}, status=200)
+
+    result = chainmanager.get_status(chain)
+
+    assert result["height"] == 123
+    for node in result['nodes'][:2]:
+        assert not node['is_alive'] and node['height'] is None and node['error']
+
+
+@pytest.mark.parametrize('regionscount', [2])
+def test_network_fault_no_heights(chain, requests_mock, mocksubprocess):
+    # no responses are mocked, so none of the nodes can be reached
+    mocksubprocess.reset_mock()
+
+    with pytest.raises(RuntimeError):
+        Chainmanager.get_network_fault(chain, 2, 123, 1)
+    assert not mocksubprocess.called
+
+
 @pytest.mark.parametrize('regionscount', [1])
 def test_get_status_ethermint_out_of_sync(chainmanager, chain, requests_mock):
     ip = chain.instances[0].public_ip_address
@@ -408,9 +565,9 @@ def test_history_default_to_fromm(requests_mock, chain, mock_ethermint_requests)
         mock_ethermint_requests(10, t, "hash", [inst.public_ip_address for inst in chain.instances])
         requests_mock.add(requests_mock.GET,
                           re.compile(r'http://' + ip + r':46657/blockchain\?minHeight=9\&maxHeight=10'),
-                          json={"result": [0, {'block_metas': [{'header': {'app_hash': "",
-                                                                           'height': "",
-                                                                           'time': t.isoformat()}}]}]},
+                          json={"result": [0, {'block_metas': 2 * [{'header': {'app_hash': "",
+                                                                               'height': "",
+                                                                               'time': t.isoformat()}}]}]},
                           status=200)
 
     reset_mocks()
@@ -520,3 +677,74 @@ def test_network_fault(requests_mock, chain, mock_ethermint_requests, mocksubpro
         (246, delay_step_time2),
         (0, delay_step_time3)
     ]
+
+
+@pytest.mark.parametrize('regionscount', [5])
+def test_destroy_ethermint_network(chainmanager, mockregions, ethermint_version, monkeypatch):
+    chain = chainmanager.create_ethermint_network(mockregions, ethermint_version)
+    shared_region = chain.instances[0].region_name
+    key_name = chain.instances[0].key_name
+    group_ids = dict((node.region_name, node.security_groups[0]["GroupId"]) for node in chain.instances)
+    # an instance of e.g. a thawed chain that shares the security group and key pair
+    other = boto3.resource('ec2', region_name=shared_region).create_instances(
+        ImageId=chain.instances[0].image_id, MinCount=1, MaxCount=1, KeyName=key_name,
+        SecurityGroupIds=[group_ids[shared_region]])[0]
+
+    # moto doesn't detach the volumes of terminated instances
+    def iter_available_volumes(volume_ids_by_region, clients):
+        for region, volume_ids in volume_ids_by_region.items():
+            for volume in clients[region].describe_volumes(VolumeIds=volume_ids)["Volumes"]:
+                attachment = volume["Attachments"][0]
+                clients[region].detach_volume(VolumeId=volume["VolumeId"], InstanceId=attachment["InstanceId"],
+                                              Device=attachment["Device"])
+                yield region, volume["VolumeId"]
+    monkeypatch.setattr("chainmanager.iter_available_volumes", iter_available_volumes)
+
+    # a chainshot of the chain, thawed with the security group and key pair
+    chainshot_region = chain.instances[4].region_name
+    chainshot = {"chainshot_name": "Test", "instances": [{
+        "instance": {"region": chainshot_region, "key_name": key_name,
+                     "security_groups": [chain.instances[4].security_groups[0]["GroupName"]]},
+        "snapshot": {"id": "snap-1"}}]}
+
+    report = Chainmanager.destroy_ethermint_network(chain, delete_groups_and_keys=True, chainshots=[chainshot])
+
+    for region in set(mockregions):
+        client = boto3.client('ec2', region_name=region)
+        states = dict((instance["InstanceId"], instance["State"]["Name"])
+                      for reservation in client.describe_instances()["Reservations"]
+                      for instance in reservation["Instances"])
+        assert sorted(report["terminated"][region]) == sorted(node.id for node in chain.instances
+                                                              if node.region_name == region)
+        assert all(states[instance_id] == "terminated" for instance_id in report["terminated"][region])
+        deleted_volumes = report["deleted"][region]["volumes"]["deleted"]
+        assert len(deleted_volumes) == mockregions.count(region)
+        assert not set(deleted_volumes) & set(volume["VolumeId"] for volume in client.describe_volumes()["Volumes"])
+
+        key_names = [key_pair["KeyName"] for key_pair in client.describe_key_pairs()["KeyPairs"]]
+        groups = [group["GroupId"] for group in client.describe_security_groups()["SecurityGroups"]]
+        if region == shared_region:
+            assert states[other.id] == "running"
+            assert key_name in key_names and group_ids[region] in groups
+            assert report["deleted"][region]["key_pairs"]["deleted"] == []
+        elif region == chainshot_region:
+            assert key_name in key_names and group_ids[region] in groups
+        else:
+            assert key_name not in key_names and group_ids[region] not in groups
+            assert report["deleted"][region]["key_pairs"]["deleted"] == [key_name]
+
+
+@pytest.mark.parametrize('regionscount', [2])
+def test_destroy_ethermint_network_keeps_groups_and_keys(chainmanager, mockregions, ethermint_version, monkeypatch):
+    chain = chainmanager.create_ethermint_network(mockregions, ethermint_version)
+    monkeypatch.setattr("chainmanager.iter_available_volumes", MagicMock(return_value=[]))
+
+    report = Chainmanager.destroy_ethermint_network(chain)
+
+    for node in chain.instances:
+        client = boto3.client('ec2', region_name=node.region_name)
+        assert node.key_name in [key_pair["KeyName"] for key_pair in client.describe_key_pairs()["KeyPairs"]]
+        assert node.security_groups[0]["GroupId"] in [group["GroupId"] for group in
+                                                      client.describe_security_groups()["SecurityGroups"]]
+        assert report["deleted"][node.region_name]["security_groups"]["deleted"] == []
+        assert report["deleted"][node.region_name]["key_pairs"]["deleted"] == []
@@ -11,9 +11,9 @@ from mock import MagicMock
 
 from chain import Chain
 from chainmanager import RegionInstancePair
-from chainshotter import Chainshotter
+from chainshotter import Chainshotter, restorable_heights
 from settings import DEFAULT_REGION, DEFAULT_DEVICE
-from utils import get_shh_key_file
+from utils import get_shh_key_file, SSH_OPTIONS
 
 ETHERMINT_P2P_PORT = 46656
 
@@ -43,17 +43,17 @@ def test_chainshot_halts_restarts(chainshotter, mocksubprocess, mockregions, cha
     args_list = mocksubprocess.call_args_list
     assert len(args_list) == 4
 
-    assert args_list[0:2] == [mock.call("ssh -o StrictHostKeyChecking=no -i {0} ubuntu@{1} "
+    assert args_list[0:2] == [mock.call("ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} "
                                         "'bash -s' < shell_scripts/halt_ethermint.sh".format(
         get_shh_key_file(instance.key_name),
         instance.public_ip_address), shell=True) for instance in [instance1, instance2]]
 
-    assert args_list[2] == mock.call("ssh -o StrictHostKeyChecking=no -i {0} ubuntu@{1} "
+    assert args_list[2] == mock.call("ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} "
                                      "'bash -s' < shell_scripts/run_ethermint.sh".format(
         get_shh_key_file(instance1.key_name),
         instance1.public_ip_address), shell=True)
 
-    assert args_list[3] == mock.call("ssh -o StrictHostKeyChecking=no -i {0} ubuntu@{1} "
+    assert args_list[3] == mock.call("ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} "
                                      "'bash -s' < shell_scripts/run_ethermint.sh {2}:{3}".format(
         get_shh_key_file(instance2.key_name),
         instance2.public_ip_address,
@@ -61,6 +61,32 @@ def test_chainshot_halts_restarts(chainshotter, mocksubprocess, mockregions, cha
         ETHERMINT_P2P_PORT), shell=True)
 
 
+@pytest.mark.parametrize('regionscount', [4])
+def test_chainshot_parallel_halts_restarts(mocksubprocess, mockregions, chainmanager, ethermint_version):
+    chain = chainmanager.create_ethermint_network(mockregions, ethermint_version)
+    mocksubprocess.reset_mock()
+
+    Chainshotter(concurrency=4).chainshot("Test", chain)
+
+    commands = [call[0][0] for call in mocksubprocess.call_args_list]
+    assert len(commands) == 8
+
+    # halting in any order, then the seed node, then the others in any order
+    halts = ["ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} 'bash -s' < shell_scripts/halt_ethermint.sh".format(
+             get_shh_key_file(instance.key_name), instance.public_ip_address) for instance in chain.instances]
+    assert sorted(commands[0:4]) == sorted(halts)
+
+    seed = chain.instances[0]
+    assert commands[4] == "ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} " \
+                          "'bash -s' < shell_scripts/run_ethermint.sh".format(get_shh_key_file(seed.key_name),
+                                                                              seed.public_ip_address)
+
+    runs = ["ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} 'bash -s' < shell_scripts/run_ethermint.sh {2}:{3}".format(
+            get_shh_key_file(instance.key_name), instance.public_ip_address, seed.public_ip_address,
+            ETHERMINT_P2P_PORT) for instance in chain.instances[1:]]
+    assert sorted(commands[5:]) == sorted(runs)
+
+
 def test_chainshot_creates_snapshots(chainshotter, chainmanager, mockregions, ethermint_version):
     chain = chainmanager.create_ethermint_network(mockregions, ethermint_version)
     chainshotter.chainshot("Test", chain)
@@ -74,6 +100,75 @@ def test_chainshot_creates_snapshots(chainshotter, chainmanager, mockregions, et
     assert total_snapshots == len(chain.instances)
 
 
+@pytest.mark.parametrize('regionscount', [3])
+def test_chainshot_snapshots_while_halted(chainshotter, chainmanager, mocksubprocess, mockregions, ethermint_version,
+                                          monkeypatch):
+    chain = chainmanager.create_ethermint_network(mockregions, ethermint_version)
+    events = []
+    mocksubprocess.side_effect = lambda command, **kwargs: events.append(command.split("< ")[1]) or ""
+    create_snapshot = Chainshotter._start_snapshot
+    monkeypatch.setattr(Chainshotter, '_start_snapshot',
+                        staticmethod(lambda *args: events.append("snapshot") or create_snapshot(*args)))
+
+    chainshot_data = chainshotter.chainshot("Test", chain)
+
+    # all snapshots are initiated while ethermint is halted, without waiting for them to complete
+    assert events[:3] == ["shell_scripts/halt_ethermint.sh"] * 3
+    assert events[3:6] == ["snapshot"] * 3
+    assert all(event.startswith("shell_scripts/run_ethermint.sh") for event in events[6:])
+
+    assert chainshot_data["downtime"] > 0
+    for data in chainshot_data["instances"]:
+        assert sorted(data["timings"].keys()) == ["halt", "run", "snapshot_completion", "snapshot_initiation"]
+
+
+@pytest.mark.parametrize('regionscount', [2])
+def test_chainshot_restarts_when_snapshot_fails(chainshotter, chainmanager, mocksubprocess, mockregions,
+                                                ethermint_version, monkeypatch):
+    chain = chainmanager.create_ethermint_network(mockregions, ethermint_version)
+    mocksubprocess.reset_mock()
+    monkeypatch.setattr(Chainshotter, '_start_snapshot', staticmethod(MagicMock(side_effect=RuntimeError("EBS"))))
+
+    with pytest.raises(RuntimeError):
+        chainshotter.chainshot("Test", chain)
+
+    scripts = [call[0][0].split("< ")[1] for call in mocksubprocess.call_args_list]
+    assert scripts[:2] == ["shell_scripts/halt_ethermint.sh"] * 2
+    assert len(scripts) == 4 and all(script.startswith("shell_scripts/run_ethermint.sh") for script in scripts[2:])
+
+
+@pytest.mark.parametrize('regionscount', [2])
+def test_chainshot_lineage(chainshotter, chainmanager, mockregions, ethermint_version, monkeypatch):
+    chain = chainmanager.create_ethermint_network(mockregions, ethermint_version)
+    heights = MagicMock(side_effect=[[10, 9], [24, 25]])
+    monkeypatch.setattr(Chainshotter, '_get_heights', staticmethod(heights))
+
+    first = chainshotter.chainshot("First", chain)
+    second = chainshotter.chainshot("Second", chain, parent=first)
+
+    assert first["parent"] is None
+    assert first["lineage"] == first["id"]
+    assert first["heights"] == {"from": 1, "to": 10}
+
+    assert second["id"] != first["id"]
+    assert second["parent"] == first["id"]
+    assert second["lineage"] == first["id"]
+    assert second["heights"] == {"from": 11, "to": 25}
+    assert dateutil.parser.parse(second["created"]) >= dateutil.parser.parse(first["created"])
+
+
+@pytest.mark.parametrize('regionscount', [1])
+def test_chainshot_pre_lineage_parent(chainshotter, chainmanager, mockregions, ethermint_version, monkeypatch):
+    chain = chainmanager.create_ethermint_network(mockregions, ethermint_version)
+    monkeypatch.setattr(Chainshotter, '_get_heights', staticmethod(lambda instances: [12]))
+
+    chainshot = chainshotter.chainshot("Second", chain, parent={"chainshot_name": "Old", "instances": []})
+
+    assert chainshot["parent"] == "Old"
+    assert chainshot["lineage"] == "Old"
+    assert chainshot["heights"] == {"from": 1, "to": 12}
+
+
 def test_chainshot_return_data(chainshotter, chainmanager, mockregions, mockami, ethermint_version):
     time1 = datetime.datetime.now(tz=pytz.UTC).replace(microsecond=0)
     sleep(1)  # sleeping to put differentiate times from aws with second resolution and make test deterministic
@@ -141,6 +236,22 @@ def test_attaching_ebs_snapshots_on_thaw(chainshotter, prepare_chainshot):
                 assert bdm["DeviceName"] == DEFAULT_DEVICE
 
 
+@pytest.mark.parametrize('regionscount', [6])
+def test_thaw_launches_per_region(chainshotter, prepare_chainshot, mockregions):
+    chain = chainshotter.thaw(prepare_chainshot)
+
+    assert [instance.region_name for instance in chain.instances] == mockregions
+    for region in set(mockregions):
+        reservations = boto3.client('ec2', region_name=region).describe_instances()["Reservations"]
+        # one launch when creating the network and one when thawing
+        assert len(reservations) == 2
+        assert len(reservations[1]["Instances"]) == mockregions.count(region)
+
+    for instance, data in zip(chain.instances, prepare_chainshot["instances"]):
+        volumes = list(instance.volumes.filter(Filters=[{'Name': 'snapshot-id', 'Values': [data["snapshot"]["id"]]}]))
+        assert len(volumes) == 1
+
+
 @pytest.mark.parametrize('regionscount', [2])
 def test_mounting_ebs_and_running_on_thaw(chainshotter, mocksubprocess, prepare_chainshot):
     # For now testing if the ssh command is correct
@@ -152,12 +263,12 @@ def test_mounting_ebs_and_running_on_thaw(chainshotter, mocksubprocess, prepare_
     args_list = mocksubprocess.call_args_list
     assert len(args_list) == 4
 
-    assert args_list[0] == mock.call("ssh -o StrictHostKeyChecking=no -i {0} ubuntu@{1} "
+    assert args_list[0] == mock.call("ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} "
                                      "'bash -s' < shell_scripts/mount_snapshot.sh".format(
         get_shh_key_file(instance.key_name),
         instance.public_ip_address), shell=True)
 
-    assert args_list[2] == mock.call("ssh -o StrictHostKeyChecking=no -i {0} ubuntu@{1} "
+    assert args_list[2] == mock.call("ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} "
                                      "'bash -s' < shell_scripts/run_ethermint.sh".format(
         get_shh_key_file(instance.key_name),
         instance.public_ip_address), shell=True)
@@ -192,3 +303,85 @@ def test_thaw_printable(chainshotter, prepare_chainshot, capsys):
         region, instance_id = line.split(':')
         assert region == chain.instances[i].region_name
         assert instance_id == chain.instances[i].id
+
+
+def test_restorable_heights():
+    assert restorable_heights([10, 10, 10, 10]) == {"heights": [10, 10, 10, 10], "min_height": 10, "max_height": 10,
+                                                    "consistent": True, "restorable": True, "restorable_height": 10}
+    result = restorable_heights([10, 12, 15, 17])
+    assert not result["consistent"]
+    # 3 of the 4 nodes have reached 12
+    assert result["restorable_height"] == 12
+
+    result = restorable_heights([10, None, None, 17])
+    assert not result["restorable"]
+    assert result["restorable_height"] is None
+
+
+@pytest.mark.parametrize('regionscount', [6])
+def test_rolling_chainshot(chainshotter, chainmanager, mocksubprocess, mockregions, ethermint_version, monkeypatch):
+    chain = chainmanager.create_ethermint_network(mockregions, ethermint_version)
+    mocksubprocess.reset_mock()
+    heights = {instance.id: 100 + 10 * i for i, instance in enumerate(chain.instances)}
+    node_heights = dict(heights)
+    states = dict((instance.id, "up") for instance in chain.instances)
+    ids = dict((instance.public_ip_address, instance.id) for instance in chain.instances)
+    syncing_polls = {}
+
+    def run_script(command, **kwargs):
+        instance_id = ids[command.split("ubuntu@")[1].split(" ")[0]]
+        states[instance_id] = "halted" if "halt_ethermint.sh" in command else "syncing"
+        return ""
+    mocksubprocess.side_effect = run_script
+
+    def get_heights(instances):
+        result = []
+        for instance in instances:
+            if states[instance.id] == "syncing":
+                # a restarted node syncs past the height it was halted at right away, and catches up on the next poll
+                syncing_polls[instance.id] = syncing_polls.get(instance.id, 0) + 1
+                node_heights[instance.id] = node_heights[instance.id] + 5 if syncing_polls[instance.id] == 1 \
+                    else max(node_heights.values())
+                if syncing_polls[instance.id] > 1:
+                    states[instance.id] = "up"
+            result.append(None if states[instance.id] == "halted" else node_heights[instance.id])
+        return result
+    monkeypatch.setattr(Chainshotter, '_get_heights', staticmethod(get_heights))
+    monkeypatch.setattr("chainshotter.WAIT_MIN_INTERVAL", 0)
+
+    chainshot_data = chainshotter.rolling_chainshot("Rolling", chain)
+
+    # f = 1 for 6 nodes: one node at a time, each restarted with a node that stayed up as its seed
+    commands = [call[0][0] for call in mocksubprocess.call_args_list]
+    assert len(commands) == 12
+    for i, instance in enumerate(chain.instances):
+        ssh = "ssh " + SSH_OPTIONS + " -i {0} ubuntu@{1} 'bash -s' < ".format(
+            get_shh_key_file(instance.key_name), instance.public_ip_address)
+        seed = chain.instances[1 if i == 0 else 0]
+        assert commands[2 * i] == ssh + "shell_scripts/halt_ethermint.sh"
+        assert commands[2 * i + 1] == ssh + "shell_scripts/run_ethermint.sh {}:{}".format(
+            seed.public_ip_address, ETHERMINT_P2P_PORT)
+
+    for instance, data in zip(chain.instances, chainshot_data["instances"]):
+        assert data["snapshot"]["height"] == heights[instance.id]
+        snapshot = boto3.resource('ec2', region_name=data["instance"]["region"]).Snapshot(data["snapshot"]["id"])
+        assert {"Key": "BlockHeight", "Value": str(heights[instance.id])} in snapshot.tags
+
+    assert chainshot_data["rolling"]["heights"] == [100, 110, 120, 130, 140, 150]
+    # 5 of the 6 nodes have reached 110
+    assert chainshot_data["rolling"]["restorable_height"] == 110
+    assert chainshot_data["heights"] == {"from": 1, "to": 110}
+    # every restarted node was polled until it caught up with the nodes that stayed up
+    assert sorted(syncing_polls.keys()) == sorted(heights.keys())
+    assert syncing_polls[chain.instances[0].id] == 2
+
+
+@pytest.mark.parametrize('regionscount', [4])
+def test_rolling_chainshot_catch_up_timeout(chainshotter, chainmanager, mockregions, ethermint_version, monkeypatch):
+    chain = chainmanager.create_ethermint_network(mockregions, ethermint_version)
+    # the height before the halt, then the restarted node doesn't catch up with the nodes that stayed up
+    get_heights = MagicMock(side_effect=[[100], [110, 110, 110], [99]])
+    monkeypatch.setattr(Chainshotter, '_get_heights', staticmethod(get_heights))
+
+    with pytest.raises(RuntimeError):
+        chainshotter.rolling_chainshot("Rolling", chain, catch_up_timeout=-1)
@@ -0,0 +1,62 @@
+import os
+
+import boto3
+
+from instance_creator import InstanceCreator
+
+REGIONS = ["ap-northeast-1", "us-west-1", "eu-central-1", "us-east-1"]
+
+
+def _config(region, i, add_volume=False):
+    ec2 = boto3.resource('ec2', region_name=region)
+    groups = list(ec2.security_groups.filter(GroupNames=["testgroup"])) or \
+        [ec2.create_security_group(GroupName="testgroup", Description="test group")]
+    return {
+        "region": region,
+        "ami": "ami-90b01686",
+        "security_groups": [groups[0].id],
+        "key_name": "key",
+        "tags": [{"Key": "Name", "Value": "node" + str(i)}],
+        "add_volume": add_volume
+    }
+
+
+def test_create_instances_one_launch_per_region(moto, mockossystem, mocksubprocess, tmp_files_dir):
+    open(os.path.join(tmp_files_dir, "key.pem"), 'w').close()
+    config = [_config(REGIONS[i % len(REGIONS)], i, add_volume=(i < 4)) for i in range(12)]
+
+    instances = InstanceCreator().create_ec2s_from_json(config)
+
+    assert len(instances) == 12
+    for i, instance in enumerate(instances):
+        assert instance.placement["AvailabilityZone"].startswith(REGIONS[i % len(REGIONS)])
+        assert instance.tags == [{"Key": "Name", "Value": "node" + str(i)}]
+        assert len(instance.block_device_mappings) == (2 if i < 4 else 1)
+
+    for region in REGIONS:
+        reservations = boto3.client('ec2', region_name=region).describe_instances()["Reservations"]
+        assert len(reservations) == 1
+        assert len(reservations[0]["Instances"]) == 3
+
+    # the new volumes are mounted
+    assert len([call for call in mocksubprocess.call_args_list if "mount_new_volume" in call[0][0]]) == 4
+
+
+def test_create_instances_ready_once_mounted(moto, mockossystem, mocksubprocess, tmp_files_dir):
+    open(os.path.join(tmp_files_dir, "key.pem"), 'w').close()
+    config = [_config(REGIONS[0], i, add_volume=(i % 2 == 0)) for i in range(4)]
+    events = []
+
+    def run_script(command, **kwargs):
+        events.append(("mount", command.split("ubuntu@")[1].split(" ")[0]))
+    mocksubprocess.side_effect = run_script
+
+    instances = InstanceCreator().create_ec2s_from_json(
+        config, on_ready=lambda index, instance: events.append(("ready", index, instance.public_ip_address)))
+
+    assert sorted(event[1] for event in events if event[0] == "ready") == range(4)
+    for event in events:
+        if event[0] == "ready" and config[event[1]]["add_volume"]:
+            # every node is handed over right after its own volume is mounted
+            assert events.index(("mount", event[2])) < events.index(event)
+    assert all(len(instance.block_device_mappings) == (2 if i % 2 == 0 else 1) for i, instance in enumerate(instances))
@@ -0,0 +1,56 @@
+import json
+import os
+
+import pytest
+
+from lineage import coverage, find_chainshot, load_chainshots
+
+
+def chainshot(chainshot_id, parent, lineage, fromm, to, created):
+    return {"chainshot_name": "shot-" + chainshot_id, "id": chainshot_id, "parent": parent, "lineage": lineage,
+            "heights": {"from": fromm, "to": to}, "created": created, "instances": []}
+
+
+@pytest.fixture()
+def chainshots():
+    return [
+        chainshot("b", "a", "a", 11, 20, "2017-05-01T11:00:00+00:00"),
+        chainshot("a", None, "a", 1, 10, "2017-05-01T10:00:00+00:00"),
+        chainshot("c", "b", "a", 21, 30, "2017-05-01T12:00:00+00:00"),
+        # thawed from a at height 10 and run again
+        chainshot("d", "a", "a", 11, 15, "2017-05-01T13:00:00+00:00"),
+        chainshot("x", None, "x", 1, 50, "2017-05-01T09:00:00+00:00"),
+        {"chainshot_name": "old", "instances": []},
+    ]
+
+
+def test_coverage(chainshots):
+    lineages = coverage(chainshots)
+
+    assert sorted(lineages.keys()) == ["a", "x"]
+    assert [(entry["id"], entry["from"], entry["to"]) for entry in lineages["a"]] == \
+        [("a", 1, 10), ("b", 11, 20), ("c", 21, 30), ("d", 11, 15)]
+    assert lineages["a"][1]["parent"] == "a"
+
+
+def test_find_chainshot(chainshots):
+    assert find_chainshot(chainshots[:4], 5)["id"] == "a"
+    assert find_chainshot(chainshots[:4], 25)["id"] == "c"
+    # the newest one covering the height
+    assert find_chainshot(chainshots[:4], 12)["id"] == "d"
+    assert find_chainshot(chainshots[:4], 18)["id"] == "b"
+    assert find_chainshot(chainshots)["id"] == "d"
+
+    with pytest.raises(ValueError):
+        find_chainshot(chainshots[:4], 31)
+
+
+def test_load_chainshots(tmpdir, chainshots):
+    paths = []
+    for data in chainshots:
+        path = os.path.join(str(tmpdir), data["chainshot_name"])
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        paths.append(path)
+
+    assert load_chainshots(paths) == chainshots
@@ -0,0 +1,125 @@
+import csv
+import json
+import re
+import urlparse
+from StringIO import StringIO
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+from mock import MagicMock
+
+from chain import Chain
+from monitor import ChainMonitor, COLUMNS
+
+START = datetime(2017, 4, 1, tzinfo=pytz.UTC)
+IPS = ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+
+
+def block_time(height):
+    return START + timedelta(seconds=2 * height)
+
+
+@pytest.fixture()
+def nodes(requests_mock):
+    """
+    Nodes at the given heights, mocked with callbacks; set heights[ip] to make a node move on
+    """
+    heights = dict((ip, 10) for ip in IPS)
+    blockchain_calls = []
+    # nodes which don't move on aren't asked for blocks
+    requests_mock.assert_all_requests_are_fired = False
+
+    def status(request):
+        ip = urlparse.urlparse(request.url).hostname
+        seconds = (block_time(heights[ip]) - datetime(1970, 1, 1, tzinfo=pytz.UTC)).total_seconds()
+        return 200, {}, json.dumps({"result": [0, {"latest_block_height": heights[ip],
+                                                   "latest_block_time": seconds * 1e9,
+                                                   "latest_app_hash": "hash"}]})
+
+    def blockchain(request):
+        query = urlparse.parse_qs(urlparse.urlparse(request.url).query)
+        low, high = int(query["minHeight"][0]), int(query["maxHeight"][0])
+        blockchain_calls.append((urlparse.urlparse(request.url).hostname, low, high))
+        metas = [{"header": {"app_hash": "hash", "height": height, "time": block_time(height).isoformat()}}
+                 for height in reversed(range(low, high + 1))]
+        return 200, {}, json.dumps({"result": [0, {"block_metas": metas}]})
+
+    for ip in IPS:
+        requests_mock.add_callback(requests_mock.GET, re.compile(r'http://' + ip + r':46657/status'), status)
+        requests_mock.add_callback(requests_mock.GET, re.compile(r'http://' + ip + r':46657/blockchain'), blockchain)
+
+    pairs = [MagicMock(id="i-{}".format(i), region_name="us-west-1", public_ip_address=ip, is_stale=False)
+             for i, ip in enumerate(IPS)]
+    return Chain(pairs), heights, blockchain_calls
+
+
+def test_monitor_fetches_only_new_blocks(nodes):
+    chain, heights, blockchain_calls = nodes
+    monitor = ChainMonitor(chain)
+
+    rows = monitor.poll()
+    assert [(row["height"], row["lag"], row["new_blocks"]) for row in rows] == [(10, 0, 0)] * 3
+    assert blockchain_calls == []
+
+    heights.update({IPS[0]: 14, IPS[1]: 12})
+    rows = monitor.poll()
+    assert [(row["height"], row["lag"], row["new_blocks"]) for row in rows] == [(14, 0, 4), (12, 2, 2), (10, 4, 0)]
+    assert rows[0]["mean_block_time"] == 2
+    assert sorted(blockchain_calls) == [(IPS[0], 11, 14), (IPS[1], 11, 12)]
+
+    heights[IPS[0]] = 15
+    rows = monitor.poll()
+    assert [row["new_blocks"] for row in rows] == [1, 0, 0]
+    assert sorted(blockchain_calls)[1] == (IPS[0], 15, 15)
+
+
+def test_monitor_unreachable_node(nodes):
+    chain, heights, _ = nodes
+    chain.instances.append(MagicMock(id="i-dead", region_name="us-west-1", public_ip_address="10.0.0.99",
+                                     is_stale=False))
+
+    rows = ChainMonitor(chain, timeout=0.1).poll()
+
+    assert rows[-1]["height"] is None and rows[-1]["lag"] is None
+    assert rows[-1]["error"]
+    assert all(row["error"] is None and row["rpc_latency_ms"] is not None for row in rows[:-1])
+
+
+def test_monitor_node_with_bad_response(nodes, requests_mock):
+    chain, heights, _ = nodes
+    requests_mock.add(requests_mock.GET, re.compile(r'http://10.0.0.4:46657/status'), body="not json", status=200)
+    chain.instances.append(MagicMock(id="i-bad", region_name="us-west-1", public_ip_address="10.0.0.4",
+                                     is_stale=False))
+
+    rows = ChainMonitor(chain).poll()
+
+    assert rows[-1]["height"] is None and rows[-1]["error"]
+    assert [row["height"] for row in rows[:-1]] == [10] * 3
+
+
+def test_monitor_hydrates_chain_once_per_poll(nodes, monkeypatch):
+    chain, heights, _ = nodes
+    describe_all = MagicMock()
+    monkeypatch.setattr("chain.RegionInstancePair.describe_all", describe_all)
+
+    monitor = ChainMonitor(chain)
+    monitor.poll()
+    monitor.poll()
+
+    assert describe_all.call_count == 2
+    describe_all.assert_called_with(chain.instances, False)
+
+
+def test_monitor_writes_csv(nodes, monkeypatch):
+    chain, heights, _ = nodes
+    monkeypatch.setattr("monitor.time.sleep", MagicMock())
+    output = StringIO()
+
+    ChainMonitor(chain).run(output, interval=1, ticks=2)
+
+    output.seek(0)
+    rows = list(csv.DictReader(output))
+    assert len(rows) == 6
+    assert set(rows[0].keys()) == set(COLUMNS)
+    assert rows[-1]["last_block_time"] == block_time(10).isoformat()
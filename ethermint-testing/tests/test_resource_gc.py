@@ -0,0 +1,147 @@
+import time
+from datetime import datetime, timedelta
+
+import boto3
+import pytest
+
+from chainshotter import Chainshotter
+from resource_gc import chainshot_resources, chainshot_snapshots, chainshot_regions, collect_garbage, find_garbage, \
+    _is_young
+from settings import ETHERMINT_VOLUME_NAME, SNAPSHOT_DESCRIPTION, SECURITY_GROUP_NAME_PREFIX, KEY_NAME_PREFIX
+
+REGION = "us-west-1"
+
+
+def chainshot(chainshot_id, created, snapshot_ids):
+    return {"chainshot_name": chainshot_id, "id": chainshot_id, "parent": None, "lineage": "lineage",
+            "heights": {"from": 1, "to": 10}, "created": created,
+            "instances": [{"snapshot": {"id": snapshot_id}} for snapshot_id in snapshot_ids]}
+
+
+@pytest.fixture()
+def stale_resources(moto):
+    ec2 = boto3.resource('ec2', region_name=REGION)
+    client = boto3.client('ec2', region_name=REGION)
+
+    used_group = ec2.create_security_group(GroupName=SECURITY_GROUP_NAME_PREFIX + "used", Description="test")
+    stale_group = ec2.create_security_group(GroupName=SECURITY_GROUP_NAME_PREFIX + "stale", Description="test")
+    other_group = ec2.create_security_group(GroupName="something-else", Description="test")
+    for name in ["used", "stale"]:
+        client.create_key_pair(KeyName=KEY_NAME_PREFIX + name)
+    client.create_key_pair(KeyName="my-key")
+    ec2.create_instances(ImageId="ami-90b01686", MinCount=1, MaxCount=1, SecurityGroupIds=[used_group.id],
+                         KeyName=KEY_NAME_PREFIX + "used")
+
+    volume = ec2.create_volume(Size=10, AvailabilityZone=REGION + "a")
+    volume.create_tags(Tags=[{'Key': 'Name', 'Value': ETHERMINT_VOLUME_NAME}])
+    ec2.create_volume(Size=10, AvailabilityZone=REGION + "a")  # not ours
+    snapshots = [ec2.create_snapshot(VolumeId=volume.id, Description=SNAPSHOT_DESCRIPTION).id for _ in range(4)]
+
+    return {"stale_group": stale_group.id, "other_group": other_group.id, "volume": volume.id,
+            "snapshots": snapshots}
+
+
+def test_chainshot_retention():
+    chainshots = [chainshot("a", "2017-05-01T10:00:00+00:00", ["snap-1", "snap-2"]),
+                  chainshot("c", "2017-05-01T12:00:00+00:00", ["snap-5", "snap-6"]),
+                  chainshot("b", "2017-05-01T11:00:00+00:00", ["snap-3", "snap-4"])]
+
+    assert chainshot_snapshots(chainshots) == ({"snap-1", "snap-2", "snap-3", "snap-4", "snap-5", "snap-6"}, set())
+    assert chainshot_snapshots(chainshots, keep=2) == ({"snap-3", "snap-4", "snap-5", "snap-6"}, {"snap-1", "snap-2"})
+    assert chainshot_snapshots(chainshots, keep=0) == (set(), {"snap-1", "snap-2", "snap-3", "snap-4", "snap-5",
+                                                               "snap-6"})
+
+
+def test_find_garbage(stale_resources):
+    snapshots = stale_resources["snapshots"]
+    chainshots = [chainshot("old", "2017-05-01T10:00:00+00:00", snapshots[:1]),
+                  chainshot("new", "2017-05-01T11:00:00+00:00", snapshots[1:2])]
+
+    garbage = find_garbage([REGION], chainshots, keep=1, grace_period=0)[REGION]
+    assert garbage == {"volumes": [stale_resources["volume"]], "snapshots": [snapshots[0]],
+                       "security_groups": [stale_resources["stale_group"]], "key_pairs": [KEY_NAME_PREFIX + "stale"]}
+
+    garbage = find_garbage([REGION], chainshots, keep=1, include_orphans=True, grace_period=0)[REGION]
+    assert sorted(garbage["snapshots"]) == sorted([snapshots[0]] + snapshots[2:])
+
+
+def test_collect_garbage(stale_resources):
+    client = boto3.client('ec2', region_name=REGION)
+
+    report = collect_garbage([REGION], include_orphans=True, dry_run=True, grace_period=0)
+    assert sorted(report[REGION]["snapshots"]["deleted"]) == sorted(stale_resources["snapshots"])
+    assert len(client.describe_snapshots(OwnerIds=['self'])["Snapshots"]) == 4
+
+    report = collect_garbage([REGION], include_orphans=True, grace_period=0)
+    assert report[REGION]["security_groups"] == {"deleted": [stale_resources["stale_group"]], "failed": {}}
+    assert client.describe_snapshots(OwnerIds=['self'])["Snapshots"] == []
+    assert sorted(key_pair["KeyName"] for key_pair in client.describe_key_pairs()["KeyPairs"]) == \
+        sorted([KEY_NAME_PREFIX + "used", "my-key"])
+    assert stale_resources["other_group"] in [group["GroupId"] for group in
+                                              client.describe_security_groups()["SecurityGroups"]]
+    assert len(client.describe_volumes()["Volumes"]) == 2  # the root volume of the instance and the other one
+
+
+def test_find_garbage_skips_young_resources(stale_resources):
+    client = boto3.client('ec2', region_name=REGION)
+    young_group = client.create_security_group(GroupName=SECURITY_GROUP_NAME_PREFIX + str(datetime.now()),
+                                               Description="test")["GroupId"]
+    client.create_key_pair(KeyName=KEY_NAME_PREFIX + str(int(time.time())) + "_abc")
+
+    garbage = find_garbage([REGION], include_orphans=True, grace_period=3600)[REGION]
+
+    # the volume and snapshots were just made, the stale group and key have no creation time in their names
+    assert garbage == {"volumes": [], "snapshots": [], "security_groups": [stale_resources["stale_group"]],
+                       "key_pairs": [KEY_NAME_PREFIX + "stale"]}
+    garbage = find_garbage([REGION], include_orphans=True, grace_period=0)[REGION]
+    assert young_group in garbage["security_groups"]
+
+
+def test_is_young():
+    old = datetime.now() - timedelta(hours=2)
+    assert _is_young(SECURITY_GROUP_NAME_PREFIX + str(datetime.now()), SECURITY_GROUP_NAME_PREFIX, 3600)
+    assert not _is_young(SECURITY_GROUP_NAME_PREFIX + str(old), SECURITY_GROUP_NAME_PREFIX, 3600)
+    assert _is_young(KEY_NAME_PREFIX + str(int(time.time())) + "_abc", KEY_NAME_PREFIX, 3600)
+    assert not _is_young(KEY_NAME_PREFIX + str(int(time.time()) - 7200) + "_abc", KEY_NAME_PREFIX, 3600)
+    assert not _is_young(KEY_NAME_PREFIX + "stale", KEY_NAME_PREFIX, 3600)
+
+
+def test_chainshot_regions():
+    chainshots = [chainshot("a", "2017-05-01T10:00:00+00:00", ["snap-1", "snap-2"])]
+    chainshots[0]["instances"][0]["instance"] = {"region": "us-west-1b"}
+    chainshots[0]["instances"][1]["instance"] = {"region": "eu-west-1"}
+
+    assert chainshot_regions(chainshots) == {"us-west-1", "eu-west-1"}
+
+
+def test_chainshot_resources():
+    chainshots = [chainshot("a", "2017-05-01T10:00:00+00:00", ["snap-1"]),
+                  chainshot("b", "2017-05-01T11:00:00+00:00", ["snap-2"])]
+    chainshots[0]["instances"][0]["instance"] = {"region": "us-west-1b", "security_groups": ["group-a"],
+                                                 "key_name": "key-a"}
+    chainshots[1]["instances"][0]["instance"] = {"region": "us-west-1", "security_groups": ["group-b"],
+                                                 "key_name": "key-b"}
+
+    assert chainshot_resources(chainshots) == {"us-west-1": ({"group-a", "group-b"}, {"key-a", "key-b"})}
+    assert chainshot_resources(chainshots, keep=1) == {"us-west-1": ({"group-b"}, {"key-b"})}
+
+
+@pytest.mark.parametrize('regionscount', [2])
+def test_collect_garbage_then_thaw(chainmanager, mockregions, ethermint_version):
+    chain = chainmanager.create_ethermint_network(mockregions, ethermint_version)
+    chainshotter = Chainshotter()
+    chainshot = chainshotter.chainshot("Test", chain)
+    for region_instance_pair in chain.instances:
+        region_instance_pair.instance.terminate()
+
+    collect_garbage(set(mockregions), [chainshot])
+
+    for data in chainshot["instances"]:
+        client = boto3.client('ec2', region_name=data["instance"]["region"])
+        assert [key_pair["KeyName"] for key_pair in client.describe_key_pairs()["KeyPairs"]] == \
+            [data["instance"]["key_name"]]
+        assert data["instance"]["security_groups"][0] in [group["GroupName"] for group in
+                                                          client.describe_security_groups()["SecurityGroups"]]
+    thawed = chainshotter.thaw(chainshot)
+    assert [instance.key_name for instance in thawed.instances] == \
+        [data["instance"]["key_name"] for data in chainshot["instances"]]
@@ -0,0 +1,200 @@
+import json
+import random
+import re
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import requests
+from mock import MagicMock
+
+from tendermint_app_interface import RPCConnectionPool, EthermintInterface, EthermintException
+
+IP = "10.0.0.1"
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = json.dumps({"result": [0, {}]})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def local_rpc_url():
+    server = HTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_connection_pool_reuses_connections(local_rpc_url):
+    pool = RPCConnectionPool()
+    for _ in range(3):
+        assert pool.get(local_rpc_url + "/status").json() == {"result": [0, {}]}
+
+    assert pool.stats() == {"requests": 3, "connections": 1, "reused": 2}
+
+
+class UnavailableHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests_count = 0
+
+    def do_GET(self):
+        UnavailableHandler.requests_count += 1
+        self.send_response(503)
+        # the server handles one connection at a time
+        self.send_header("Connection", "close")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_connection_pool_retries(monkeypatch):
+    monkeypatch.setattr(UnavailableHandler, "requests_count", 0)
+    server = HTTPServer(("127.0.0.1", 0), UnavailableHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/status".format(server.server_address[1])
+    pool = RPCConnectionPool(retries=2, backoff=0)
+    try:
+        assert pool.get(url, timeout=1, retries=False).status_code == 503
+        assert UnavailableHandler.requests_count == 1
+
+        with pytest.raises(requests.exceptions.RetryError):
+            pool.get(url, timeout=1)
+        assert UnavailableHandler.requests_count == 1 + 3
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_connection_pool_timeouts():
+    pool = RPCConnectionPool(connect_timeout=2, read_timeout=7)
+    assert pool._timeout(None) == (2, 7)
+    assert pool._timeout(1) == (1, 1)
+    assert pool._timeout(10) == (2, 10)
+
+
+@pytest.fixture()
+def instance():
+    return MagicMock(public_ip_address=IP, id="i-12345678")
+
+
+@pytest.fixture()
+def mock_tendermint_blocks(requests_mock):
+    def _mock(fromm, to, apphash="HASH", served_from=None):
+        """
+        :param served_from: the lowest height returned, to mock a capped response; fromm if None
+        """
+        metas = [{"header": {"app_hash": apphash, "height": height, "time": ""}}
+                 for height in reversed(range(served_from or fromm, to + 1))]
+        url = r'http://' + IP + r':46657/blockchain\?minHeight={}\&maxHeight={}'.format(fromm, to)
+        requests_mock.add(requests_mock.GET, re.compile(url),
+                          json={"result": [0, {"block_metas": metas}]}, status=200)
+    return _mock
+
+
+@pytest.fixture()
+def mock_geth_batches(requests_mock):
+    """
+    Answers batches of eth_getBlockByNumber, in random order; returns the list of received batch sizes
+    """
+    batch_sizes = []
+
+    def _callback(request):
+        batch = json.loads(request.body)
+        batch_sizes.append(len(batch))
+        responses = [{"jsonrpc": "2.0", "id": call["id"],
+                      "result": {"number": hex(int(call["params"][0])), "hash": "0xhash", "timestamp": "0x0"}}
+                     for call in batch]
+        random.shuffle(responses)
+        return 200, {}, json.dumps(responses)
+
+    requests_mock.add_callback(requests_mock.POST, re.compile(r'http://' + IP + r':8545'), callback=_callback)
+    return batch_sizes
+
+
+def test_batch_request_matches_ids(instance, mock_geth_batches):
+    calls = [("eth_getBlockByNumber", [str(height), False]) for height in range(5)]
+    responses = EthermintInterface._batch_request(instance, calls, batch_size=2)
+
+    assert mock_geth_batches == [2, 2, 1]
+    assert [int(response["result"]["number"], 16) for response in responses] == range(5)
+
+
+def test_batch_request_invalid_batch_size(instance):
+    with pytest.raises(ValueError):
+        EthermintInterface._batch_request(instance, [("eth_blockNumber", [])], batch_size=0)
+
+
+def test_batch_request_missing_response(instance, requests_mock):
+    requests_mock.add(requests_mock.POST, re.compile(r'http://' + IP + r':8545'), json=[], status=200)
+    with pytest.raises(EthermintException):
+        EthermintInterface._batch_request(instance, [("eth_blockNumber", [])])
+
+
+def test_check_blocks(instance, mock_tendermint_blocks, mock_geth_batches):
+    mock_tendermint_blocks(2, 11)
+    blocks = EthermintInterface.check_blocks(instance, 2, 11, batch_size=4)
+
+    assert len(blocks) == 10
+    assert mock_geth_batches == [4, 4, 2]
+
+
+def test_check_blocks_out_of_sync(instance, mock_tendermint_blocks, mock_geth_batches):
+    mock_tendermint_blocks(2, 3, apphash="OTHER")
+    with pytest.raises(EthermintException):
+        EthermintInterface.check_blocks(instance, 2, 3)
+
+
+def test_iter_blocks_pages(instance, mock_tendermint_blocks):
+    for fromm, to in [(1, 20), (21, 40), (41, 45)]:
+        mock_tendermint_blocks(fromm, to)
+
+    blocks = EthermintInterface.iter_blocks(instance, 1, 45)
+    assert [block.height for block in blocks] == range(1, 46)
+
+
+def test_iter_blocks_is_lazy(instance, mock_tendermint_blocks, requests_mock):
+    requests_mock.assert_all_requests_are_fired = False
+    mock_tendermint_blocks(1, 10)
+    mock_tendermint_blocks(11, 20)
+    mock_tendermint_blocks(21, 30)
+
+    blocks = EthermintInterface.iter_blocks(instance, 1, 30, page_size=10)
+    assert next(blocks).height == 1
+    blocks.close()
+
+    # the first page and the prefetched second one
+    assert len(requests_mock.calls) == 2
+
+
+def test_iter_blocks_completes_short_pages(instance, mock_tendermint_blocks):
+    mock_tendermint_blocks(1, 20, served_from=6)
+    mock_tendermint_blocks(1, 5)
+    mock_tendermint_blocks(21, 25)
+
+    blocks = EthermintInterface.iter_blocks(instance, 1, 25)
+    assert [block.height for block in blocks] == range(1, 26)
+
+
+def test_iter_blocks_empty_page(instance, mock_tendermint_blocks):
+    mock_tendermint_blocks(1, 20, served_from=21)
+
+    with pytest.raises(EthermintException):
+        list(EthermintInterface.iter_blocks(instance, 1, 25))
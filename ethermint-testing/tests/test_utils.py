@@ -0,0 +1,129 @@
+import os
+import subprocess
+import time
+
+import pytest
+from mock import MagicMock
+
+import utils
+from chain import Chain
+from settings import MAX_MACHINE_CALL_TRIES
+from utils import SSHSessions, run_sh_script, SSH_OPTIONS, get_shh_key_file, run_on_chain, raise_for_failures, \
+    RemoteCommandError
+
+
+@pytest.fixture()
+def keyfile(tmp_files_dir):
+    open(os.path.join(tmp_files_dir, "key.pem"), 'w').close()
+    return "key"
+
+
+@pytest.fixture()
+def mocksleep(monkeypatch):
+    mock = MagicMock(time.sleep)
+    monkeypatch.setattr(time, 'sleep', mock)
+    return mock
+
+
+def test_ssh_sessions_stats():
+    sessions = SSHSessions()
+    sessions.opened("key", "1.1.1.1", 2.0)
+    sessions.opened("key", "2.2.2.2", 1.0)
+    for ip in ["1.1.1.1", "1.1.1.1", "1.1.1.1", "2.2.2.2"]:
+        sessions.record("key", ip)
+
+    assert sessions.is_open("key", "1.1.1.1") and not sessions.is_open("key", "3.3.3.3")
+    assert sessions.stats() == {"sessions": 2, "calls": 4, "reused": 2, "handshake_time": 3.0,
+                                "handshake_time_saved": 4.0}
+
+
+def test_ssh_sessions_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(utils.time, 'time', lambda: now[0])
+    sessions = SSHSessions(control_persist=300)
+    sessions.opened("key", "1.1.1.1", 2.0)
+    sessions.record("key", "1.1.1.1")
+
+    now[0] += 299
+    assert sessions.is_open("key", "1.1.1.1")
+    sessions.record("key", "1.1.1.1")
+    now[0] += 300
+    assert not sessions.is_open("key", "1.1.1.1")
+
+    sessions.opened("key", "1.1.1.1", 1.0)
+    sessions.record("key", "1.1.1.1")
+    assert sessions.stats() == {"sessions": 2, "calls": 3, "reused": 1, "handshake_time": 3.0,
+                                "handshake_time_saved": 2.0}
+
+
+def test_ssh_control_path_is_per_connection():
+    assert "ControlPath=/tmp/ethermint-ssh-%C" in SSH_OPTIONS
+
+
+def test_run_sh_script_multiplexes(mocksubprocess, keyfile, monkeypatch):
+    monkeypatch.setattr(utils, 'ssh_sessions', SSHSessions())
+    run_sh_script("shell_scripts/get_datetime.sh", keyfile, "1.1.1.1")
+    run_sh_script("shell_scripts/get_datetime.sh", keyfile, "1.1.1.1")
+
+    mocksubprocess.assert_called_with("ssh {} -i {} ubuntu@1.1.1.1 'bash -s' < shell_scripts/get_datetime.sh".format(
+        SSH_OPTIONS, get_shh_key_file(keyfile)), shell=True)
+    assert "ControlMaster=auto" in SSH_OPTIONS
+    # the master connection is opened once, on its own
+    subprocess.check_call.assert_called_once_with("ssh {} -i {} ubuntu@1.1.1.1 true".format(
+        SSH_OPTIONS, get_shh_key_file(keyfile)), shell=True)
+    assert utils.ssh_sessions.stats()["reused"] == 1
+
+
+def test_run_sh_script_backs_off(mocksubprocess, mocksleep, keyfile):
+    mocksubprocess.side_effect = subprocess.CalledProcessError(255, "ssh")
+
+    with pytest.raises(IOError):
+        run_sh_script("shell_scripts/get_datetime.sh", keyfile, "1.1.1.1")
+
+    assert mocksubprocess.call_count == MAX_MACHINE_CALL_TRIES
+    delays = [call[0][0] for call in mocksleep.call_args_list]
+    assert len(delays) == MAX_MACHINE_CALL_TRIES - 1
+    assert all(0 <= delay <= 2 ** i for i, delay in enumerate(delays))
+
+
+def test_run_sh_script_succeeds_on_last_try(mocksubprocess, mocksleep, keyfile):
+    failures = [subprocess.CalledProcessError(255, "ssh")] * (MAX_MACHINE_CALL_TRIES - 1)
+    mocksubprocess.side_effect = failures + ["output"]
+
+    assert run_sh_script("shell_scripts/get_datetime.sh", keyfile, "1.1.1.1") == "output"
+
+
+@pytest.fixture()
+def fake_chain(keyfile):
+    return Chain([MagicMock(id="i-{}".format(i), key_name=keyfile, public_ip_address="10.0.0.{}".format(i))
+                  for i in range(5)])
+
+
+def test_run_on_chain(mocksubprocess, fake_chain):
+    mocksubprocess.side_effect = lambda command, **kwargs: command.split("ubuntu@")[1].split(" ")[0]
+
+    results = run_on_chain(fake_chain, "shell_scripts/get_datetime.sh", concurrency=2)
+
+    assert [result.instance_id for result in results] == [instance.id for instance in fake_chain.instances]
+    assert [result.output for result in results] == [instance.public_ip_address for instance in fake_chain.instances]
+    assert all(result.ok and result.latency >= 0 for result in results)
+    raise_for_failures(results, "shell_scripts/get_datetime.sh")
+
+
+def test_run_on_chain_failures(mocksubprocess, mocksleep, fake_chain):
+    def _side_effect(command, **kwargs):
+        if "10.0.0.3" in command:
+            raise subprocess.CalledProcessError(3, command, "failed")
+        return "ok"
+
+    mocksubprocess.side_effect = _side_effect
+
+    results = run_on_chain(fake_chain, "shell_scripts/get_datetime.sh", concurrency=1)
+    assert [result.returncode for result in results] == [0, 0, 0, 3, 0]
+    assert results[3].output == "failed"
+    with pytest.raises(RemoteCommandError):
+        raise_for_failures(results, "shell_scripts/get_datetime.sh")
+
+    # sequentially, the nodes after the failing one are not even tried
+    results = run_on_chain(fake_chain, "shell_scripts/get_datetime.sh", concurrency=1, fail_fast=True)
+    assert [result.returncode for result in results] == [0, 0, 0, 3, None]
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+from mock import MagicMock
+
+from waiting_for_ec2 import iter_running_instances, iter_running_instance_descriptions, iter_available_volumes, \
+    WaitTimeoutError
+
+
+@pytest.fixture()
+def mocksleep(monkeypatch):
+    mock = MagicMock(time.sleep)
+    monkeypatch.setattr(time, 'sleep', mock)
+    return mock
+
+
+def describe_instances_response(states):
+    return {"Reservations": [{"Instances": [{"InstanceId": instance_id, "State": {"Name": state}}
+                                            for instance_id, state in states.items()]}]}
+
+
+def test_instances_yielded_as_they_run(mocksleep):
+    client = MagicMock()
+    client.describe_instances.side_effect = [
+        ClientError({"Error": {"Code": "InvalidInstanceID.NotFound"}}, "DescribeInstances"),
+        describe_instances_response({"i-1": "pending", "i-2": "running", "i-3": "pending"}),
+        describe_instances_response({"i-1": "pending", "i-3": "pending"}),
+        describe_instances_response({"i-1": "pending", "i-3": "pending"}),
+        describe_instances_response({"i-1": "running", "i-3": "pending"}),
+        describe_instances_response({"i-3": "running"}),
+    ]
+
+    ready = list(iter_running_instances({"us-west-1": ["i-1", "i-2", "i-3"]}, clients={"us-west-1": client}))
+
+    assert ready == [("us-west-1", "i-2"), ("us-west-1", "i-1"), ("us-west-1", "i-3")]
+    # one call for all the pending instances
+    assert [call[1]["InstanceIds"] for call in client.describe_instances.call_args_list] == \
+        [["i-1", "i-2", "i-3"]] * 2 + [["i-1", "i-3"]] * 3 + [["i-3"]]
+    # backs off while nothing happens
+    assert [call[0][0] for call in mocksleep.call_args_list] == [1, 1, 2, 4, 1]
+
+
+def test_instance_descriptions(mocksleep):
+    client = MagicMock()
+    client.describe_instances.return_value = describe_instances_response({"i-1": "running"})
+
+    ready = list(iter_running_instance_descriptions({"us-west-1": ["i-1"]}, clients={"us-west-1": client}))
+
+    assert ready == [("us-west-1", {"InstanceId": "i-1", "State": {"Name": "running"}})]
+    assert client.describe_instances.call_count == 1
+
+
+def test_volumes_in_many_regions(mocksleep):
+    clients = {region: MagicMock() for region in ["us-west-1", "eu-central-1"]}
+    clients["us-west-1"].describe_volumes.return_value = {"Volumes": [{"VolumeId": "vol-1", "State": "available"}]}
+    clients["eu-central-1"].describe_volumes.return_value = {"Volumes": [{"VolumeId": "vol-2", "State": "available"}]}
+
+    ready = iter_available_volumes({"us-west-1": ["vol-1"], "eu-central-1": ["vol-2"]}, clients=clients)
+
+    assert sorted(ready) == [("eu-central-1", "vol-2"), ("us-west-1", "vol-1")]
+    mocksleep.assert_not_called()
+
+
+def test_wait_failures(mocksleep):
+    client = MagicMock()
+    client.describe_volumes.return_value = {"Volumes": [{"VolumeId": "vol-1", "State": "error"}]}
+    with pytest.raises(RuntimeError):
+        list(iter_available_volumes({"us-west-1": ["vol-1"]}, clients={"us-west-1": client}))
+
+    client.describe_volumes.return_value = {"Volumes": [{"VolumeId": "vol-1", "State": "creating"}]}
+    with pytest.raises(WaitTimeoutError):
+        list(iter_available_volumes({"us-west-1": ["vol-1"]}, clients={"us-west-1": client}, timeout=-1))
@@ -1,15 +1,25 @@
+import Queue
 import os
+import random
 import subprocess
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 
 import boto3
 import logging
 
 import time
 
-from settings import DEFAULT_FILES_LOCATION, MAX_MACHINE_CALL_TRIES
+from settings import DEFAULT_FILES_LOCATION, MAX_MACHINE_CALL_TRIES, SSH_CONTROL_PATH, SSH_CONTROL_PERSIST, \
+    SSH_RETRY_BASE_DELAY, SSH_RETRY_MAX_DELAY, DEFAULT_SSH_CONCURRENCY
 
 logger = logging.getLogger(__name__)
 
+# options for both ssh and scp; connections to a host are multiplexed over a single master connection
+SSH_OPTIONS = "-o StrictHostKeyChecking=no -o ControlMaster=auto -o ControlPath={} -o ControlPersist={}".format(
+    SSH_CONTROL_PATH, SSH_CONTROL_PERSIST)
+
 
 def get_shh_key_file(filename):
     """
@@ -39,6 +49,27 @@ def get_region_name(region):
     return region
 
 
+def thread_map(func, items, concurrency=None):
+    """
+    Maps func over items in a pool of threads; meant for I/O bound work like RPC or SSH calls
+    Exceptions raised by func are re-raised in the calling thread
+    :param func: a function of one argument
+    :param items: an iterable of arguments
+    :param concurrency: the maximum number of threads, defaults to one thread per item
+    :return: a list of results, in the order of items
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    pool = ThreadPool(min(concurrency or len(items), len(items)))
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def create_keyfile(name, regions_set):
     """
     Creates a key pair in AWS and saves the .pem file to default location,
@@ -74,6 +105,102 @@ def create_keyfile(name, regions_set):
         print(res.key_fingerprint)
 
 
+class RemoteCommandError(IOError):
+    """
+    Running a script on a node through SSH failed; returncode and output are those of the last try
+    """
+
+    def __init__(self, message, returncode=None, output=None):
+        super(RemoteCommandError, self).__init__(message)
+        self.returncode = returncode
+        self.output = output
+
+
+class NodeResult(namedtuple("NodeResult", ["instance_id", "ip_address", "output", "returncode", "latency", "error"])):
+    """
+    The outcome of running a script on a single node; returncode is None if the script wasn't run to completion
+    """
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+
+class SSHSessions(object):
+    """
+    Book-keeping of the multiplexed SSH sessions, per (key name, IP)
+    The master connection to a host is opened on its own, with a no-op command, so that its handshake is timed apart
+    from the scripts; later calls reuse it, until it has been idle for ControlPersist and ssh closes it
+    """
+
+    def __init__(self, control_persist=SSH_CONTROL_PERSIST):
+        """
+        :param control_persist: seconds an idle master connection is kept open, see SSH_OPTIONS
+        """
+        self.control_persist = control_persist
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._closed = []
+
+    def is_open(self, ssh_key_name, ip_address):
+        with self._lock:
+            session = self._sessions.get((ssh_key_name, ip_address))
+            return session is not None and time.time() - session["last_used"] < self.control_persist
+
+    def opened(self, ssh_key_name, ip_address, handshake_time):
+        with self._lock:
+            closed = self._sessions.get((ssh_key_name, ip_address))
+            if closed is not None:
+                self._closed.append(closed)
+            self._sessions[(ssh_key_name, ip_address)] = {"handshake": handshake_time, "calls": 0,
+                                                          "last_used": time.time()}
+
+    def record(self, ssh_key_name, ip_address):
+        with self._lock:
+            session = self._sessions[(ssh_key_name, ip_address)]
+            session["calls"] += 1
+            session["last_used"] = time.time()
+
+    def stats(self):
+        """
+        Without multiplexing every call would pay the handshake, so every call after the first one to a host saves
+        the handshake time of its master connection; master connections which expired count as sessions of their own
+        :return: dict
+        """
+        with self._lock:
+            sessions = [dict(session) for session in self._sessions.values() + self._closed]
+        return {
+            "sessions": len(sessions),
+            "calls": sum(session["calls"] for session in sessions),
+            "reused": sum(max(session["calls"] - 1, 0) for session in sessions),
+            "handshake_time": sum(session["handshake"] for session in sessions),
+            "handshake_time_saved": sum(session["handshake"] * max(session["calls"] - 1, 0) for session in sessions)
+        }
+
+
+ssh_sessions = SSHSessions()
+
+
+def _retry_delay(tries):
+    """
+    Exponential backoff with full jitter, so that many nodes retrying at once don't retry in lockstep
+    """
+    return random.uniform(0, min(SSH_RETRY_MAX_DELAY, SSH_RETRY_BASE_DELAY * 2 ** (tries - 1)))
+
+
+def _open_master_connection(ssh_key_name, ip_address):
+    """
+    Opens the master connection to a host with a no-op command, timing the SSH handshake
+    :raises subprocess.CalledProcessError: if the host can't be connected to
+    """
+    start = time.time()
+    subprocess.check_call("ssh {0} -i {1} ubuntu@{2} true".format(SSH_OPTIONS, get_shh_key_file(ssh_key_name),
+                                                                  ip_address), shell=True)
+    handshake_time = time.time() - start
+    ssh_sessions.opened(ssh_key_name, ip_address, handshake_time)
+    logger.info("Opened the SSH master connection to {} in {:.2f}s".format(ip_address, handshake_time))
+
+
 def run_sh_script(script_filename, ssh_key_name, ip_address):
     """
     Allows to run a shell script on an instance through SSH
@@ -83,53 +210,142 @@ def run_sh_script(script_filename, ssh_key_name, ip_address):
     :return:
     """
     logger.info("Running ./{} on instance IP: {}".format(script_filename, ip_address))
-    ssh_command = "ssh -o StrictHostKeyChecking=no -i {0} ubuntu@{1} 'bash -s' < {2}" \
-                  "".format(get_shh_key_file(ssh_key_name), ip_address, script_filename)
+    ssh_command = "ssh {0} -i {1} ubuntu@{2} 'bash -s' < {3}" \
+                  "".format(SSH_OPTIONS, get_shh_key_file(ssh_key_name), ip_address, script_filename)
 
     result = 1
+    output = None
     tries = 0
     while result != 0 and tries < MAX_MACHINE_CALL_TRIES:
         try:
             tries += 1
+            if not ssh_sessions.is_open(ssh_key_name, ip_address):
+                _open_master_connection(ssh_key_name, ip_address)
             output = subprocess.check_output(ssh_command, shell=True)  # FIXME, shell=True unsafe
+            ssh_sessions.record(ssh_key_name, ip_address)
             result = 0
         except subprocess.CalledProcessError as e:
+            result, output = e.returncode, e.output
             logger.info("SSH {} to {}, No success yet, tries {}/{}: {}".format(script_filename,
                                                                                ip_address,
                                                                                tries,
                                                                                MAX_MACHINE_CALL_TRIES,
                                                                                e.message))
-            time.sleep(5)  # let things settle, SSH refuses connection
+            if tries < MAX_MACHINE_CALL_TRIES:
+                time.sleep(_retry_delay(tries))  # let things settle, SSH refuses connection
 
-    if tries == MAX_MACHINE_CALL_TRIES:
-        raise IOError("Unable to perform actions using SSH, {} on {}".format(script_filename,
-                                                                             ip_address))
+    if result != 0:
+        raise RemoteCommandError("Unable to perform actions using SSH, {} on {}".format(script_filename,
+                                                                                        ip_address),
+                                 returncode=result, output=output)
     else:
         logger.info("{} run successfully".format(script_filename))
         return output
 
 
-def run_ethermint(chain):
-    first_seed = None
-    for i, instance in enumerate(chain.instances):
-        logger.info("Running ethermint on instance ID: {}".format(instance.id))
+def _node_worker(script_filename, tasks, done, stop):
+    """
+    Runs the script on the nodes taken from tasks, putting their (index, NodeResult) in done, until tasks is empty
+    or stop is set
+    """
+    while not stop.is_set():
+        try:
+            i, (instance_id, key_name, ip) = tasks.get_nowait()
+        except Queue.Empty:
+            return
+        start = time.time()
+        try:
+            output = run_sh_script(script_filename, key_name, ip)
+            done.put((i, NodeResult(instance_id, ip, output, 0, time.time() - start, None)))
+        except Exception as e:
+            done.put((i, NodeResult(instance_id, ip, getattr(e, "output", None), getattr(e, "returncode", None),
+                                    time.time() - start, str(e))))
+
+
+def _run_on_nodes(nodes, script_filename, concurrency, fail_fast):
+    """
+    :param nodes: a list of (instance id, key name, IP) tuples
+    """
+    results = [NodeResult(instance_id, ip, None, None, None, "not run") for instance_id, _, ip in nodes]
+    if not nodes:
+        return results
+
+    tasks = Queue.Queue()
+    for task in enumerate(nodes):
+        tasks.put(task)
+    done = Queue.Queue()
+    stop = threading.Event()
+
+    for _ in xrange(min(concurrency or len(nodes), len(nodes))):
+        thread = threading.Thread(target=_node_worker, args=(script_filename, tasks, done, stop))
+        thread.daemon = True  # in fail fast mode, calls in flight are left to finish in the background
+        thread.start()
 
-        # run ethermint
-        if first_seed is None:
-            run_sh_script("shell_scripts/run_ethermint.sh",
-                          instance.key_name,
-                          instance.public_ip_address)
-            first_seed = str(instance.public_ip_address) + ":46656"
-        else:
-            run_sh_script("shell_scripts/run_ethermint.sh {}".format(first_seed),
-                          instance.key_name,
-                          instance.public_ip_address)
+    for _ in xrange(len(nodes)):
+        i, result = done.get()
+        results[i] = result
+        if fail_fast and not result.ok:
+            logger.info("Running {} on instance {} failed, not waiting for other instances".format(
+                script_filename, result.instance_id))
+            stop.set()
+            break
+    logger.info("SSH sessions: {}".format(ssh_sessions.stats()))
+    return results
 
 
-def halt_ethermint(chain):
-    for i, instance in enumerate(chain.instances):
-        logger.info("Halting ethermint on instance ID: {}".format(instance.id))
+def run_on_chain(chain, script_filename, concurrency=DEFAULT_SSH_CONCURRENCY, fail_fast=False):
+    """
+    Runs a shell script on every node of the chain, in a pool of threads
+    :param script_filename: the script, possibly followed by its arguments
+    :param concurrency: the maximum number of nodes to run the script on at once
+    :param fail_fast: return as soon as the script fails on any node
+    :return: a list of NodeResults, in the order of chain.instances; nodes that weren't done when returning
+             early have returncode None
+    """
+    nodes = [(instance.id, instance.key_name, instance.public_ip_address) for instance in chain.instances]
+    return _run_on_nodes(nodes, script_filename, concurrency, fail_fast)
+
+
+def raise_for_failures(results, script_filename):
+    """
+    :param results: NodeResults as returned by run_on_chain
+    :raises RemoteCommandError: if the script didn't succeed on any of the nodes
+    """
+    failed = [result for result in results if not result.ok]
+    if failed:
+        raise RemoteCommandError("{} failed on instances {}".format(
+            script_filename, ", ".join("{} ({})".format(result.instance_id, result.error) for result in failed)),
+            returncode=failed[0].returncode, output=failed[0].output)
 
-        run_sh_script("shell_scripts/halt_ethermint.sh",
-                      instance.key_name,
-                      instance.public_ip_address)
+
+def run_ethermint(chain, concurrency=1):
+    """
+    Starts ethermint on all of the nodes of the chain; the first node is started first,
+    as a seed for all of the others
+    :param concurrency: how many of the other nodes to start at once, once the seed is up
+    :return: a dictionary instance id -> how long it took to start ethermint on the node (seconds)
+    """
+    nodes = [(instance.id, instance.key_name, instance.public_ip_address) for instance in chain.instances]
+    if not nodes:
+        return {}
+
+    logger.info("Running ethermint on seed instance ID: {}".format(nodes[0][0]))
+    results = _run_on_nodes(nodes[:1], "shell_scripts/run_ethermint.sh", 1, True)
+    raise_for_failures(results, "shell_scripts/run_ethermint.sh")
+
+    first_seed = str(nodes[0][2]) + ":46656"
+    script = "shell_scripts/run_ethermint.sh {}".format(first_seed)
+    results += _run_on_nodes(nodes[1:], script, concurrency, True)
+    raise_for_failures(results, script)
+    return dict((result.instance_id, result.latency) for result in results)
+
+
+def halt_ethermint(chain, concurrency=1):
+    """
+    Stops ethermint on all of the nodes of the chain
+    :param concurrency: how many nodes to stop at once
+    :return: a dictionary instance id -> how long it took to stop ethermint on the node (seconds)
+    """
+    results = run_on_chain(chain, "shell_scripts/halt_ethermint.sh", concurrency, fail_fast=True)
+    raise_for_failures(results, "shell_scripts/halt_ethermint.sh")
+    return dict((result.instance_id, result.latency) for result in results)
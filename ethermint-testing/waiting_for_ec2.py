@@ -1,6 +1,17 @@
-import boto3
+import logging
 import time
 
+import boto3
+from botocore.exceptions import ClientError
+
+from settings import WAIT_MIN_INTERVAL, WAIT_MAX_INTERVAL, WAIT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class WaitTimeoutError(RuntimeError):
+    pass
+
 
 def wait_for_detached(volume, instance):
     state = None
@@ -10,8 +21,135 @@ def wait_for_detached(volume, instance):
         time.sleep(3)
 
 
-def wait_for_available_volume(volume, region):
-    if volume.state != 'available':
-        ec2_client = boto3.client('ec2', region_name=region)
-        volume_waiter = ec2_client.get_waiter('volume_available')
-        volume_waiter.wait(VolumeIds=[volume.id])
+def _describe_instance_states(client, instance_ids):
+    response = client.describe_instances(InstanceIds=instance_ids)
+    return {instance["InstanceId"]: (instance["State"]["Name"], instance)
+            for reservation in response["Reservations"] for instance in reservation["Instances"]}
+
+
+def _describe_volume_states(client, volume_ids):
+    response = client.describe_volumes(VolumeIds=volume_ids)
+    return {volume["VolumeId"]: (volume["State"], volume) for volume in response["Volumes"]}
+
+
+def _describe_snapshot_states(client, snapshot_ids):
+    response = client.describe_snapshots(SnapshotIds=snapshot_ids)
+    return {snapshot["SnapshotId"]: (snapshot["State"], snapshot) for snapshot in response["Snapshots"]}
+
+
+def _poll_region(region, pending, clients, describe_states, ready_state, failed_states):
+    """
+    A single describe call for all the resources of a region still pending; the ready ones are removed from pending
+    :return: a list of (resource id, description) of the resources which became ready
+    """
+    if region not in clients:
+        clients[region] = boto3.client('ec2', region_name=region)
+    try:
+        states = describe_states(clients[region], sorted(pending[region]))
+    except ClientError as e:
+        # freshly created resources may not be visible to describe calls yet
+        if not e.response["Error"]["Code"].endswith(".NotFound"):
+            raise
+        states = {}
+
+    ready = []
+    for resource_id, (state, description) in states.items():
+        if state == ready_state:
+            pending[region].discard(resource_id)
+            ready.append((resource_id, description))
+        elif state in failed_states:
+            raise RuntimeError("{} in {} went into state {} instead of {}".format(
+                resource_id, region, state, ready_state))
+    if not pending[region]:
+        del pending[region]
+    return ready
+
+
+def _iter_ready(ids_by_region, describe_states, ready_state, failed_states, clients=None, timeout=WAIT_TIMEOUT,
+                min_interval=WAIT_MIN_INTERVAL, max_interval=WAIT_MAX_INTERVAL):
+    """
+    Polls EC2 with a single describe call per region for all the resources still pending,
+    yielding each resource as soon as it is ready.
+    The poll interval starts at min_interval, doubles up to max_interval while nothing becomes ready
+    and goes back to min_interval when something does
+    :return: a generator of (region, resource id, description from the describe call)
+    """
+    clients = dict(clients or {})
+    pending = {region: set(ids) for region, ids in ids_by_region.items() if ids}
+    deadline = time.time() + timeout
+    interval = min_interval
+
+    while pending:
+        progress = False
+        for region in pending.keys():
+            for resource_id, description in _poll_region(region, pending, clients, describe_states, ready_state,
+                                                         failed_states):
+                progress = True
+                yield region, resource_id, description
+
+        if not pending:
+            break
+        if time.time() > deadline:
+            raise WaitTimeoutError("Timed out waiting for {} to become {}".format(
+                ", ".join(sorted(resource_id for ids in pending.values() for resource_id in ids)), ready_state))
+
+        interval = min_interval if progress else interval
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+
+def _ids(ready):
+    return ((region, resource_id) for region, resource_id, _ in ready)
+
+
+def iter_running_instances(instance_ids_by_region, clients=None, timeout=WAIT_TIMEOUT):
+    """
+    Waits for instances in many regions at once
+    :param instance_ids_by_region: a dict region -> list of instance ids
+    :param clients: optional dict region -> EC2 client to poll with, clients are created as needed otherwise
+    :return: a generator of (region, instance id), in the order the instances become running
+    """
+    return ((region, description["InstanceId"]) for region, description in
+            iter_running_instance_descriptions(instance_ids_by_region, clients, timeout))
+
+
+def iter_running_instance_descriptions(instance_ids_by_region, clients=None, timeout=WAIT_TIMEOUT):
+    """
+    Like iter_running_instances, with the descriptions of the instances from the batched describe calls
+    :return: a generator of (region, instance description), in the order the instances become running
+    """
+    return ((region, description) for region, _, description in
+            _iter_ready(instance_ids_by_region, _describe_instance_states, 'running',
+                        ['shutting-down', 'terminated', 'stopping', 'stopped'], clients, timeout))
+
+
+def iter_terminated_instances(instance_ids_by_region, clients=None, timeout=WAIT_TIMEOUT):
+    """
+    Waits for instances in many regions at once to be terminated
+    :param instance_ids_by_region: a dict region -> list of instance ids
+    :param clients: optional dict region -> EC2 client to poll with, clients are created as needed otherwise
+    :return: a generator of (region, instance id), in the order the instances are terminated
+    """
+    return _ids(_iter_ready(instance_ids_by_region, _describe_instance_states, 'terminated', [], clients, timeout))
+
+
+def iter_available_volumes(volume_ids_by_region, clients=None, timeout=WAIT_TIMEOUT):
+    """
+    Waits for volumes in many regions at once
+    :param volume_ids_by_region: a dict region -> list of volume ids
+    :param clients: optional dict region -> EC2 client to poll with, clients are created as needed otherwise
+    :return: a generator of (region, volume id), in the order the volumes become available
+    """
+    return _ids(_iter_ready(volume_ids_by_region, _describe_volume_states, 'available',
+                            ['deleting', 'deleted', 'error'], clients, timeout))
+
+
+def iter_completed_snapshots(snapshot_ids_by_region, clients=None, timeout=WAIT_TIMEOUT):
+    """
+    Waits for snapshots in many regions at once
+    :param snapshot_ids_by_region: a dict region -> list of snapshot ids
+    :param clients: optional dict region -> EC2 client to poll with, clients are created as needed otherwise
+    :return: a generator of (region, snapshot id), in the order the snapshots complete
+    """
+    return _ids(_iter_ready(snapshot_ids_by_region, _describe_snapshot_states, 'completed', ['error'], clients,
+                            timeout))